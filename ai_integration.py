@@ -1,17 +1,29 @@
-from dataclasses import dataclass
+import functools
+import time
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 
 import logfire
 from pydantic_ai import Agent, RunContext
+from pydantic_ai.exceptions import ModelHTTPError
+from pydantic_ai.tools import ToolDefinition
 from pydantic_ai.usage import UsageLimits
 from sqlmodel import Session, select
 
-from .calendar_integration import fetch_google_calendar_events, create_google_calendar_event, delete_google_calendar_event
-from .email_integration import get_emails, draft_email, send_draft, get_drafts, get_email_details, delete_draft
+from .calendar_integration import fetch_google_calendar_events, fetch_google_free_busy, create_google_calendar_event, delete_google_calendar_event
+from .email_integration import EMAIL_SEARCH_BY_THREAD, iter_emails, draft_email, send_draft, get_drafts, get_email_details, delete_draft
+from .bm25_index import BM25_THREAD_INDEX_FILENAME, BM25Index, user_bm25_index_path
+from .vector_index import VECTOR_THREAD_INDEX_DIRECTORY, VectorIndex, index_lock, user_vector_index_path
 from .database import engine
+from .metrics import instrument_tool, agent_run_duration, model_inference_duration, observe
+from .conversation import CONVERSATION_CONTEXT_ENABLED, conversation_history
+from .model_routing import route_message
+from .response_cache import RESPONSE_CACHE_ENABLED, response_cache, used_tools
+from .tool_selection import select_tools, tool_description
+from . import tool_compaction
 from .models.chat_message import ChatMessage
 from .models.user import User
-from . import search
+from . import calendar_cache, profiling, search
 
 Agent.instrument_all()
 
@@ -19,38 +31,110 @@ Agent.instrument_all()
 class MyDeps:
     token: str
     user: User
+    # the tools offered to the model in this run, None offers all tools
+    tool_names: frozenset[str] | None = None
+    # the tools with side effects that ran, e.g. sent a draft, see _records_side_effect
+    side_effects: list[str] = field(default_factory=list)
+
+SYSTEM_PROMPT = (
+    'You are a helpful AI assistant to the user.\n'
+    'Your answer should be concise and to the point.\n'
+    'Try to fulfill the users request to the best of your abilities.\n'
+    'Do not ask if you should proceed. Simply fulfill the request.\n'
+        
+    'You have access to tools that may help you with your tasks.\n'
+    'If a request requires knowledge of any date and time, use the get_offset_time tool to confirm the current date and time.\n'
+    'If you need to know the current time or date, use the get_offset_time tool.\n'
+    'Minimize the use of tools, while still fulfilling the request to the best of your abilities.\n'
+        
+    'You have access to tools that allow you to interact with the user\'s calendar and email.\n'
+)
 
 # Models: openai:gpt-4o-mini anthropic:claude-3-haiku-20240307 google-gla:gemini-2.0-flash
 agent = Agent(
     'openai:gpt-4o-mini',
-    system_prompt=(
-        'You are a helpful AI assistant to the user.\n'
-        'Your answer should be concise and to the point.\n'
-        'Try to fulfill the users request to the best of your abilities.\n'
-        'Do not ask if you should proceed. Simply fulfill the request.\n'
-        
-        'You have access to tools that may help you with your tasks.\n'
-        'If a request requires knowledge of any date and time, use the get_offset_time tool to confirm the current date and time.\n'
-        'If you need to know the current time or date, use the get_offset_time tool.\n'
-        'Minimize the use of tools, while still fulfilling the request to the best of your abilities.\n'
-        
-        'You have access to tools that allow you to interact with the user\'s calendar and email.\n'
-    ),
+    system_prompt=SYSTEM_PROMPT,
     deps_type=MyDeps
 )
 
+if RESPONSE_CACHE_ENABLED and CONVERSATION_CONTEXT_ENABLED:
+    logfire.warn("The response cache only answers the first message of a conversation while conversation context is enabled")
 
-async def get_ai_response(user_prompt: str, token: str, user: User) -> str:
-    """ Get an AI response to a user prompt """
-    ai_response = await agent.run(
-        user_prompt,
-        deps=MyDeps(token=token, user=user),
-        usage_limits=UsageLimits(request_tokens_limit=20000, total_tokens_limit=30000)
-    )
-
-    return ai_response.data
 
-@agent.tool_plain
+async def get_ai_response(user_prompt: str, token: str, user: User) -> str:
+    """
+    Get an AI response to a user prompt
+
+    The prompt is routed to a model and a tool subset first, which is narrowed down to the tools
+    relevant to the prompt. If a model fails, the next model of the route is tried,
+    unless a tool with side effects already ran, which the next model would run again.
+    The agent sees the summary of the conversation and its latest messages, see conversation.conversation_history.
+    Answers that needed no tools are cached, if enabled, and served again for similar prompts.
+    The cache is bypassed while there is a conversation, whose answers depend on more than the prompt.
+    """
+    with observe(model_inference_duration, model='bi_encoder'):
+        message_embedding = await profiling.to_thread(
+            search.bi_encoder.encode, user_prompt, convert_to_tensor=True, show_progress_bar=False
+        )
+    message_history = await profiling.to_thread(conversation_history, user.id, SYSTEM_PROMPT)
+    if not message_history:
+        cached_response = response_cache.get(user.id, message_embedding)
+        if cached_response is not None:
+            return cached_response
+
+    route = route_message(user_prompt, message_embedding)
+    tool_names = select_tools(message_embedding, TOOL_DESCRIPTIONS, route.tool_names)
+    deps = MyDeps(token=token, user=user, tool_names=tool_names)
+    last_error = None
+    for model in route.models:
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            ai_response = await agent.run(
+                user_prompt,
+                model=model,
+                message_history=message_history,
+                deps=deps,
+                usage_limits=UsageLimits(request_tokens_limit=20000, total_tokens_limit=30000)
+            )
+            outcome = 'ok'
+            if not message_history and not used_tools(ai_response.new_messages()):
+                response_cache.put(user.id, user_prompt, message_embedding, ai_response.data)
+            return ai_response.data
+        except ModelHTTPError as error:
+            if deps.side_effects:
+                logfire.error(
+                    "Model {model} failed after tools with side effects ran, not falling back",
+                    model=model, route=route.name, side_effects=deps.side_effects, error=str(error),
+                )
+                raise
+            logfire.warn("Model {model} failed, trying the next one", model=model, route=route.name, error=str(error))
+            last_error = error
+        finally:
+            agent_run_duration.labels(route=route.name, model=model, outcome=outcome).observe(time.perf_counter() - start)
+    if last_error is None:
+        raise RuntimeError(f"Route {route.name} has no models to run")
+    raise last_error
+
+
+def _records_side_effect(function):
+    """ Record in the run's deps that a tool with side effects ran, apply it below instrument_tool """
+    @functools.wraps(function)
+    async def wrapper(context: RunContext[MyDeps], *args, **kwargs):
+        context.deps.side_effects.append(function.__name__)
+        return await function(context, *args, **kwargs)
+    return wrapper
+
+
+async def _prepare_tool(context: RunContext[MyDeps], tool_definition: ToolDefinition) -> ToolDefinition | None:
+    """ Internal method to only offer the tools selected for the current run """
+    tool_names = context.deps.tool_names
+    if tool_names is None or tool_definition.name in tool_names:
+        return tool_definition
+    return None
+
+@agent.tool_plain(prepare=_prepare_tool)
+@instrument_tool
 def get_offset_time(
         offset_seconds: int = 0,
         offset_minutes: int = 0,
@@ -74,12 +158,12 @@ def get_offset_time(
         hours=offset_hours,
         days=offset_days
     )
-    logfire.info(f"Time delta: {delta}")
     time_string = (datetime.now() + delta).strftime("%Y-%m-%d(%A) %H:%M:%S")
-    logfire.info(f"Final date and time string: {time_string}")
+    logfire.debug("Offset time {time_string} for delta {delta}", time_string=time_string, delta=str(delta))
     return time_string
 
-@agent.tool
+@agent.tool(prepare=_prepare_tool)
+@instrument_tool
 async def get_user_timezone(context: RunContext[MyDeps]) -> str:
     """ Get the user's timezone """
     user = context.deps.user
@@ -87,12 +171,23 @@ async def get_user_timezone(context: RunContext[MyDeps]) -> str:
     return "Europe/Berlin"
     # TODO: Placeholder, replace with actual timezone retrieval logic
 
-@agent.tool
-async def get_calendar_events(context: RunContext[MyDeps], search_query: str = None, start_time: str = None, end_time: str = None) -> list[dict] | str:
+def _search_calendar_events(events: list[dict], query: str, num_hits: int) -> list[dict]:
+    """ Internal method to rank calendar events by their relevance to the query and keep the best ones """
+    if not query:
+        return events[:num_hits]
+    with logfire.span("Searching {count} calendar events", count=len(events)):
+        results = search.search(search.preprocess_events(events), query, num_hits=num_hits)
+    return [result['event'] for result in results]
+
+
+@agent.tool(prepare=_prepare_tool)
+@instrument_tool
+async def get_calendar_events(context: RunContext[MyDeps], search_query: str = None, start_time: str = None, end_time: str = None) -> dict | str:
     """
     Get all calendar events from the user's calendars matching the parameters
     MUST INCLUDE AT LEAST ONE OF THE PARAMETERS
     ALWAYS USE get_offset_time TO GET THE CURRENT TIME PRIOR TO CALLING THIS FUNCTION
+    Results of a search query and large results are ranked by relevance, only the best events are returned.
 
     Args:
         search_query (str, optional): The search query to filter events. Defaults to None.
@@ -122,21 +217,94 @@ async def get_calendar_events(context: RunContext[MyDeps], search_query: str = N
 
     token = context.deps.token
     parameters = {}
-    if search_query:
-        parameters['search_query'] = search_query
     if start_time_datetime:
         parameters['maximum_start_time'] = start_time_datetime
     if end_time_datetime:
         parameters['minimum_end_time'] = end_time_datetime
+    if search_query and not parameters:
+        # without a time window the query has to narrow down the API request,
+        # within a window the events are searched locally, which also finds paraphrases
+        parameters['search_string'] = search_query
 
     try:
-        logfire.info(f"Parameters: {parameters}")
-        return fetch_google_calendar_events(token, parameters)
+        logfire.debug("Calendar event parameters: {parameters}", parameters=parameters)
+        if calendar_cache.CALENDAR_CACHE_ENABLED and 'search_string' not in parameters:
+            events = await profiling.to_thread(
+                calendar_cache.get_calendar_events,
+                token,
+                context.deps.user.id,
+                end_time_datetime,
+                start_time_datetime,
+            )
+        else:
+            events = await profiling.to_thread(fetch_google_calendar_events, token, parameters)
+        if search_query or len(events) > tool_compaction.TOOL_OUTPUT_MAX_ITEMS:
+            ranked_events = await profiling.to_thread(
+                _search_calendar_events,
+                events,
+                search_query or context.prompt,
+                search.num_event_hits if search_query else tool_compaction.TOOL_OUTPUT_MAX_ITEMS,
+            )
+            compacted = tool_compaction.compact_events(ranked_events)
+            if len(ranked_events) < len(events):
+                compacted['omitted_events'] = len(events) - len(ranked_events)
+            return compacted
+        return tool_compaction.compact_events(events)
     except Exception as e:
         return f"Failed to get calendar events: {e}"
 
 
-@agent.tool
+@agent.tool(prepare=_prepare_tool)
+@instrument_tool
+async def get_free_busy(
+        context: RunContext[MyDeps],
+        start_time: str,
+        end_time: str,
+        minimum_free_minutes: int = 0
+) -> dict | str:
+    """
+    Get when the user is busy and free across all calendars, use this to answer availability questions
+    ALWAYS USE get_offset_time TO GET THE CURRENT TIME PRIOR TO CALLING THIS FUNCTION
+
+    Args:
+        start_time (str): The start of the time window, in RFC3339 format with timezone.
+        end_time (str): The end of the time window, in RFC3339 format with timezone.
+        minimum_free_minutes (int, optional): Free slots shorter than this are left out. Defaults to 0.
+
+    Returns:
+        dict: The busy intervals and free slots within the window. Calendars listed under unavailable_calendars
+            could not be checked, tell the user that the free slots do not account for them.
+        OR
+        str: The error message
+    """
+    try:
+        start_time_datetime = datetime.fromisoformat(start_time)
+        end_time_datetime = datetime.fromisoformat(end_time)
+    except ValueError:
+        return "start_time and end_time must be in iso8601 format"
+    if start_time_datetime.tzinfo is None or end_time_datetime.tzinfo is None:
+        return "start_time and end_time must include a timezone"
+
+    def free_busy() -> dict:
+        # loading the calendar store reads from disk, so the ids are looked up in the worker thread as well
+        return fetch_google_free_busy(
+            context.deps.token,
+            start_time_datetime,
+            end_time_datetime,
+            calendar_cache.known_calendar_ids(context.deps.user.id),
+            timedelta(minutes=max(minimum_free_minutes, 0)),
+        )
+
+    try:
+        return await profiling.to_thread(free_busy)
+    except Exception as e:
+        logfire.error(f"Failed to get free/busy information: {e}")
+        return f"Failed to get free/busy information: {e}"
+
+
+@agent.tool(prepare=_prepare_tool)
+@instrument_tool
+@_records_side_effect
 async def create_calendar_event(
         context: RunContext[MyDeps],
         event_name: str,
@@ -197,7 +365,8 @@ async def create_calendar_event(
         end_time = end_time_datetime.isoformat()
 
     try:
-        created_event = create_google_calendar_event(
+        created_event = await profiling.to_thread(
+            create_google_calendar_event,
             token=token,
             event_name=event_name,
             start_time=start_time,
@@ -206,7 +375,11 @@ async def create_calendar_event(
             description=description,
             location=location,
         )
-        return created_event
+        # events are created in the managed calendar, which is the organizer of its events
+        calendar_id = created_event.get('organizer', {}).get('email')
+        if calendar_id:
+            calendar_cache.apply_created_event(context.deps.user.id, calendar_id, created_event)
+        return tool_compaction.compact_event(created_event)
     except Exception as e:
         logfire.error(f"Failed to create calendar event: {e}")
         return "Failed to create calendar event"
@@ -216,14 +389,16 @@ async def create_calendar_event(
 async def delete_calendar_event(context: RunContext[MyDeps], event_id: str) -> str:
     token = context.deps.token
     try:
-        delete_google_calendar_event(token, event_id)
+        calendar_id = await profiling.to_thread(delete_google_calendar_event, token, event_id)
+        calendar_cache.apply_deleted_event(context.deps.user.id, calendar_id, event_id)
         return f"Deleted calendar event: {event_id}"
     except Exception as e:
         logfire.error(f"Failed to delete calendar event: {e}")
         return "Failed to delete calendar event"
 
 
-@agent.tool
+@agent.tool(prepare=_prepare_tool)
+@instrument_tool
 async def get_user_recent_messages(context: RunContext[MyDeps]) -> list[dict]:
     """ Get the user's recent messages """
     user = context.deps.user
@@ -240,7 +415,37 @@ async def get_user_recent_messages(context: RunContext[MyDeps]) -> list[dict]:
             for message in recent_messages
         ]
 
-@agent.tool
+def _search_user_emails(token: str, user_id: str, search_string: str) -> list[dict]:
+    """ Internal method to fetch the emails matching the search string and rank them locally """
+    # e-mails are preprocessed as they arrive, so only their text is kept
+    preprocessed_emails = []
+    if EMAIL_SEARCH_BY_THREAD:
+        for thread in iter_emails(token, search_string, by_thread=True):
+            preprocessed_emails.extend(search.preprocess_threads([thread]))
+        bm25_index_path = user_bm25_index_path(user_id, BM25_THREAD_INDEX_FILENAME)
+        vector_index_path = user_vector_index_path(user_id, VECTOR_THREAD_INDEX_DIRECTORY)
+    else:
+        for email in iter_emails(token, search_string):
+            preprocessed_emails.extend(search.preprocess_emails([email]))
+        bm25_index_path = user_bm25_index_path(user_id)
+        vector_index_path = user_vector_index_path(user_id)
+
+    # concurrent searches of the user would overwrite each other's updates of both indexes
+    with index_lock(vector_index_path):
+        bm25_index = BM25Index.load(bm25_index_path)
+        vector_index = VectorIndex.load(vector_index_path)
+        indexed_count = len(bm25_index)
+        embedded_count = len(vector_index)
+        results = search.search(preprocessed_emails, search_string, bm25_index=bm25_index, vector_index=vector_index)
+        if len(bm25_index) != indexed_count:
+            bm25_index.save(bm25_index_path)
+        if len(vector_index) != embedded_count:
+            vector_index.save(vector_index_path)
+    return results
+
+
+@agent.tool(prepare=_prepare_tool)
+@instrument_tool
 async def get_user_emails(context: RunContext[MyDeps], search_string: str) -> list | str:
     """
     Get the user's emails using the Gmail API.
@@ -249,7 +454,7 @@ async def get_user_emails(context: RunContext[MyDeps], search_string: str) -> li
         search_string (str): The search string to filter emails.
 
     Returns:
-        list: The list of emails from the Gmail API.
+        list: The id and text of the best matching emails.
         OR
         str: The error message
     """
@@ -257,24 +462,15 @@ async def get_user_emails(context: RunContext[MyDeps], search_string: str) -> li
     if search_string is None:
         return "search_string must be provided"
     try:
-        email_list = get_emails(
-            token=token,
-            search_string=search_string
-        )
-        email_ids = [email['id'] for email in email_list['messages'] if 'id' in email]
-        emails = []
-        for email_id in email_ids:
-            email_details = get_email_details(token, email_id)
-            emails.append(email_details)
-
-        preprocessed_emails = search.preprocess_emails(emails)
-
-        return search.search(preprocessed_emails, search_string)
+        # runs in a worker thread, so the event loop keeps serving other requests meanwhile
+        results = await profiling.to_thread(_search_user_emails, token, context.deps.user.id, search_string)
+        return tool_compaction.compact_emails(results)
     except Exception as e:
         logfire.error(f"Failed to get emails: {e}")
         return "Failed to get emails"
 
-@agent.tool
+@agent.tool(prepare=_prepare_tool)
+@instrument_tool
 async def get_user_email_details(context: RunContext[MyDeps], email_id: str) -> dict | str:
     """
     Get the details of an email using the Gmail API.
@@ -283,7 +479,7 @@ async def get_user_email_details(context: RunContext[MyDeps], email_id: str) ->
         email_id (str): The ID of the email to retrieve.
 
     Returns:
-        dict: The details of the email from the Gmail API.
+        dict: The id and text of the email.
         OR
         str: The error message
     """
@@ -291,17 +487,20 @@ async def get_user_email_details(context: RunContext[MyDeps], email_id: str) ->
     if email_id is None:
         return "email_id must be provided"
     try:
-        details = get_email_details(
+        details = await profiling.to_thread(
+            get_email_details,
             token=token,
             email_id=email_id
         )
         preprocessed_details = search.preprocess_emails([details])[0] # TODO: not clean
-        return preprocessed_details
+        return tool_compaction.compact_email(preprocessed_details, tool_compaction.TOOL_OUTPUT_MAX_EMAIL_DETAILS_CHARS)
     except Exception as e:
         logfire.error(f"Failed to get email details: {e}")
         return "Failed to get email details"
 
-@agent.tool
+@agent.tool(prepare=_prepare_tool)
+@instrument_tool
+@_records_side_effect
 async def draft_user_email(
         context: RunContext[MyDeps],
         receiver: str,
@@ -317,7 +516,7 @@ async def draft_user_email(
         body (str): The body of the email.
 
     Returns:
-        dict: The draft email from the Gmail API.
+        dict: The ids of the draft.
         OR
         str: The error message
     """
@@ -325,17 +524,21 @@ async def draft_user_email(
     if receiver is None or subject is None or body is None:
         return "receiver, subject, and body must be provided"
     try:
-        return draft_email(
+        draft = await profiling.to_thread(
+            draft_email,
             token=token,
             recipient=receiver,
             subject=subject,
             body=body
         )
+        return tool_compaction.compact_draft(draft)
     except Exception as e:
         logfire.error(f"Failed to draft email: {e}")
         return "Failed to draft email"
 
-@agent.tool
+@agent.tool(prepare=_prepare_tool)
+@instrument_tool
+@_records_side_effect
 async def send_user_draft(
         context: RunContext[MyDeps],
         draft_id: str
@@ -347,7 +550,7 @@ async def send_user_draft(
         draft_id (str): The ID of the draft to send.
 
     Returns:
-        dict: The sent email from the Gmail API.
+        dict: The ids and labels of the sent email.
         OR
         str: The error message
     """
@@ -355,15 +558,18 @@ async def send_user_draft(
     if draft_id is None:
         return "draft_id must be provided"
     try:
-        return send_draft(
+        sent_message = await profiling.to_thread(
+            send_draft,
             token=token,
             draft_id=draft_id
         )
+        return tool_compaction.compact_sent_message(sent_message)
     except Exception as e:
         logfire.error(f"Failed to send draft email: {e}")
         return "Failed to send draft email"
 
-@agent.tool
+@agent.tool(prepare=_prepare_tool)
+@instrument_tool
 async def get_user_drafts(context: RunContext[MyDeps]) -> dict | str:
     """
     Get the user's email drafts using the Gmail API.
@@ -372,20 +578,24 @@ async def get_user_drafts(context: RunContext[MyDeps]) -> dict | str:
         None
 
     Returns:
-        dict: The list of drafts from the Gmail API.
+        dict: The ids of the drafts.
         OR
         str: The error message
     """
     token = context.deps.token
     try:
-        return get_drafts(
+        drafts = await profiling.to_thread(
+            get_drafts,
             token=token
         )
+        return tool_compaction.compact_drafts(drafts)
     except Exception as e:
         logfire.error(f"Failed to get drafts: {e}")
         return "Failed to get drafts"
 
-@agent.tool
+@agent.tool(prepare=_prepare_tool)
+@instrument_tool
+@_records_side_effect
 async def delete_user_draft(
         context: RunContext[MyDeps],
         draft_id: str
@@ -405,11 +615,31 @@ async def delete_user_draft(
     if draft_id is None:
         return "draft_id must be provided"
     try:
-        delete_draft(
+        await profiling.to_thread(
+            delete_draft,
             token=token,
             draft_id=draft_id
         )
         return "Draft email deleted successfully"
     except Exception as e:
         logfire.error(f"Failed to delete draft email: {e}")
-        return "Failed to delete draft email"
\ No newline at end of file
+        return "Failed to delete draft email"
+
+
+TOOL_DESCRIPTIONS = {
+    tool.__name__: tool_description(tool)
+    for tool in [
+        get_offset_time,
+        get_user_timezone,
+        get_calendar_events,
+        get_free_busy,
+        create_calendar_event,
+        get_user_recent_messages,
+        get_user_emails,
+        get_user_email_details,
+        draft_user_email,
+        send_user_draft,
+        get_user_drafts,
+        delete_user_draft,
+    ]
+}
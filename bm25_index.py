@@ -0,0 +1,216 @@
+import os
+import string
+import tempfile
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction import _stop_words
+
+from .storage import user_data_directory
+
+BM25_INDEX_FILENAME = "bm25_index.npz"
+BM25_THREAD_INDEX_FILENAME = "bm25_thread_index.npz"
+# compact the index once this fraction of its rows belongs to removed documents
+compaction_threshold = 0.5
+
+
+def bm25_tokenizer(text: str) -> list[str]:
+    """
+    Tokenize a string using the BM25 algorithm.
+    """
+    tokenized_text = []
+    for token in text.lower().split():
+        token = token.strip(string.punctuation)
+        if len(token) > 0 and token not in _stop_words.ENGLISH_STOP_WORDS:
+            tokenized_text.append(token)
+    return tokenized_text
+
+
+class BM25Index:
+    """
+    An incrementally updatable BM25 index backed by a sparse CSR term frequency matrix.
+
+    Every document is keyed by a string id. Adding documents only tokenizes the new documents,
+    removing documents marks their rows as removed until the index gets compacted.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.vocabulary: dict[str, int] = {}
+        self.document_ids: list[str | None] = []
+        self._rows: dict[str, int] = {}
+        self._data = np.zeros(0, dtype=np.float32)
+        self._indices = np.zeros(0, dtype=np.int32)
+        self._indptr = np.zeros(1, dtype=np.int64)
+        self._document_lengths = np.zeros(0, dtype=np.float32)
+        self._document_frequencies = np.zeros(0, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, document_id: str) -> bool:
+        return document_id in self._rows
+
+    @property
+    def term_frequencies(self) -> sparse.csr_matrix:
+        """ The term frequency matrix with one row per (possibly removed) document and one column per term """
+        return sparse.csr_matrix(
+            (self._data, self._indices, self._indptr),
+            shape=(len(self.document_ids), len(self.vocabulary))
+        )
+
+    def add_documents(self, documents: dict[str, str]) -> None:
+        """
+        Add documents to the index, documents that are already indexed are replaced.
+
+        Args:
+            documents (dict[str, str]): A mapping of document ids to document texts.
+        """
+        replaced_ids = [document_id for document_id in documents if document_id in self._rows]
+        if replaced_ids:
+            self.remove_documents(replaced_ids)
+
+        data = []
+        indices = []
+        indptr = []
+        lengths = []
+        offset = int(self._indptr[-1])
+        for document_id, text in documents.items():
+            term_counts: dict[int, int] = {}
+            tokens = bm25_tokenizer(text)
+            for token in tokens:
+                term_id = self.vocabulary.setdefault(token, len(self.vocabulary))
+                term_counts[term_id] = term_counts.get(term_id, 0) + 1
+            indices.extend(term_counts.keys())
+            data.extend(term_counts.values())
+            offset += len(term_counts)
+            indptr.append(offset)
+            lengths.append(len(tokens))
+            self._rows[document_id] = len(self.document_ids)
+            self.document_ids.append(document_id)
+
+        new_indices = np.asarray(indices, dtype=np.int32)
+        self._data = np.concatenate([self._data, np.asarray(data, dtype=np.float32)])
+        self._indices = np.concatenate([self._indices, new_indices])
+        self._indptr = np.concatenate([self._indptr, np.asarray(indptr, dtype=np.int64)])
+        self._document_lengths = np.concatenate([self._document_lengths, np.asarray(lengths, dtype=np.float32)])
+        self._document_frequencies = np.concatenate([
+            self._document_frequencies,
+            np.zeros(len(self.vocabulary) - len(self._document_frequencies), dtype=np.int64)
+        ])
+        np.add.at(self._document_frequencies, new_indices, 1)
+
+    def remove_documents(self, document_ids: list[str]) -> None:
+        """
+        Remove documents from the index, unknown ids are ignored.
+
+        Args:
+            document_ids (list[str]): The ids of the documents to remove.
+        """
+        for document_id in document_ids:
+            row = self._rows.pop(document_id, None)
+            if row is None:
+                continue
+            start, end = self._indptr[row], self._indptr[row + 1]
+            np.subtract.at(self._document_frequencies, self._indices[start:end], 1)
+            self._data[start:end] = 0
+            self._document_lengths[row] = 0
+            self.document_ids[row] = None
+
+        if len(self.document_ids) and 1 - len(self._rows) / len(self.document_ids) >= compaction_threshold:
+            self.compact()
+
+    def compact(self) -> None:
+        """ Drop the rows of removed documents from the term frequency matrix """
+        alive_rows = [row for row, document_id in enumerate(self.document_ids) if document_id is not None]
+        matrix = self.term_frequencies[alive_rows]
+        self._data = matrix.data.astype(np.float32)
+        self._indices = matrix.indices.astype(np.int32)
+        self._indptr = matrix.indptr.astype(np.int64)
+        self._document_lengths = self._document_lengths[alive_rows]
+        self.document_ids = [self.document_ids[row] for row in alive_rows]
+        self._rows = {document_id: row for row, document_id in enumerate(self.document_ids)}
+
+    def get_scores(self, query: str, document_ids: list[str] | None = None) -> np.ndarray:
+        """
+        Score documents against a query.
+
+        Args:
+            query (str): The search query.
+            document_ids (list[str], optional): The ids of the documents to score, in the order of the returned scores.
+                Defaults to all rows of the index, removed documents score 0.
+
+        Returns:
+            np.ndarray: The BM25 score of each document.
+        """
+        if document_ids is None:
+            rows = np.arange(len(self.document_ids))
+        else:
+            rows = np.asarray([self._rows[document_id] for document_id in document_ids], dtype=np.int64)
+
+        query_counts: dict[int, int] = {}
+        for token in bm25_tokenizer(query):
+            term_id = self.vocabulary.get(token)
+            if term_id is not None:
+                query_counts[term_id] = query_counts.get(term_id, 0) + 1
+        if not query_counts or not self._rows:
+            return np.zeros(len(rows), dtype=np.float32)
+
+        term_ids = np.fromiter(query_counts.keys(), dtype=np.int64)
+        query_weights = np.fromiter(query_counts.values(), dtype=np.float32)
+
+        document_count = len(self._rows)
+        document_frequencies = self._document_frequencies[term_ids]
+        idf = np.log1p((document_count - document_frequencies + 0.5) / (document_frequencies + 0.5))
+
+        average_length = self._document_lengths.sum() / document_count
+        lengths = self._document_lengths[rows]
+        term_frequencies = self.term_frequencies[rows][:, term_ids].toarray()
+        normalization = self.k1 * (1 - self.b + self.b * lengths / max(average_length, 1e-9))
+        saturated = term_frequencies * (self.k1 + 1) / (term_frequencies + normalization[:, None])
+        return (saturated @ (idf * query_weights)).astype(np.float32)
+
+    def save(self, path: str) -> None:
+        """ Persist the index atomically to the given path """
+        directory = os.path.dirname(path) or "."
+        with tempfile.NamedTemporaryFile(dir=directory, suffix=".npz", delete=False) as file:
+            np.savez_compressed(
+                file,
+                parameters=np.asarray([self.k1, self.b], dtype=np.float64),
+                vocabulary=np.asarray(list(self.vocabulary), dtype=np.str_),
+                document_ids=np.asarray(["" if document_id is None else document_id for document_id in self.document_ids], dtype=np.str_),
+                removed=np.asarray([document_id is None for document_id in self.document_ids], dtype=bool),
+                data=self._data,
+                indices=self._indices,
+                indptr=self._indptr,
+                document_lengths=self._document_lengths,
+                document_frequencies=self._document_frequencies,
+            )
+        os.replace(file.name, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        """ Load an index from the given path, returns an empty index if the file does not exist """
+        if not os.path.exists(path):
+            return cls()
+        with np.load(path, allow_pickle=False) as arrays:
+            k1, b = arrays["parameters"].tolist()
+            index = cls(k1=k1, b=b)
+            index.vocabulary = {term: term_id for term_id, term in enumerate(arrays["vocabulary"].tolist())}
+            index.document_ids = [
+                None if removed else document_id
+                for document_id, removed in zip(arrays["document_ids"].tolist(), arrays["removed"].tolist())
+            ]
+            index._rows = {document_id: row for row, document_id in enumerate(index.document_ids) if document_id is not None}
+            index._data = arrays["data"]
+            index._indices = arrays["indices"]
+            index._indptr = arrays["indptr"]
+            index._document_lengths = arrays["document_lengths"]
+            index._document_frequencies = arrays["document_frequencies"]
+        return index
+
+
+def user_bm25_index_path(user_id: str, filename: str = BM25_INDEX_FILENAME) -> str:
+    """ Get the path of a persisted BM25 index of a user, by default the index of single e-mails """
+    return os.path.join(user_data_directory(user_id), filename)
@@ -0,0 +1,327 @@
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import logfire
+import requests
+
+from .calendar_integration import EVENT_FIELDS, _events_fields_mask, fetch_calendar_list, fetch_google_calendar_events
+from .google_api import google_get
+from .storage import user_data_directory
+
+CALENDAR_CACHE_ENABLED = os.getenv("CALENDAR_CACHE_ENABLED", "true").lower() == "true"
+# within this interval after a sync, queries are answered locally without asking Google for changes
+CALENDAR_SYNC_INTERVAL_SECONDS = float(os.getenv("CALENDAR_SYNC_INTERVAL_SECONDS", 60))
+CALENDAR_CACHE_FILENAME = "calendar_events.json"
+# a full sync fetches the events within this window around the current time, queries outside it go to Google
+sync_past_window = timedelta(days=365)
+sync_future_window = timedelta(days=2 * 365)
+# stores without a query for this long are dropped from memory, they are persisted after every change
+store_idle_seconds = 60 * 60
+
+
+def _event_timestamp(time: dict | None) -> float | None:
+    """ Internal method to convert a calendar event time to a timestamp, all day events are taken as UTC dates """
+    if not time:
+        return None
+    if time.get('dateTime'):
+        return datetime.fromisoformat(time['dateTime'].replace('Z', '+00:00')).timestamp()
+    if time.get('date'):
+        return datetime.fromisoformat(time['date']).replace(tzinfo=timezone.utc).timestamp()
+    return None
+
+
+class EventIntervalIndex:
+    """
+    Index of event intervals for overlap queries.
+
+    Intervals are sorted by start. Since no interval is longer than the longest one,
+    all intervals overlapping a window start within the window extended by that length.
+    """
+
+    def __init__(self, intervals: list[tuple[float, float, tuple[str, str]]]):
+        intervals = sorted(intervals, key=lambda interval: interval[0])
+        self._starts = [start for start, _, _ in intervals]
+        self._ends = [end for _, end, _ in intervals]
+        self._keys = [key for _, _, key in intervals]
+        self._max_duration = max((end - start for start, end, _ in intervals), default=0.0)
+
+    def overlapping(self, minimum_end: float | None, maximum_start: float | None) -> list[tuple[str, str]]:
+        """
+        Get the keys of the intervals ending after minimum_end and starting before maximum_start.
+
+        Args:
+            minimum_end (float, optional): The exclusive lower bound of the interval ends, None for no bound.
+            maximum_start (float, optional): The exclusive upper bound of the interval starts, None for no bound.
+
+        Returns:
+            list[tuple[str, str]]: The keys of the overlapping intervals, ordered by start.
+        """
+        high = len(self._starts) if maximum_start is None else bisect.bisect_left(self._starts, maximum_start)
+        low = 0 if minimum_end is None else bisect.bisect_left(self._starts, minimum_end - self._max_duration)
+        return [
+            self._keys[idx] for idx in range(low, high)
+            if minimum_end is None or self._ends[idx] > minimum_end
+        ]
+
+
+class CalendarEventStore:
+    """
+    Local copy of the events of all calendars of a user, kept current through incremental sync.
+
+    Each calendar remembers the sync token of its last sync, so only changes are fetched from Google.
+    A full sync only fetches the events within a window around the current time, the store answers
+    queries within the windows of all calendars from an interval index over the event times.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        # calendar id -> {'sync_token': str | None, 'events': {event id: event}}
+        self.calendars: dict[str, dict] = {}
+        self.last_sync: float = 0.0
+        self.last_used: float = time.monotonic()
+        self._index: EventIntervalIndex | None = None
+
+    @classmethod
+    def load(cls, path: str) -> "CalendarEventStore":
+        """ Load a store from the given path, returns an empty store if the file does not exist """
+        store = cls(path)
+        if os.path.exists(path):
+            with open(path) as file:
+                store.calendars = json.load(file)['calendars']
+        return store
+
+    def save(self) -> None:
+        """ Persist the store atomically """
+        directory = os.path.dirname(self.path) or "."
+        with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".json", delete=False) as file:
+            json.dump({'calendars': self.calendars}, file)
+        os.replace(file.name, self.path)
+
+    def _calendar(self, calendar_id: str) -> dict:
+        # window is the [start, end] timestamps of the last full sync, None until a full sync succeeded
+        return self.calendars.setdefault(calendar_id, {'sync_token': None, 'window': None, 'events': {}})
+
+    def apply_event(self, calendar_id: str, event: dict) -> None:
+        """ Insert, update or, if it is cancelled, remove an event """
+        events = self._calendar(calendar_id)['events']
+        if event.get('status') == 'cancelled':
+            events.pop(event['id'], None)
+        else:
+            events[event['id']] = {field: event.get(field) for field in EVENT_FIELDS}
+        self._index = None
+
+    def remove_event(self, calendar_id: str, event_id: str) -> None:
+        """ Remove an event, e.g. after it was deleted """
+        self._calendar(calendar_id)['events'].pop(event_id, None)
+        self._index = None
+
+    def _sync_calendar(self, token: str, calendar_id: str) -> None:
+        """ Internal method to fetch the changes of a calendar since its last sync, or all events on the first sync """
+        calendar = self._calendar(calendar_id)
+        params = {
+            'singleEvents': True,
+            'showDeleted': True,
+            'fields': _events_fields_mask(EVENT_FIELDS + ['status']) + ',nextSyncToken',
+        }
+        now = datetime.now(timezone.utc)
+        window = calendar.get('window')
+        if not window or window[1] < (now + sync_future_window / 2).timestamp():
+            # no full sync succeeded yet, or the window moved on with time: start over around the current time
+            calendar['sync_token'] = None
+        if calendar['sync_token']:
+            params['syncToken'] = calendar['sync_token']
+        else:
+            calendar['events'] = {}
+            calendar['window'] = None
+            window = [(now - sync_past_window).timestamp(), (now + sync_future_window).timestamp()]
+            # changes reported by later incremental syncs are not bound to the window
+            params['timeMin'] = (now - sync_past_window).isoformat()
+            params['timeMax'] = (now + sync_future_window).isoformat()
+
+        changes = 0
+        while True:
+            try:
+                response = google_get(
+                    token,
+                    f'https://www.googleapis.com/calendar/v3/calendars/{calendar_id}/events',
+                    params,
+                )
+            except requests.exceptions.HTTPError as error:
+                if error.response is not None and error.response.status_code == 410 and 'syncToken' in params:
+                    # the sync token expired, start over with a full sync
+                    logfire.info("Sync token of calendar {calendar_id} expired, syncing fully", calendar_id=calendar_id)
+                    calendar['sync_token'] = None
+                    return self._sync_calendar(token, calendar_id)
+                raise
+            for event in response.get('items', []):
+                self.apply_event(calendar_id, event)
+                changes += 1
+            if 'nextPageToken' not in response:
+                calendar['sync_token'] = response.get('nextSyncToken')
+                if 'syncToken' not in params:
+                    calendar['window'] = window
+                break
+            params = {**params, 'pageToken': response['nextPageToken']}
+        logfire.debug("Synced {changes} event changes of calendar {calendar_id}", changes=changes, calendar_id=calendar_id)
+
+    def sync(self, token: str) -> bool:
+        """
+        Fetch the changes of all calendars of the user, calendars the user no longer has are dropped.
+
+        Returns:
+            bool: Whether all calendars were synced, only then the store counts as synced.
+        """
+        with logfire.span("Syncing calendar events"):
+            calendar_ids = [calendar['id'] for calendar in fetch_calendar_list(token)]
+            for calendar_id in set(self.calendars) - set(calendar_ids):
+                del self.calendars[calendar_id]
+                self._index = None
+            synced = True
+            for calendar_id in calendar_ids:
+                try:
+                    self._sync_calendar(token, calendar_id)
+                except Exception as error:
+                    synced = False
+                    logfire.exception(
+                        "Failed to sync calendar {calendar_id}: {error}", calendar_id=calendar_id, error=str(error)
+                    )
+            if synced:
+                self.last_sync = time.monotonic()
+            self.save()
+            return synced
+
+    def covers(self, minimum_end_time: datetime | None, maximum_start_time: datetime | None) -> bool:
+        """
+        Check if the store can answer a query, i.e. its bounds are within the window of every calendar.
+
+        An open bound is cut off at the window, so events far beyond the window are not returned for it.
+        """
+        if minimum_end_time is None and maximum_start_time is None:
+            return False
+        bounds = [time.timestamp() for time in (minimum_end_time, maximum_start_time) if time is not None]
+        return all(
+            calendar.get('window') and all(calendar['window'][0] <= bound <= calendar['window'][1] for bound in bounds)
+            for calendar in self.calendars.values()
+        )
+
+    def _get_index(self) -> EventIntervalIndex:
+        if self._index is None:
+            intervals = []
+            for calendar_id, calendar in self.calendars.items():
+                for event_id, event in calendar['events'].items():
+                    start = _event_timestamp(event.get('start'))
+                    end = _event_timestamp(event.get('end'))
+                    if start is not None and end is not None:
+                        intervals.append((start, end, (calendar_id, event_id)))
+            self._index = EventIntervalIndex(intervals)
+        return self._index
+
+    def events_between(self, minimum_end_time: datetime | None, maximum_start_time: datetime | None) -> list[dict]:
+        """ Get the stored events ending after minimum_end_time and starting before maximum_start_time """
+        keys = self._get_index().overlapping(
+            minimum_end_time.timestamp() if minimum_end_time else None,
+            maximum_start_time.timestamp() if maximum_start_time else None,
+        )
+        return [self.calendars[calendar_id]['events'][event_id] for calendar_id, event_id in keys]
+
+
+_stores: dict[str, CalendarEventStore] = {}
+_stores_lock = threading.Lock()
+
+
+def _get_store(user_id: str) -> CalendarEventStore:
+    """ Internal method to get the event store of a user, loading it from disk on first use """
+    now = time.monotonic()
+    with _stores_lock:
+        for idle_user_id in [
+            other_user_id for other_user_id, other_store in _stores.items()
+            if now - other_store.last_used > store_idle_seconds and not other_store.lock.locked()
+        ]:
+            del _stores[idle_user_id]
+        store = _stores.get(user_id)
+        if store is None:
+            store = CalendarEventStore.load(os.path.join(user_data_directory(user_id), CALENDAR_CACHE_FILENAME))
+            _stores[user_id] = store
+        store.last_used = now
+        return store
+
+
+def get_calendar_events(
+        token: str,
+        user_id: str,
+        minimum_end_time: datetime | None = None,
+        maximum_start_time: datetime | None = None
+) -> list[dict]:
+    """
+    Get the events of all calendars of a user within a time window from the local store.
+
+    The store is synced with Google first, unless it was synced within CALENDAR_SYNC_INTERVAL_SECONDS.
+    If the sync failed or the window is not covered by the store, the events are fetched from Google directly.
+
+    Args:
+        token (str): The user's Google API token.
+        user_id (str): The id of the user.
+        minimum_end_time (datetime, optional): Only events ending after this time are returned.
+        maximum_start_time (datetime, optional): Only events starting before this time are returned.
+
+    Returns:
+        list[dict]: The events, ordered by start time, with the fields in EVENT_FIELDS.
+    """
+    store = _get_store(user_id)
+    with store.lock:
+        synced = True
+        if time.monotonic() - store.last_sync > CALENDAR_SYNC_INTERVAL_SECONDS or not store.last_sync:
+            synced = store.sync(token)
+        if synced and store.covers(minimum_end_time, maximum_start_time):
+            events = store.events_between(minimum_end_time, maximum_start_time)
+            logfire.info("Found {count} events in the local calendar store", count=len(events))
+            return events
+
+    logfire.info("Local calendar store can not answer the query, fetching from Google", synced=synced)
+    parameters = {}
+    if minimum_end_time is not None:
+        parameters['minimum_end_time'] = minimum_end_time
+    if maximum_start_time is not None:
+        parameters['maximum_start_time'] = maximum_start_time
+    return fetch_google_calendar_events(token, parameters)
+
+
+def known_calendar_ids(user_id: str) -> list[str] | None:
+    """
+    Get the ids of the user's calendars as of the last sync.
+
+    Does not wait for a sync in progress, returns None instead, as it does if the calendars are not known yet.
+    """
+    store = _get_store(user_id)
+    if not store.lock.acquire(blocking=False):
+        return None
+    try:
+        return list(store.calendars) or None
+    finally:
+        store.lock.release()
+
+
+def apply_created_event(user_id: str, calendar_id: str, event: dict) -> None:
+    """ Add an event created by the user to the local store right away, before the next sync """
+    store = _get_store(user_id)
+    with store.lock:
+        if event.get('recurrence'):
+            # the store holds single instances, which only the next sync expands the recurring event into
+            store.last_sync = 0.0
+            return
+        store.apply_event(calendar_id, event)
+        store.save()
+
+
+def apply_deleted_event(user_id: str, calendar_id: str, event_id: str) -> None:
+    """ Remove an event deleted by the user from the local store right away, before the next sync """
+    store = _get_store(user_id)
+    with store.lock:
+        store.remove_event(calendar_id, event_id)
+        store.save()
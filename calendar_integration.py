@@ -1,12 +1,48 @@
 import json
 import urllib.parse
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import logfire
 import requests
 
+from .google_api import google_get, google_request
+from .log_policy import log_payload
 
-def fetch_google_calendar_events(token: str, parameters: dict):
+# partial response masks, see https://developers.google.com/calendar/api/guides/performance#partial
+CALENDAR_LIST_FIELDS = 'items(id,summary),nextPageToken'
+EVENT_FIELDS = ['id', 'summary', 'description', 'start', 'end', 'attendees', 'location', 'recurrence']
+_EVENT_FIELD_MASKS = {
+    'attendees': 'attendees(email,displayName,responseStatus)',
+}
+
+
+def _events_fields_mask(fields: list[str]) -> str:
+    """ Internal method to build the partial response mask of an events list request """
+    event_masks = ','.join(_EVENT_FIELD_MASKS.get(field, field) for field in fields)
+    return f'items({event_masks}),nextPageToken'
+
+
+def _get_all_items(token: str, url: str, params: dict) -> list[dict]:
+    """ Internal method to get the items of a list request, following nextPageToken over all pages """
+    items = []
+    while True:
+        page = google_get(token, url, params)
+        items.extend(page.get('items', []))
+        if not page.get('nextPageToken'):
+            return items
+        params = {**params, 'pageToken': page['nextPageToken']}
+
+
+def fetch_calendar_list(token: str) -> list[dict]:
+    """ Get the id and summary of all calendars of the user """
+    return _get_all_items(
+        token,
+        'https://www.googleapis.com/calendar/v3/users/me/calendarList',
+        {'fields': CALENDAR_LIST_FIELDS},
+    )
+
+
+def fetch_google_calendar_events(token: str, parameters: dict, fields: list[str] | None = None):
     """
         Fetch all events from all calendars of the user with the given token and at least one of the given parameters.
 
@@ -16,7 +52,10 @@ def fetch_google_calendar_events(token: str, parameters: dict):
                 search_string: A string to filter events by.
                 minimum_end_time: A datetime object representing the minimum end time of events to fetch.
                 maximum_start_time: A datetime object representing the maximum start time of events to fetch.
+            fields: The event fields to fetch and return, only these are requested from the API.
+                Defaults to EVENT_FIELDS.
     """
+    fields = fields or EVENT_FIELDS
     search_string = parameters.get('search_string', '')
     minimum_end_time = parameters.get('minimum_end_time', None)
     maximum_start_time = parameters.get('maximum_start_time', None)
@@ -34,22 +73,14 @@ def fetch_google_calendar_events(token: str, parameters: dict):
                 raise ValueError("maximum_start_time must be a datetime object.")
             if maximum_start_time.tzinfo is None:
                 raise ValueError("maximum_start_time must be timezone-aware datetime object.")
-        params: dict[str, str | bool] = {'singleEvents': True}
+        params: dict[str, str | bool] = {'singleEvents': True, 'fields': _events_fields_mask(fields)}
         if search_string:
             params['q'] = search_string
         if minimum_end_time:
-            params['timeMin'] = maximum_start_time.isoformat()
+            params['timeMin'] = minimum_end_time.isoformat()
         if maximum_start_time:
-            params['timeMax'] = minimum_end_time.isoformat()
-        headers = {
-            'Authorization': f'Bearer {token}',
-        }
-        calendars_response = requests.get(
-            'https://www.googleapis.com/calendar/v3/users/me/calendarList',
-            headers=headers,
-        )
-        calendars_response.raise_for_status()
-        calendars = calendars_response.json()['items']
+            params['timeMax'] = maximum_start_time.isoformat()
+        calendars = fetch_calendar_list(token)
 
         calendar_ids = [calendar['id'] for calendar in calendars]
         calendar_ids.append("primary")  # Include primary calendar
@@ -58,41 +89,149 @@ def fetch_google_calendar_events(token: str, parameters: dict):
         with logfire.span("Fetching events from all calendars"):
             for calendar_id in calendar_ids:
                 try:
-                    events_response = requests.get(
+                    calendar_events = _get_all_items(
+                        token,
                         f'https://www.googleapis.com/calendar/v3/calendars/{calendar_id}/events',
-                        headers=headers,
-                        params=params,
+                        params,
+                    )
+                    logfire.debug(
+                        "Fetched {count} events from calendar {calendar_id}",
+                        count=len(calendar_events),
+                        calendar_id=calendar_id,
                     )
-                    events_response.raise_for_status()
-                    logfire.info(f"Fetched events from calendar {calendar_id}")
-                    items = events_response.json()
-                    logfire.info(f"Got {items}")
-                    logfire.info(f"Got items data: {items}")
-                    events.extend(items.get('items', []))
+                    log_payload("Calendar events of {calendar_id}", calendar_events, calendar_id=calendar_id)
+                    events.extend(calendar_events)
                 except Exception as error:
                     # TODO: Handle specific exceptions, ?maybe wrap in logfire.span logfire.instrument?
-                    logfire.exception(f"Failed to fetch events from calendar {calendar_id}: {error}")
-        logfire.info(f"Fetched {len(events)} events from all calendars.")
+                    logfire.exception("Failed to fetch events from calendar {calendar_id}: {error}", calendar_id=calendar_id, error=str(error))
+        logfire.info("Fetched {count} events from all calendars.", count=len(events))
 
         return_events = []
         for event in events:
-            return_events.append({
-                'id': event.get('id'),
-                'summary': event.get('summary'),
-                'description': event.get('description'),
-                'start': event.get('start'),
-                'end': event.get('end'),
-                'attendees': event.get('attendees'),
-                'location': event.get('location'),
-                'recurrence': event.get('recurrence'),
-            })
-        with logfire.span(f"Returning {len(return_events)} events."):
-            for event in return_events:
-                logfire.info(f"Event ID: {event['id']}, Summary: {event['summary']}, Start: {event['start']}, End: {event['end']}")
+            return_events.append({field: event.get(field) for field in fields})
+        log_payload("Returning {count} events", return_events, count=len(return_events))
 
         return return_events
 
 
+# the freeBusy endpoint accepts at most this many calendars per request
+FREE_BUSY_MAX_CALENDARS = 50
+
+
+def _merge_intervals(intervals: list[tuple[datetime, datetime]]) -> list[tuple[datetime, datetime]]:
+    """ Internal method to merge overlapping and adjacent intervals """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _format_intervals(intervals: list[tuple[datetime, datetime]], timezone) -> list[dict]:
+    """ Internal method to format intervals as start and end times in the given timezone """
+    return [
+        {'start': start.astimezone(timezone).isoformat(), 'end': end.astimezone(timezone).isoformat()}
+        for start, end in intervals
+    ]
+
+
+def fetch_google_free_busy(
+        token: str,
+        time_min: datetime,
+        time_max: datetime,
+        calendar_ids: list[str] | None = None,
+        minimum_free_duration: timedelta = timedelta(0)
+) -> dict:
+    """
+    Get the busy and free times of the user across all calendars within a time window.
+
+    The busy intervals of all calendars are merged, the free slots are the gaps between them.
+
+    Parameters:
+        token: The user's Google API token.
+        time_min: The timezone-aware start of the window.
+        time_max: The timezone-aware end of the window.
+        calendar_ids: The calendars to check. Defaults to all calendars of the user.
+        minimum_free_duration: Free slots shorter than this are left out.
+
+    Returns:
+        A dictionary with the merged busy intervals and the free slots, as lists of start and end times
+        in the timezone of time_min. Calendars whose free/busy information is unavailable are listed
+        under "unavailable_calendars", their events are missing from the busy intervals.
+
+    Raises:
+        RuntimeError: If the free/busy information of no calendar is available.
+    """
+    if time_min.tzinfo is None or time_max.tzinfo is None:
+        raise ValueError("time_min and time_max must be timezone-aware datetime objects.")
+    if time_min >= time_max:
+        raise ValueError("time_min must be before time_max.")
+
+    with logfire.span("Fetching free/busy information"):
+        if calendar_ids is None:
+            calendar_ids = [calendar['id'] for calendar in fetch_calendar_list(token)]
+
+        busy = []
+        unavailable = {}
+        for offset in range(0, len(calendar_ids), FREE_BUSY_MAX_CALENDARS):
+            response = google_request(
+                'POST',
+                token,
+                'https://www.googleapis.com/calendar/v3/freeBusy',
+                params={'fields': 'calendars'},
+                json={
+                    'timeMin': time_min.isoformat(),
+                    'timeMax': time_max.isoformat(),
+                    'items': [
+                        {'id': calendar_id}
+                        for calendar_id in calendar_ids[offset:offset + FREE_BUSY_MAX_CALENDARS]
+                    ],
+                },
+            ).json()
+            for calendar_id, calendar in response.get('calendars', {}).items():
+                if calendar.get('errors'):
+                    logfire.warn(
+                        "Free/busy information of calendar {calendar_id} is unavailable: {errors}",
+                        calendar_id=calendar_id,
+                        errors=calendar['errors'],
+                    )
+                    unavailable[calendar_id] = [error.get('reason') for error in calendar['errors']]
+                    continue
+                for interval in calendar.get('busy', []):
+                    busy.append((
+                        datetime.fromisoformat(interval['start'].replace('Z', '+00:00')),
+                        datetime.fromisoformat(interval['end'].replace('Z', '+00:00')),
+                    ))
+
+        if calendar_ids and len(unavailable) == len(calendar_ids):
+            raise RuntimeError(f"Free/busy information of all calendars is unavailable: {unavailable}")
+
+        busy = [
+            (max(start, time_min), min(end, time_max))
+            for start, end in _merge_intervals(busy)
+            if start < time_max and end > time_min
+        ]
+        free = []
+        free_start = time_min
+        for start, end in busy + [(time_max, time_max)]:
+            if start > free_start and start - free_start >= minimum_free_duration:
+                free.append((free_start, start))
+            free_start = max(free_start, end)
+        logfire.info("Found {busy} busy intervals and {free} free slots", busy=len(busy), free=len(free))
+
+        free_busy = {
+            'busy': _format_intervals(busy, time_min.tzinfo),
+            'free': _format_intervals(free, time_min.tzinfo),
+        }
+        if unavailable:
+            free_busy['unavailable_calendars'] = [
+                {'calendar_id': calendar_id, 'reasons': reasons} for calendar_id, reasons in unavailable.items()
+            ]
+        return free_busy
+
+
 # events_response = requests.get(
 #                 f'https://www.googleapis.com/calendar/v3/calendars/{calendar_id}/events?timeMin={datetime.now().isoformat()}Z',
 #                 headers=headers,
@@ -101,17 +240,8 @@ def fetch_google_calendar_events(token: str, parameters: dict):
 
 def _get_managed_calendar(token: str):
     """ Internal method to get the managed calendar """
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
-
     # Get list of calendars
-    calendars_response = requests.get(
-        'https://www.googleapis.com/calendar/v3/users/me/calendarList',
-        headers=headers,
-    )
-    calendars_response.raise_for_status()
-    calendars = calendars_response.json()['items']
+    calendars = fetch_calendar_list(token)
 
     # Find or create AI Managed Calendar
     try:
@@ -123,22 +253,18 @@ def _get_managed_calendar(token: str):
 
 def create_google_calendar_event(token: str, event_name: str, start_time: str, end_time: str, recurrence: list = None, description: str = None, location: str = None):
     """ Create a Google Calendar event with the given parameters and return the created event data. """
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
-
     try:
         ai_managed_calendar = _get_managed_calendar(token)
 
         if ai_managed_calendar is None:
-            calendar_create_response = requests.post(
+            calendar_create_response = google_request(
+                'POST',
+                token,
                 'https://www.googleapis.com/calendar/v3/calendars',
-                headers=headers,
                 json={
                     'summary': 'AI Managed Calendar',
                 },
             )
-            calendar_create_response.raise_for_status()
             ai_managed_calendar = calendar_create_response.json()
 
         # Prepare event data
@@ -159,12 +285,12 @@ def create_google_calendar_event(token: str, event_name: str, start_time: str, e
             event_data['recurrence'] = recurrence if isinstance(recurrence, list) else [recurrence]
 
         # Create event
-        event_response = requests.post(
+        event_response = google_request(
+            'POST',
+            token,
             f'https://www.googleapis.com/calendar/v3/calendars/{ai_managed_calendar["id"]}/events',
-            headers=headers,
             json=event_data,
         )
-        event_response.raise_for_status()
         return event_response.json()
 
     except requests.exceptions.HTTPError as e:
@@ -175,14 +301,13 @@ def create_google_calendar_event(token: str, event_name: str, start_time: str, e
         raise
 
 
-def delete_google_calendar_event(token: str, event_id: str):
-    """ Delete a Google Calendar event. """
-    headers = {
-        'Authorization': f'Bearer {token}'
-    }
-    delete_response = requests.delete(
-        f'https://www.googleapis.com/calendar/v3/calendars/{_get_managed_calendar(token)["id"]}/events/{event_id}',
-        headers=headers,
+def delete_google_calendar_event(token: str, event_id: str) -> str:
+    """ Delete a Google Calendar event of the managed calendar and return the id of the calendar. """
+    calendar_id = _get_managed_calendar(token)["id"]
+    # the response of a deletion has no body
+    google_request(
+        'DELETE',
+        token,
+        f'https://www.googleapis.com/calendar/v3/calendars/{calendar_id}/events/{event_id}',
     )
-    delete_response.raise_for_status()
-    return delete_response.json()
\ No newline at end of file
+    return calendar_id
\ No newline at end of file
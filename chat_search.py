@@ -0,0 +1,98 @@
+import base64
+import binascii
+import math
+
+from sqlalchemy import REAL, cast, func, tuple_
+from sqlmodel import Session, select
+from sqlmodel.sql.expression import Select
+
+from .models.chat_message import CHAT_MESSAGE_SEARCH_CONFIG, ChatMessage
+
+CHAT_SEARCH_MAX_PAGE_SIZE = 100
+# only the newest matches are ranked, so a broad query does not rank every message of a long history on every page
+chat_search_max_ranked = 1000
+
+
+def encode_cursor(rank: float, message_id: int) -> str:
+    """ Encode the position after a search result as an opaque cursor """
+    return base64.urlsafe_b64encode(f"{rank!r}:{message_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[float, int]:
+    """
+    Decode a cursor of encode_cursor.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        rank, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+        rank, message_id = float(rank), int(message_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as error:
+        raise ValueError("Invalid cursor") from error
+    # a NaN rank would never compare lower and silently end the results
+    if not math.isfinite(rank):
+        raise ValueError("Invalid cursor")
+    return rank, message_id
+
+
+def _search_statement(user_id: str, query: str, limit: int, cursor: str | None = None) -> Select:
+    """ Internal method to build the query of a search page, one row more than the limit """
+    ts_query = func.websearch_to_tsquery(CHAT_MESSAGE_SEARCH_CONFIG, query)
+    # the matches are found through the GIN index without ranking them, only the newest get ranked
+    newest_matches = (
+        select(ChatMessage.id)
+        .where(ChatMessage.user_id == user_id)
+        .where(ChatMessage.message_search.bool_op('@@')(ts_query))
+        .order_by(ChatMessage.id.desc())
+        .limit(chat_search_max_ranked)
+    )
+    rank = func.ts_rank(ChatMessage.message_search, ts_query)
+    statement = (
+        select(ChatMessage.id, ChatMessage.message, ChatMessage.sender, ChatMessage.send_time, rank.label('rank'))
+        .where(ChatMessage.id.in_(newest_matches))
+    )
+    if cursor is not None:
+        after_rank, after_id = decode_cursor(cursor)
+        # ts_rank returns a real, compare as real so the rank of the last result matches itself exactly
+        statement = statement.where(tuple_(rank, ChatMessage.id) < tuple_(cast(after_rank, REAL), after_id))
+    # one extra row tells if there is a next page
+    return statement.order_by(rank.desc(), ChatMessage.id.desc()).limit(limit + 1)
+
+
+def search_chat_messages(
+        db_session: Session,
+        user_id: str,
+        query: str,
+        limit: int = 20,
+        cursor: str | None = None
+) -> dict:
+    """
+    Full text search over the chat history of a user, best matches first.
+
+    The query uses web search syntax: quoted phrases, "or" and "-" to exclude words.
+    Results are paged by keyset on (rank, id), so a page costs the same wherever it is in the results.
+    Only the newest chat_search_max_ranked matches are ranked, which bounds the cost of a page.
+
+    Args:
+        db_session (Session): The database session.
+        user_id (str): The id of the user.
+        query (str): The search query.
+        limit (int): The maximum number of results of the page.
+        cursor (str, optional): The next_cursor of the previous page, None for the first page.
+
+    Returns:
+        dict: The results with their rank and the cursor of the next page, None if this is the last page.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    rows = db_session.exec(_search_statement(user_id, query, limit, cursor)).all()
+    page = rows[:limit]
+    return {
+        'results': [
+            {'id': row.id, 'message': row.message, 'sender': row.sender, 'send_time': row.send_time, 'rank': row.rank}
+            for row in page
+        ],
+        'next_cursor': encode_cursor(page[-1].rank, page[-1].id) if len(rows) > limit else None,
+    }
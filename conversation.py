@@ -0,0 +1,170 @@
+import os
+from datetime import datetime
+
+import logfire
+from pydantic_ai import Agent
+from pydantic_ai.messages import ModelMessage, ModelRequest, ModelResponse, SystemPromptPart, TextPart, UserPromptPart
+from sqlmodel import Session, select
+
+from . import profiling
+from .database import engine
+from .models.chat_message import ChatMessage
+from .models.conversation_summary import ConversationSummary
+
+CONVERSATION_CONTEXT_ENABLED = os.getenv("CONVERSATION_CONTEXT_ENABLED", "true").lower() == "true"
+# compaction keeps this many of the most recent messages out of the summary,
+# the agent sees every message that is not summarized yet as it is
+CONVERSATION_RECENT_MESSAGES = int(os.getenv("CONVERSATION_RECENT_MESSAGES", 6))
+# older messages are folded into the summary once there are at least this many of them
+CONVERSATION_COMPACTION_BATCH = int(os.getenv("CONVERSATION_COMPACTION_BATCH", 10))
+# the history is cut off here, which only happens if compaction keeps failing
+_max_unsummarized_messages = CONVERSATION_RECENT_MESSAGES + 2 * CONVERSATION_COMPACTION_BATCH
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "openai:gpt-4o-mini")
+summary_max_words = 250
+
+summary_agent = Agent(
+    SUMMARY_MODEL,
+    system_prompt=(
+        'You maintain the running summary of a conversation between a user and their AI assistant.\n'
+        'Merge the new messages into the previous summary.\n'
+        'Keep facts, decisions, names, dates and open requests that later messages may refer to, '
+        'drop small talk and details that were only relevant at the time.\n'
+        f'Answer with the updated summary only, in at most {summary_max_words} words.\n'
+    ),
+)
+
+# users whose conversation is being compacted, compaction runs on the event loop so no lock is needed
+_compacting_users: set[str] = set()
+
+
+def _message_text(message: ChatMessage) -> str:
+    return f"{message.sender}: {message.message}"
+
+
+def conversation_history(user_id: str, system_prompt: str) -> list[ModelMessage]:
+    """
+    Build the message history of the next agent run: the summary of the conversation and every message after it.
+
+    Messages wait for compaction until a batch is complete, so these are between CONVERSATION_RECENT_MESSAGES
+    and about CONVERSATION_RECENT_MESSAGES + CONVERSATION_COMPACTION_BATCH messages.
+    The oldest of them are only left out if compaction keeps failing.
+    The agent does not add its system prompt to a run with history, so the history starts with it.
+
+    Args:
+        user_id (str): The id of the user.
+        system_prompt (str): The system prompt of the agent.
+
+    Returns:
+        list[ModelMessage]: The message history, empty if the conversation is empty or context is disabled.
+    """
+    if not CONVERSATION_CONTEXT_ENABLED:
+        return []
+    with Session(engine) as db_session:
+        summary = db_session.get(ConversationSummary, user_id)
+        statement = select(ChatMessage).where(ChatMessage.user_id == user_id)
+        if summary is not None:
+            statement = statement.where(ChatMessage.id > summary.summarized_until_message_id)
+        # ids grow with every message, the send_time default is not reliable for ordering
+        recent_messages = list(reversed(db_session.exec(
+            statement.order_by(ChatMessage.id.desc()).limit(_max_unsummarized_messages)
+        ).all()))
+    if len(recent_messages) == _max_unsummarized_messages:
+        logfire.warn("Conversation compaction is behind, the oldest unsummarized messages may be left out")
+
+    if summary is None and not recent_messages:
+        return []
+    system_parts = [SystemPromptPart(content=system_prompt)]
+    if summary is not None:
+        system_parts.append(SystemPromptPart(content=f"Summary of the earlier conversation:\n{summary.summary}"))
+    history: list[ModelMessage] = [ModelRequest(parts=system_parts)]
+    for message in recent_messages:
+        if message.sender == 'user':
+            history.append(ModelRequest(parts=[UserPromptPart(content=message.message)]))
+        else:
+            history.append(ModelResponse(parts=[TextPart(content=message.message)]))
+    return history
+
+
+def _unsummarized_messages(user_id: str) -> tuple[ConversationSummary | None, list[ChatMessage]]:
+    """ Internal method to get the summary of a user and the messages after it, oldest first """
+    with Session(engine) as db_session:
+        summary = db_session.get(ConversationSummary, user_id)
+        statement = select(ChatMessage).where(ChatMessage.user_id == user_id)
+        if summary is not None:
+            statement = statement.where(ChatMessage.id > summary.summarized_until_message_id)
+        return summary, list(db_session.exec(statement.order_by(ChatMessage.id)).all())
+
+
+def _save_summary(user_id: str, summary_text: str, previous_until_message_id: int | None, until_message_id: int) -> bool:
+    """
+    Internal method to store the new summary of a user, unless the conversation changed while it was written.
+
+    Returns:
+        bool: Whether the summary was stored, not if the summary or the summarized messages are gone,
+            e.g. because the chat was cleared.
+    """
+    with Session(engine) as db_session:
+        summary = db_session.get(ConversationSummary, user_id)
+        current_until_message_id = summary.summarized_until_message_id if summary is not None else None
+        last_message = db_session.get(ChatMessage, until_message_id)
+        if current_until_message_id != previous_until_message_id or last_message is None or last_message.user_id != user_id:
+            return False
+        if summary is None:
+            summary = ConversationSummary(
+                user_id=user_id,
+                summary='',
+                summarized_until_message_id=0,
+                updated_at=datetime.now(),
+            )
+        summary.summary = summary_text
+        summary.summarized_until_message_id = until_message_id
+        summary.updated_at = datetime.now()
+        db_session.add(summary)
+        db_session.commit()
+        return True
+
+
+async def compact_conversation(user_id: str) -> None:
+    """
+    Fold the messages before the most recent ones into the user's conversation summary.
+
+    Nothing happens until at least CONVERSATION_COMPACTION_BATCH messages are waiting to be summarized,
+    so the summary model runs once per batch and not on every turn. Run this in the background.
+    The new summary is dropped if the chat was cleared while it was written.
+
+    Args:
+        user_id (str): The id of the user.
+    """
+    if not CONVERSATION_CONTEXT_ENABLED or user_id in _compacting_users:
+        return
+    _compacting_users.add(user_id)
+    try:
+        summary, unsummarized = await profiling.to_thread(_unsummarized_messages, user_id)
+        to_summarize = unsummarized[:max(len(unsummarized) - CONVERSATION_RECENT_MESSAGES, 0)]
+        if len(to_summarize) < CONVERSATION_COMPACTION_BATCH:
+            return
+
+        with logfire.span("Compacting conversation", messages=len(to_summarize)):
+            transcript = '\n'.join(_message_text(message) for message in to_summarize)
+            previous_summary = summary.summary if summary is not None else ''
+            result = await summary_agent.run(
+                f"Previous summary:\n{previous_summary or '(none)'}\n\nNew messages:\n{transcript}"
+            )
+            saved = await profiling.to_thread(
+                _save_summary,
+                user_id,
+                result.data,
+                summary.summarized_until_message_id if summary is not None else None,
+                to_summarize[-1].id,
+            )
+            if not saved:
+                logfire.info("Conversation changed during compaction, dropping the summary")
+    finally:
+        _compacting_users.discard(user_id)
+
+
+def clear_conversation_summary(db_session: Session, user_id: str) -> None:
+    """ Delete the conversation summary of a user, e.g. when the chat is cleared. The caller commits """
+    summary = db_session.get(ConversationSummary, user_id)
+    if summary is not None:
+        db_session.delete(summary)
@@ -2,10 +2,14 @@ import os
 
 from sqlmodel import SQLModel, create_engine
 
+from .metrics import instrument_engine
+
 
 if os.getenv("DATABASE_URL") is None:
     raise ValueError("DATABASE_URL must be set")
 
 database_url = os.getenv("DATABASE_URL")
 
-engine = create_engine(database_url, echo=True)
\ No newline at end of file
+# echoing every statement is expensive with real data, enable it for debugging only
+engine = create_engine(database_url, echo=os.getenv("SQL_ECHO", "false").lower() == "true")
+instrument_engine(engine)
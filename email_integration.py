@@ -1,8 +1,34 @@
 import base64
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed
 from email.message import EmailMessage
+from typing import Iterator
 
+import logfire
 import requests
 
+from .google_api import google_get, google_request
+
+# partial response masks, see https://developers.google.com/gmail/api/guides/performance#partial
+_BODY_PART_FIELDS = 'mimeType,filename,body/data'
+EMAIL_BODY_FIELDS = (
+    f'id,threadId,snippet,'
+    f'payload({_BODY_PART_FIELDS},headers,parts({_BODY_PART_FIELDS},parts({_BODY_PART_FIELDS},parts)))'
+)
+EMAIL_LIST_FIELDS = 'messages(id,threadId),nextPageToken,resultSizeEstimate'
+THREAD_LIST_FIELDS = 'threads(id),nextPageToken'
+THREAD_FIELDS = f'id,messages({EMAIL_BODY_FIELDS})'
+DRAFT_LIST_FIELDS = 'drafts(id,message(id,threadId)),nextPageToken'
+
+EMAIL_LIST_PAGE_SIZE = int(os.getenv("EMAIL_LIST_PAGE_SIZE", 25))
+# a search stops fetching e-mails once it has this many candidates or ran out of time
+EMAIL_SEARCH_MAX_CANDIDATES = int(os.getenv("EMAIL_SEARCH_MAX_CANDIDATES", 50))
+EMAIL_SEARCH_TIME_BUDGET_SECONDS = float(os.getenv("EMAIL_SEARCH_TIME_BUDGET_SECONDS", 10))
+# e-mails of a page are fetched concurrently, the rate limiter keeps them within the quota
+email_fetch_workers = 4
+# search whole threads instead of single e-mails, quoted replies are only indexed once
+EMAIL_SEARCH_BY_THREAD = os.getenv("EMAIL_SEARCH_BY_THREAD", "false").lower() == "true"
 
 def draft_email(token: str, recipient: str, subject: str, body: str) -> dict:
     """
@@ -26,15 +52,12 @@ def draft_email(token: str, recipient: str, subject: str, body: str) -> dict:
     create_draft_message = {'message': {'raw': encoded_message}}
 
     try:
-        response = requests.post(
+        response = google_request(
+            'POST',
+            token,
             'https://gmail.googleapis.com/gmail/v1/users/me/drafts',
-            headers={
-                'Authorization': f'Bearer {token}',
-                'Content-Type': 'application/json',
-            },
             json=create_draft_message
         )
-        response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
         raise Exception(f"Failed to draft email: {e}")
@@ -50,19 +73,11 @@ def get_drafts(token: str, search_string: str = '') -> dict:
     Returns:
         dict: The list of email drafts from the Gmail API.
     """
+    params = {'fields': DRAFT_LIST_FIELDS}
+    if search_string:
+        params['q'] = search_string
     try:
-        if search_string:
-            response = requests.get(
-                f'https://gmail.googleapis.com/gmail/v1/users/me/drafts?q={search_string}',
-                headers={'Authorization': f'Bearer {token}'}
-            )
-        else:
-            response = requests.get(
-                'https://gmail.googleapis.com/gmail/v1/users/me/drafts',
-                headers={'Authorization': f'Bearer {token}'}
-            )
-        response.raise_for_status()
-        return response.json()
+        return google_get(token, 'https://gmail.googleapis.com/gmail/v1/users/me/drafts', params)
     except requests.exceptions.RequestException as e:
         raise Exception(f"Failed to get drafts: {e}")
 
@@ -78,21 +93,13 @@ def send_draft(token: str, draft_id: str) -> dict:
         dict: The sent email response from the Gmail API.
     """
     try:
-        get_draft_response = requests.get(
-            f'https://gmail.googleapis.com/gmail/v1/users/me/drafts/{draft_id}',
-            headers={'Authorization': f'Bearer {token}'}
-        )
-        get_draft_response.raise_for_status()
-        draft = get_draft_response.json()
-        send_response = requests.post(
-            f'https://gmail.googleapis.com/gmail/v1/users/me/drafts/send',
-            headers={
-                'Authorization': f'Bearer {token}',
-                'Content-Type': 'application/json'
-            },
+        draft = google_get(token, f'https://gmail.googleapis.com/gmail/v1/users/me/drafts/{draft_id}')
+        send_response = google_request(
+            'POST',
+            token,
+            'https://gmail.googleapis.com/gmail/v1/users/me/drafts/send',
             json=draft
         )
-        send_response.raise_for_status()
         return send_response.json()
     except requests.exceptions.RequestException as e:
         raise Exception(f"Failed to send draft: {e}")
@@ -111,11 +118,7 @@ def delete_draft(token: str, draft_id: str) -> None:
         None
     """
     try:
-        response = requests.delete(
-            f'https://gmail.googleapis.com/gmail/v1/users/me/drafts/{draft_id}',
-            headers={'Authorization': f'Bearer {token}'}
-        )
-        response.raise_for_status()
+        google_request('DELETE', token, f'https://gmail.googleapis.com/gmail/v1/users/me/drafts/{draft_id}')
     except requests.exceptions.RequestException as e:
         raise Exception(f"Failed to delete draft: {e}")
 
@@ -131,12 +134,11 @@ def get_emails(token: str, search_string: str) -> dict: #TODO: can search_string
         dict: The list of emails from the Gmail API.
     """
     try:
-        response = requests.get(
-            f'https://gmail.googleapis.com/gmail/v1/users/me/messages?q={search_string}',
-            headers={'Authorization': f'Bearer {token}'}
+        return google_get(
+            token,
+            'https://gmail.googleapis.com/gmail/v1/users/me/messages',
+            {'q': search_string, 'fields': EMAIL_LIST_FIELDS}
         )
-        response.raise_for_status()
-        return response.json()
     except requests.exceptions.RequestException as e:
         raise Exception(f"Failed to get emails: {e}")
 
@@ -144,6 +146,8 @@ def get_email_details(token: str, email_id: str) -> dict:
     """
     Get the details of an email using the Gmail API.
 
+    Only the headers and the MIME parts with the body are requested, see EMAIL_BODY_FIELDS.
+
     Args:
         token (str): The OAuth2 token for authentication.
         email_id (str): The ID of the email to retrieve.
@@ -152,11 +156,119 @@ def get_email_details(token: str, email_id: str) -> dict:
         dict: The details of the email from the Gmail API.
     """
     try:
-        response = requests.get(
+        return google_get(
+            token,
             f'https://gmail.googleapis.com/gmail/v1/users/me/messages/{email_id}',
-            headers={'Authorization': f'Bearer {token}'}
+            {'format': 'full', 'fields': EMAIL_BODY_FIELDS}
+        )
+    except requests.exceptions.RequestException as e:
+        raise Exception(f"Failed to get email details: {e}")
+
+def get_thread_details(token: str, thread_id: str) -> dict:
+    """
+    Get a thread with the details of all its emails using the Gmail API.
+
+    Args:
+        token (str): The OAuth2 token for authentication.
+        thread_id (str): The ID of the thread to retrieve.
+
+    Returns:
+        dict: The thread from the Gmail API, its messages have the fields of get_email_details.
+    """
+    try:
+        return google_get(
+            token,
+            f'https://gmail.googleapis.com/gmail/v1/users/me/threads/{thread_id}',
+            {'format': 'full', 'fields': THREAD_FIELDS}
         )
-        response.raise_for_status()
-        return response.json()
     except requests.exceptions.RequestException as e:
-        raise Exception(f"Failed to get email details: {e}")
\ No newline at end of file
+        raise Exception(f"Failed to get thread details: {e}")
+
+def iter_email_id_pages(
+        token: str,
+        search_string: str,
+        page_size: int = EMAIL_LIST_PAGE_SIZE,
+        threads: bool = False
+) -> Iterator[list[str]]:
+    """
+    Iterate over the ids of the emails or threads matching the search string, page by page.
+
+    The next page is only requested when the previous one has been consumed.
+
+    Args:
+        token (str): The OAuth2 token for authentication.
+        search_string (str): The search string to filter emails.
+        page_size (int): The maximum number of ids per page.
+        threads (bool): Whether to list the ids of the matching threads instead of the emails. Defaults to False.
+
+    Yields:
+        list[str]: The email or thread ids of a page.
+    """
+    resource = 'threads' if threads else 'messages'
+    params = {
+        'q': search_string,
+        'maxResults': page_size,
+        'fields': THREAD_LIST_FIELDS if threads else EMAIL_LIST_FIELDS,
+    }
+    while True:
+        try:
+            page = google_get(token, f'https://gmail.googleapis.com/gmail/v1/users/me/{resource}', params)
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Failed to get {resource}: {e}")
+        email_ids = [item['id'] for item in page.get(resource, []) if 'id' in item]
+        if email_ids:
+            yield email_ids
+        if not page.get('nextPageToken'):
+            return
+        params = {**params, 'pageToken': page['nextPageToken']}
+
+def iter_emails(
+        token: str,
+        search_string: str,
+        max_emails: int = EMAIL_SEARCH_MAX_CANDIDATES,
+        time_budget_seconds: float = EMAIL_SEARCH_TIME_BUDGET_SECONDS,
+        by_thread: bool = False
+) -> Iterator[dict]:
+    """
+    Iterate over the details of the emails or threads matching the search string.
+
+    Emails are listed and fetched page by page, so no more emails are fetched than consumed.
+    The iteration stops after max_emails emails or once the time budget is spent,
+    however broad the search string is. Emails are yielded in the order their fetches complete.
+
+    Args:
+        token (str): The OAuth2 token for authentication.
+        search_string (str): The search string to filter emails.
+        max_emails (int): The maximum number of emails.
+        time_budget_seconds (float): The time after which no further emails are fetched.
+        by_thread (bool): Whether to fetch whole threads, one per matching thread. max_emails then limits
+            the number of threads. Defaults to False.
+
+    Yields:
+        dict: The details of an email, see get_email_details, or a thread, see get_thread_details.
+    """
+    fetch_details = get_thread_details if by_thread else get_email_details
+    deadline = time.monotonic() + time_budget_seconds
+    count = 0
+    executor = ThreadPoolExecutor(max_workers=email_fetch_workers)
+    try:
+        for email_ids in iter_email_id_pages(token, search_string, min(EMAIL_LIST_PAGE_SIZE, max_emails), by_thread):
+            email_ids = email_ids[:max_emails - count]
+            futures = [executor.submit(fetch_details, token, email_id) for email_id in email_ids]
+            try:
+                # emails are yielded as they arrive, a slow fetch does not hold back the others or the deadline
+                for future in as_completed(futures, timeout=max(deadline - time.monotonic(), 0)):
+                    yield future.result()
+                    count += 1
+            except FuturesTimeoutError:
+                logfire.info("Email search ran out of time after {count} emails", count=count)
+                return
+            if count >= max_emails:
+                logfire.info("Email search reached the limit of {count} emails", count=count)
+                return
+            if time.monotonic() >= deadline:
+                logfire.info("Email search ran out of time after {count} emails", count=count)
+                return
+    finally:
+        # drop the fetches that are not consumed anymore, running ones finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
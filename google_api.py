@@ -0,0 +1,339 @@
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, Callable
+
+import logfire
+import requests
+
+from .metrics import google_api_duration, google_endpoint
+
+# Gmail allows 250 quota units per user per second, Calendar roughly 600 requests per user per minute.
+# see https://developers.google.com/gmail/api/reference/quota and https://developers.google.com/calendar/api/guides/quota
+GMAIL_QUOTA_UNITS_PER_SECOND = float(os.getenv("GMAIL_QUOTA_UNITS_PER_SECOND", 250))
+CALENDAR_REQUESTS_PER_SECOND = float(os.getenv("CALENDAR_REQUESTS_PER_SECOND", 10))
+max_retries = 5
+backoff_base_seconds = 0.5
+backoff_max_seconds = 32.0
+# (connect, read) timeout of a single request, a hung connection otherwise blocks its caller forever
+request_timeout_seconds = (5.0, 30.0)
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+# idle buckets and token owners are dropped at most this often
+prune_interval_seconds = 60
+# Google access tokens live for an hour, the owner of a token unused for this long is forgotten
+token_owner_ttl_seconds = 2 * 60 * 60
+
+# (method, path pattern, quota units), the first match wins
+_GMAIL_QUOTA_UNITS = [
+    ('POST', re.compile(r'/drafts/send$'), 100),
+    ('POST', re.compile(r'/messages/send$'), 100),
+    ('GET', re.compile(r'/threads/[^/]+$'), 10),
+    ('GET', re.compile(r'/threads$'), 10),
+    ('POST', re.compile(r'/drafts$'), 10),
+    ('DELETE', re.compile(r'/drafts/[^/]+$'), 10),
+    ('GET', re.compile(r''), 5),
+]
+
+
+class _Call:
+    """ An in-flight call whose result is shared by all callers with the same key """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key into a single call.
+
+    The first caller of a key executes the function, every caller arriving while it is
+    in flight waits for it and gets the same result or exception.
+    Nothing is cached once the call has finished.
+    A caller that waited wait_timeout seconds in vain executes the function itself.
+    """
+
+    def __init__(self, wait_timeout: float | None = None):
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._calls: dict[Any, _Call] = {}
+
+    def do(self, key: Any, function: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not is_leader:
+            if not call.done.wait(self.wait_timeout):
+                logfire.warn("Coalesced call is still in flight after {wait_timeout}s, calling again", wait_timeout=self.wait_timeout)
+                return function()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket.
+
+    Callers reserve units up front and sleep for the returned time, so concurrent callers queue up
+    fairly instead of all retrying at once.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, units: float) -> float:
+        """ Reserve units and return the number of seconds to wait before using them """
+        with self._lock:
+            self._refill()
+            self._tokens -= units
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def pause(self, seconds: float) -> None:
+        """ Drain the bucket so that nothing is available for the given number of seconds """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+    def is_full(self) -> bool:
+        """ Check if the bucket refilled completely, then it behaves like a new bucket """
+        with self._lock:
+            self._refill()
+            return self._tokens >= self.capacity
+
+
+class RateLimiter:
+    """
+    Per user and API token buckets mirroring the Google quotas.
+
+    Users are identified by the owner of the token, see register_token_owner, so refreshed tokens
+    keep the bucket of the user. Buckets that refilled completely are dropped, they hold no state.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: dict[tuple[str, str], TokenBucket] = {}
+        # token hash -> (user id, time of last use)
+        self._token_owners: dict[str, tuple[str, float]] = {}
+        self._last_prune = time.monotonic()
+
+    def register_token_owner(self, token: str, user_id: str) -> None:
+        with self._lock:
+            self._token_owners[_token_hash(token)] = (user_id, time.monotonic())
+
+    def user_key(self, token: str) -> str:
+        """ Get the key identifying the user of a token, the token hash if the owner is unknown """
+        token_hash = _token_hash(token)
+        with self._lock:
+            owner = self._token_owners.get(token_hash)
+            if owner is None:
+                return token_hash
+            # tokens in use are kept
+            self._token_owners[token_hash] = (owner[0], time.monotonic())
+            return owner[0]
+
+    def _prune(self) -> None:
+        """ Internal method to drop full buckets and forget old tokens, requires the lock """
+        now = time.monotonic()
+        if now - self._last_prune < prune_interval_seconds:
+            return
+        self._last_prune = now
+        for key in [key for key, bucket in self._buckets.items() if bucket.is_full()]:
+            del self._buckets[key]
+        for token_hash in [
+            token_hash for token_hash, (_, registered) in self._token_owners.items()
+            if now - registered > token_owner_ttl_seconds
+        ]:
+            del self._token_owners[token_hash]
+
+    def bucket(self, user_key: str, api: str) -> TokenBucket:
+        with self._lock:
+            self._prune()
+            bucket = self._buckets.get((user_key, api))
+            if bucket is None:
+                rate = GMAIL_QUOTA_UNITS_PER_SECOND if api == 'gmail' else CALENDAR_REQUESTS_PER_SECOND
+                bucket = TokenBucket(rate=rate, capacity=rate)
+                self._buckets[(user_key, api)] = bucket
+            return bucket
+
+
+# a read takes at most the request timeout per attempt, followers stop waiting once a few attempts could have run
+_google_reads = SingleFlight(wait_timeout=2 * sum(request_timeout_seconds) + backoff_max_seconds)
+_rate_limiter = RateLimiter()
+
+
+def _token_hash(token: str) -> str:
+    """ Internal method to identify a token without keeping the token itself """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def register_token_owner(token: str, user_id: str) -> None:
+    """ Remember the user a token belongs to, so all tokens of a user share the user's rate limit """
+    _rate_limiter.register_token_owner(token, user_id)
+
+
+def _quota_cost(method: str, url: str) -> tuple[str, int]:
+    """ Internal method to get the API and the quota units of a request """
+    if 'gmail.googleapis.com' not in url:
+        return 'calendar', 1
+    path = url.split('?', 1)[0]
+    for rule_method, pattern, units in _GMAIL_QUOTA_UNITS:
+        if rule_method == method and pattern.search(path):
+            return 'gmail', units
+    return 'gmail', 5
+
+
+def _is_rate_limited(response: requests.Response) -> bool:
+    """ Internal method to check if a response is a retryable rate limit error """
+    if response.status_code == 429:
+        return True
+    if response.status_code != 403:
+        return False
+    try:
+        errors = response.json().get('error', {}).get('errors', [])
+    except ValueError:
+        return False
+    return any(error.get('reason') in RATE_LIMIT_REASONS for error in errors)
+
+
+def _retry_after_seconds(response: requests.Response) -> float | None:
+    """ Internal method to parse the Retry-After header, only the delay-seconds form is used by Google. Capped at backoff_max_seconds """
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    try:
+        return min(max(float(retry_after), 0.0), backoff_max_seconds)
+    except ValueError:
+        return None
+
+
+def google_request(method: str, token: str, url: str, params: dict | None = None, json: dict | None = None) -> requests.Response:
+    """
+    Send a request to a Google API through the per user rate limiter.
+
+    Rate limit errors are retried with jittered exponential backoff, honoring Retry-After.
+    Server errors are only retried for GET requests, since other requests may have been applied.
+    Waiting for the rate limit and backing off sleep, so call this from a worker thread, not the event loop.
+
+    Args:
+        method (str): The HTTP method.
+        token (str): The OAuth2 token for authentication.
+        url (str): The URL of the API endpoint.
+        params (dict, optional): The query parameters.
+        json (dict, optional): The JSON body.
+
+    Returns:
+        requests.Response: The successful response.
+
+    Raises:
+        requests.exceptions.RequestException: If the request fails or the retries are exhausted.
+    """
+    api, units = _quota_cost(method, url)
+    endpoint = google_endpoint(method, url)
+    bucket = _rate_limiter.bucket(_rate_limiter.user_key(token), api)
+    for attempt in range(max_retries + 1):
+        wait_seconds = bucket.reserve(units)
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+        request_start = time.perf_counter()
+        try:
+            response = requests.request(
+                method,
+                url,
+                headers={'Authorization': f'Bearer {token}'},
+                params=params,
+                json=json,
+                timeout=request_timeout_seconds,
+            )
+        except requests.exceptions.RequestException:
+            google_api_duration.labels(endpoint=endpoint, status='error').observe(time.perf_counter() - request_start)
+            raise
+        google_api_duration.labels(endpoint=endpoint, status=str(response.status_code)).observe(
+            time.perf_counter() - request_start
+        )
+        rate_limited = _is_rate_limited(response)
+        retryable = rate_limited or (method == 'GET' and response.status_code in RETRYABLE_STATUS_CODES)
+        if not retryable or attempt == max_retries:
+            response.raise_for_status()
+            return response
+
+        retry_after = _retry_after_seconds(response)
+        backoff_seconds = retry_after if retry_after is not None else random.uniform(
+            0, min(backoff_max_seconds, backoff_base_seconds * 2 ** attempt)
+        )
+        logfire.warn(
+            "Google API returned {status_code}, retrying in {backoff_seconds:.2f}s",
+            status_code=response.status_code,
+            backoff_seconds=backoff_seconds,
+            api=api,
+            attempt=attempt + 1,
+        )
+        if rate_limited:
+            # every request of this user would be rejected as well, so hold them all back,
+            # the next reservation waits for the pause
+            bucket.pause(backoff_seconds)
+        else:
+            time.sleep(backoff_seconds)
+
+
+def _request_key(token: str, url: str, params: dict | None) -> tuple:
+    """ Internal method to build the coalescing key of a read, scoped to the user of the token """
+    normalized_params = tuple(sorted(
+        (name, tuple(value) if isinstance(value, list) else value)
+        for name, value in (params or {}).items()
+    ))
+    return _rate_limiter.user_key(token), url, normalized_params
+
+
+def google_get(token: str, url: str, params: dict | None = None) -> dict:
+    """
+    Send a GET request to a Google API and return the parsed JSON response.
+
+    Identical concurrent reads of the same user share one request and its result,
+    so the returned dictionary must not be mutated. The request goes through google_request.
+
+    Args:
+        token (str): The OAuth2 token for authentication.
+        url (str): The URL of the API endpoint.
+        params (dict, optional): The query parameters.
+
+    Returns:
+        dict: The parsed JSON response.
+
+    Raises:
+        requests.exceptions.RequestException: If the request fails.
+    """
+    def send_request() -> dict:
+        return google_request('GET', token, url, params=params).json()
+
+    return _google_reads.do(_request_key(token, url, params), send_request)
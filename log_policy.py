@@ -0,0 +1,50 @@
+import os
+import random
+from typing import Any
+
+import logfire
+
+# Controls whether payloads (API responses, documents, events) are logged on the hot path:
+#   off     - never, only counts and ids are logged
+#   sampled - for a LOG_PAYLOAD_SAMPLE_RATE fraction of calls
+#   full    - always
+# Logged payloads are capped at LOG_PAYLOAD_MAX_CHARS characters.
+LOG_PAYLOADS = os.getenv("LOG_PAYLOADS", "off").lower()
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", 0.01))
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", 2000))
+
+if LOG_PAYLOADS not in ("off", "sampled", "full"):
+    raise ValueError("LOG_PAYLOADS must be one of off, sampled or full")
+
+
+def should_log_payload() -> bool:
+    """ Decide if the payload of the current call should be logged, check this before building any payload """
+    if LOG_PAYLOADS == "off":
+        return False
+    if LOG_PAYLOADS == "sampled":
+        return random.random() < LOG_PAYLOAD_SAMPLE_RATE
+    return True
+
+
+def truncate_payload(payload: Any, max_chars: int = LOG_PAYLOAD_MAX_CHARS) -> str:
+    """ Render a payload for logging, capped at max_chars characters """
+    text = payload if isinstance(payload, str) else repr(payload)
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}... ({len(text) - max_chars} more characters)"
+
+
+def log_payload(message: str, payload: Any, **attributes) -> None:
+    """
+    Log a payload at debug level, if the logging policy allows it.
+
+    The payload is only rendered when it is actually logged.
+
+    Args:
+        message (str): The log message template, may reference the attributes.
+        payload (Any): The payload, rendered with repr unless it is a string.
+        **attributes: Additional structured attributes, keep them small.
+    """
+    if not should_log_payload():
+        return
+    logfire.debug(message, payload=truncate_payload(payload), **attributes)
@@ -3,28 +3,40 @@ from dotenv import load_dotenv
 load_dotenv()
 # THIS NEEDS TO BE EXECUTED BEFORE ANY OTHER IMPORTS
 
+import asyncio
 import os
 from typing import Annotated
 
 import requests
-from fastapi.security import OAuth2AuthorizationCodeBearer
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from starlette.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import HTMLResponse
-from contextlib import asynccontextmanager
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from starlette.responses import HTMLResponse, FileResponse
+from contextlib import asynccontextmanager, suppress
 from sqlmodel import select, Session
-from fastapi import FastAPI, Depends, Request, HTTPException, Response
+from fastapi import FastAPI, BackgroundTasks, Depends, Request, HTTPException, Response, Query
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.exc import NoResultFound
 import logfire
 
 from .database import engine
+from .token_manager import token_manager, token_expiry
+from .session_token import issue_session_token, verify_session_token
+from .metrics import http_metrics_middleware, metrics_response
+from .profiling import profiling_middleware, is_admin, list_profiles, profile_path
 from .ai_integration import get_ai_response
+from .conversation import compact_conversation, clear_conversation_summary
+from .chat_search import CHAT_SEARCH_MAX_PAGE_SIZE, search_chat_messages
 from .calendar_integration import fetch_google_calendar_events, create_google_calendar_event
 # MUST IMPORT ALL MODELS, OTHERWISE RELATIONSHIPS WILL NOT WORK # TODO: find a better way to do this
 from .models.user import User
 from .models.chat_message import ChatMessage
+from .models.conversation_summary import ConversationSummary
+from .models.chat_message_read import ChatMessageRead
+from .models.chat_search_page import ChatSearchPage
 from .models.incoming_chat_message import IncomingChatMessage
 from .models.select_chat_message import SelectChatMessage
 from .models.event_creation_parameters import EventCreationParameters
@@ -33,10 +45,14 @@ from .models.event_creation_parameters import EventCreationParameters
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logfire.info("FastAPI lifespan started")
+    token_refresh_task = asyncio.create_task(token_manager.run_refresh_loop())
     yield
+    token_refresh_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await token_refresh_task
     logfire.info("FastAPI lifespan ended")
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 logfire.configure()
 logfire.instrument_fastapi(app)
@@ -56,6 +72,11 @@ app.add_middleware(
 
 app.add_middleware(SessionMiddleware, secret_key=os.getenv("SECRET_KEY"))
 
+app.middleware("http")(http_metrics_middleware)
+
+# only compress responses that are large enough to be worth it, e.g. long chat histories
+app.add_middleware(GZipMiddleware, minimum_size=int(os.getenv("GZIP_MINIMUM_SIZE", 1024)), compresslevel=5)
+
 scopes = {
     "openid": "Access to OpenID Connect authentication",
     "email": "Access to user's email",
@@ -68,12 +89,13 @@ scopes = {
     "https://www.googleapis.com/auth/gmail.compose": "Compose and send emails",
     "https://www.googleapis.com/auth/gmail.labels": "Manage labels",
 }
-oauth2_scheme = OAuth2AuthorizationCodeBearer(
-    authorizationUrl='https://accounts.google.com/o/oauth2/auth',
-    tokenUrl='https://accounts.google.com/o/oauth2/token',
-    scopes=scopes
+# the bearer token is the session token of issue_session_token, not a Google token
+bearer_scheme = HTTPBearer(
+    scheme_name='SessionToken',
+    description='The session token the login callback (/auth/callback) posts to the frontend',
 )
 
+
 @app.get('/')
 async def homepage():
     return HTMLResponse("""
@@ -135,22 +157,69 @@ function logToken() {
 """)
 
 
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
-    userinfo_response = requests.get(
-        "https://www.googleapis.com/oauth2/v1/userinfo",
-        headers={"Authorization": f"Bearer {token}"},
+def get_chat_history(db_session: Session, user_id: str) -> ORJSONResponse:
+    """
+    Get the chat history of a user as a ready to send response.
+
+    Only the columns needed by the client are queried and the rows are serialized
+    directly, without building and validating ChatMessage models.
+    """
+    statement = (
+        select(ChatMessage.id, ChatMessage.message, ChatMessage.sender, ChatMessage.send_time)
+        .where(ChatMessage.user_id == user_id)
+        .order_by(ChatMessage.id)
     )
-    if userinfo_response.status_code != 200:
+    rows = db_session.exec(statement).all()
+    return ORJSONResponse([
+        {'id': row.id, 'message': row.message, 'sender': row.sender, 'send_time': row.send_time}
+        for row in rows
+    ])
+
+
+async def authenticate_session_token(token: str) -> User:
+    # the bearer token is our own session token, so requests keep working when the Google token expires
+    user_id = verify_session_token(token)
+    if user_id is None:
         raise HTTPException(status_code=401, detail="Invalid token or user not found")
-    user_data = userinfo_response.json()
 
     with Session(engine) as db_session:
-        statement = select(User).where(User.id == user_data['id'])
-        user = db_session.exec(statement).first()
+        user = db_session.get(User, user_id)
         if user:
             return user
         raise HTTPException(status_code=401, detail='Invalid token or user not found')
 
+
+async def get_current_user(credentials: Annotated[HTTPAuthorizationCredentials, Depends(bearer_scheme)]) -> User:
+    return await authenticate_session_token(credentials.credentials)
+
+app.middleware("http")(profiling_middleware(authenticate_session_token))
+
+
+async def get_admin_user(current_user: User = Depends(get_current_user)):
+    if not is_admin(current_user):
+        raise HTTPException(status_code=403, detail='Forbidden')
+    return current_user
+
+
+@app.get('/metrics', include_in_schema=False)
+async def metrics(admin_user: User = Depends(get_admin_user)):
+    # scrape with the session token of an admin as bearer token
+    return metrics_response()
+
+
+@app.get('/profiles')
+async def get_profiles(admin_user: User = Depends(get_admin_user)):
+    return list_profiles()
+
+
+@app.get('/profiles/{name}')
+async def download_profile(name: str, admin_user: User = Depends(get_admin_user)):
+    path = profile_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail='Profile not found')
+    return FileResponse(path, media_type='application/json', filename=name)
+
+
 @app.get("/auth/login")
 async def login(response: Response):
     response.headers["Location"] = (
@@ -200,7 +269,7 @@ async def auth_callback(request: Request, code: str):
                     name=user_data['name'],
                     picture=user_data.get('picture'),
                     google_token=token,
-                    google_token_expires=token_info['expires_in'],
+                    google_token_expires_at=token_expiry(token_info['expires_in']),
                     google_refresh_token=token_info.get('refresh_token'),
                 )
             except KeyError as error:
@@ -209,28 +278,31 @@ async def auth_callback(request: Request, code: str):
             db_session.commit()
         else:
             user.google_token = token
-            user.google_token_expires = token_info['expires_in']
-            user.google_refresh_token = token_info.get('refresh_token')
+            user.google_token_expires_at = token_expiry(token_info['expires_in'])
+            # google only sends a refresh token on the first consent, keep the stored one otherwise
+            if token_info.get('refresh_token'):
+                user.google_refresh_token = token_info['refresh_token']
             db_session.commit()
         db_session.refresh(user)
+        token_manager.remember(user)
 
     return templates.TemplateResponse(
         request=request,
         name="google_callback.html",
         context={
-            "token": token,
+            "token": issue_session_token(user.id),
             "frontend_origin": os.getenv("FRONTEND_ORIGIN"),
         }
     )
-@app.post('/chat', response_model=list[ChatMessage])
+@app.post('/chat', response_model=list[ChatMessageRead])
 async def send_chat_message(
         incoming_chat_message: IncomingChatMessage,
-        token: Annotated[str, Depends(oauth2_scheme)],
+        background_tasks: BackgroundTasks,
         current_user: User = Depends(get_current_user)
 ):
     ai_response = await get_ai_response(
         incoming_chat_message.message,
-        token,
+        await token_manager.get_token(current_user),
         current_user
     )
 
@@ -251,7 +323,9 @@ async def send_chat_message(
 
         db_session.commit()
 
-        return current_user.messages
+        # summarize older messages after the response is sent, so the next turn's prompt stays small
+        background_tasks.add_task(compact_conversation, current_user.id)
+        return get_chat_history(db_session, current_user.id)
 
 
 @app.post('/delete-chat-message')
@@ -269,13 +343,25 @@ async def delete_chat_message(select_chat_message: SelectChatMessage, current_us
         return {'status': 'success'}
 
 
-@app.get('/chat')
+@app.get('/chat', response_model=list[ChatMessageRead])
 async def get_chat_messages(current_user_dependency: User = Depends(get_current_user)):
     with Session(engine) as db_session:
-        user_in_session = db_session.get(User, current_user_dependency.id)
-        if not user_in_session:
-            raise HTTPException(status_code=404, detail="User not found in current session")
-        return user_in_session.messages
+        return get_chat_history(db_session, current_user_dependency.id)
+
+
+@app.get('/chat/search', response_model=ChatSearchPage)
+async def search_chat(
+        q: Annotated[str, Query(min_length=1, max_length=500)],
+        limit: Annotated[int, Query(ge=1, le=CHAT_SEARCH_MAX_PAGE_SIZE)] = 20,
+        cursor: str | None = None,
+        current_user_dependency: User = Depends(get_current_user)
+):
+    with Session(engine) as db_session:
+        try:
+            page = search_chat_messages(db_session, current_user_dependency.id, q, limit, cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail='Invalid cursor')
+        return page
 
 
 @app.delete('/clear-chat')
@@ -285,5 +371,6 @@ async def clear_chat(current_user_dependency: User = Depends(get_current_user)):
         if not user_in_session:
             raise HTTPException(status_code=404, detail="User not found in current session")
         user_in_session.messages = []
+        clear_conversation_summary(db_session, user_in_session.id)
         db_session.commit()
         return {'status': 'success'}
\ No newline at end of file
@@ -0,0 +1,168 @@
+import functools
+import inspect
+import re
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+from prometheus_client import Counter, Histogram, CONTENT_TYPE_LATEST, generate_latest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.requests import Request
+from starlette.responses import Response
+
+# Labels must stay low-cardinality: no user ids, message ids or raw URLs.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+http_request_duration = Histogram(
+    'http_request_duration_seconds',
+    'Latency of HTTP requests by route template',
+    ['method', 'route', 'status'],
+    buckets=LATENCY_BUCKETS,
+)
+agent_tool_duration = Histogram(
+    'agent_tool_duration_seconds',
+    'Latency of agent tool calls',
+    ['tool', 'outcome'],
+    buckets=LATENCY_BUCKETS,
+)
+google_api_duration = Histogram(
+    'google_api_request_duration_seconds',
+    'Latency of Google API requests by endpoint and status',
+    ['endpoint', 'status'],
+    buckets=LATENCY_BUCKETS,
+)
+model_inference_duration = Histogram(
+    'model_inference_duration_seconds',
+    'Latency of local encoder and reranker calls',
+    ['model'],
+    buckets=LATENCY_BUCKETS,
+)
+db_query_duration = Histogram(
+    'db_query_duration_seconds',
+    'Latency of database queries by statement type',
+    ['statement'],
+    buckets=LATENCY_BUCKETS,
+)
+agent_run_duration = Histogram(
+    'agent_run_duration_seconds',
+    'Latency of agent runs by route and model',
+    ['route', 'model', 'outcome'],
+    buckets=LATENCY_BUCKETS,
+)
+routing_duration = Histogram(
+    'routing_duration_seconds',
+    'Latency of routing a message, counted per chosen route',
+    ['route'],
+    buckets=LATENCY_BUCKETS,
+)
+cross_encoder_cache_lookups = Counter(
+    'cross_encoder_cache_lookups_total',
+    'Lookups of cross encoder scores in the score cache, the hit ratio is hits over all lookups',
+    ['result'],
+)
+response_cache_lookups = Counter(
+    'response_cache_lookups_total',
+    'Lookups of answers in the semantic response cache by result',
+    ['result'],
+)
+
+_GOOGLE_PATH_SEGMENTS = {
+    'gmail', 'calendar', 'v1', 'v3', 'users', 'me', 'messages', 'drafts', 'send', 'threads',
+    'calendars', 'calendarList', 'events', 'freeBusy', 'primary', 'oauth2', 'userinfo',
+}
+_host_pattern = re.compile(r'^https?://([^/]+)')
+
+
+def google_endpoint(method: str, url: str) -> str:
+    """
+    Get a low-cardinality name of a Google API endpoint, ids in the path are replaced by placeholders.
+
+    e.g. GET https://gmail.googleapis.com/gmail/v1/users/me/messages/abc -> GET gmail/v1/users/me/messages/{id}
+    """
+    path = _host_pattern.sub('', url.split('?', 1)[0])
+    segments = [
+        segment if segment in _GOOGLE_PATH_SEGMENTS else '{id}'
+        for segment in path.strip('/').split('/')
+        if segment
+    ]
+    return f"{method} {'/'.join(segments)}"
+
+
+@contextmanager
+def observe(histogram: Histogram, **labels):
+    """ Time the wrapped block and record it in the histogram """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - start)
+
+
+def instrument_tool(function: Callable) -> Callable:
+    """
+    Record the latency of an agent tool, apply it below the agent.tool decorator.
+
+    The wrapper keeps the signature and docstring of the tool, which the agent uses for the tool schema.
+    """
+    tool_name = function.__name__
+
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = 'error'
+            try:
+                result = await function(*args, **kwargs)
+                outcome = 'ok'
+                return result
+            finally:
+                agent_tool_duration.labels(tool=tool_name, outcome=outcome).observe(time.perf_counter() - start)
+    else:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = 'error'
+            try:
+                result = function(*args, **kwargs)
+                outcome = 'ok'
+                return result
+            finally:
+                agent_tool_duration.labels(tool=tool_name, outcome=outcome).observe(time.perf_counter() - start)
+    return wrapper
+
+
+def instrument_engine(engine: Engine) -> None:
+    """ Record the latency of every query executed by the engine """
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        start = connection.info['query_start_times'].pop()
+        statement_type = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'UNKNOWN'
+        db_query_duration.labels(statement=statement_type).observe(time.perf_counter() - start)
+
+
+async def http_metrics_middleware(request: Request, call_next) -> Response:
+    """ Record the latency of every request, labelled by the route template instead of the raw path """
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get('route')
+        http_request_duration.labels(
+            method=request.method,
+            route=getattr(route, 'path', 'unmatched'),
+            status=str(status),
+        ).observe(time.perf_counter() - start)
+
+
+def metrics_response() -> Response:
+    """ Render all metrics in the Prometheus text format """
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -10,6 +10,7 @@ from sqlmodel import SQLModel
 # import all sqlmodels here
 from models.user import User
 from models.chat_message import ChatMessage
+from models.conversation_summary import ConversationSummary
 
 dotenv_path = os.path.join(os.path.dirname(__file__), '..', '.env')
 load_dotenv(dotenv_path)
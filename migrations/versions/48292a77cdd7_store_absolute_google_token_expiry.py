@@ -0,0 +1,31 @@
+"""store absolute google token expiry
+
+Revision ID: 48292a77cdd7
+Revises: cf516ed6e578
+Create Date: 2026-10-19 10:12:44.318210
+
+"""
+from typing import Sequence, Union
+
+import sqlmodel
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '48292a77cdd7'
+down_revision: Union[str, None] = 'cf516ed6e578'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('user', sa.Column('google_token_expires_at', sa.DateTime(), nullable=True))
+    # the old column held the relative expires_in of the token response, without the time it was issued,
+    # so it can not be converted. Tokens without expiry are used as is until the next login.
+    op.drop_column('user', 'google_token_expires')
+
+
+def downgrade() -> None:
+    op.add_column('user', sa.Column('google_token_expires', sa.Integer(), nullable=True))
+    op.drop_column('user', 'google_token_expires_at')
@@ -0,0 +1,39 @@
+"""add chat message search
+
+Revision ID: d41b7e2c9f85
+Revises: 9c3e51f0a7d2
+Create Date: 2026-10-19 17:42:08.914356
+
+"""
+from typing import Sequence, Union
+
+import sqlmodel
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd41b7e2c9f85'
+down_revision: Union[str, None] = '9c3e51f0a7d2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # adding a stored generated column rewrites the table once, existing messages are indexed in the process
+    op.add_column('chat_message', sa.Column(
+        'message_search',
+        postgresql.TSVECTOR(),
+        sa.Computed("to_tsvector('simple', message)", persisted=True),
+        nullable=True,
+    ))
+    op.create_index('ix_chat_message_message_search', 'chat_message', ['message_search'], postgresql_using='gin')
+    # every chat query filters by user, search combines this index with the text index
+    op.create_index(op.f('ix_chat_message_user_id'), 'chat_message', ['user_id'])
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_chat_message_user_id'), table_name='chat_message')
+    op.drop_index('ix_chat_message_message_search', table_name='chat_message', postgresql_using='gin')
+    op.drop_column('chat_message', 'message_search')
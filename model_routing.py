@@ -0,0 +1,154 @@
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+import logfire
+import torch
+from sentence_transformers import util
+
+from .metrics import routing_duration
+from .search import bi_encoder
+
+DEFAULT_MODEL = os.getenv("ROUTER_DEFAULT_MODEL", "openai:gpt-4o-mini")
+# below this similarity margin between the two best routes the message is treated as mixed intent
+ambiguity_margin = 0.05
+
+COMMON_TOOLS = {'get_offset_time', 'get_user_timezone', 'get_user_recent_messages'}
+CALENDAR_TOOLS = {'get_calendar_events', 'get_free_busy', 'create_calendar_event'}
+EMAIL_TOOLS = {
+    'get_user_emails', 'get_user_email_details', 'draft_user_email', 'send_user_draft',
+    'get_user_drafts', 'delete_user_draft',
+}
+
+# example messages of each route, a message is routed to the route of its most similar example
+_ROUTE_EXAMPLES = {
+    'simple': [
+        "Who was the first president of the United States?",
+        "What is the capital of France?",
+        "Explain how photosynthesis works.",
+        "Tell me a joke.",
+        "Translate 'good morning' into Spanish.",
+        "Hi, how are you?",
+        "What did you just say?",
+        "What time is it?",
+    ],
+    'calendar': [
+        "When is my next meeting?",
+        "What is on my calendar next week?",
+        "Create a calendar entry for next Tuesday at 10am.",
+        "Schedule a dentist appointment on Friday afternoon.",
+        "Am I free tomorrow morning?",
+        "When is my event at the headquarters happening?",
+        "Add my flight to Berlin on Monday to my calendar.",
+        "Move my lunch appointment to 1pm.",
+    ],
+    'email': [
+        "Did I get any emails about the new model?",
+        "Summarize my latest emails from my boss.",
+        "Draft an email to john@example.com about the project status.",
+        "Send the draft I just created.",
+        "Show me my email drafts.",
+        "Find the invoice someone mailed me last month.",
+        "Reply to the newsletter and unsubscribe.",
+        "Delete my draft to Anna.",
+    ],
+}
+
+
+def _models_from_env(name: str, default: str) -> list[str]:
+    """ Internal method to read a comma separated list of models, the first one is tried first. Falls back to default if empty """
+    models = [model.strip() for model in os.getenv(name, default).split(",") if model.strip()]
+    if not models:
+        logfire.warn("{name} lists no models, using {default}", name=name, default=default)
+        models = [model.strip() for model in default.split(",") if model.strip()]
+    return models
+
+
+@dataclass(frozen=True)
+class Route:
+    name: str
+    # models in order of preference, later ones are fallbacks if a model fails
+    models: list[str]
+    # None means all tools
+    tool_names: frozenset[str] | None
+
+
+ROUTES = {
+    'simple': Route(
+        'simple',
+        _models_from_env("ROUTER_SIMPLE_MODELS", f"openai:gpt-4.1-nano,{DEFAULT_MODEL}"),
+        frozenset(COMMON_TOOLS),
+    ),
+    'calendar': Route(
+        'calendar',
+        _models_from_env("ROUTER_CALENDAR_MODELS", DEFAULT_MODEL),
+        frozenset(COMMON_TOOLS | CALENDAR_TOOLS),
+    ),
+    'email': Route(
+        'email',
+        _models_from_env("ROUTER_EMAIL_MODELS", DEFAULT_MODEL),
+        frozenset(COMMON_TOOLS | EMAIL_TOOLS),
+    ),
+    'mixed': Route(
+        'mixed',
+        _models_from_env("ROUTER_MIXED_MODELS", DEFAULT_MODEL),
+        None,
+    ),
+}
+ROUTING_ENABLED = os.getenv("ROUTING_ENABLED", "true").lower() == "true"
+
+_example_embeddings: torch.Tensor | None = None
+_example_routes: list[str] = []
+_example_lock = threading.Lock()
+
+
+def _get_example_embeddings() -> tuple[torch.Tensor, list[str]]:
+    """ Internal method to encode the route examples once, on first use """
+    global _example_embeddings, _example_routes
+    with _example_lock:
+        if _example_embeddings is None:
+            routes = [route for route, examples in _ROUTE_EXAMPLES.items() for _ in examples]
+            examples = [example for examples in _ROUTE_EXAMPLES.values() for example in examples]
+            _example_embeddings = bi_encoder.encode(examples, convert_to_tensor=True, show_progress_bar=False)
+            _example_routes = routes
+    return _example_embeddings, _example_routes
+
+
+def route_message(message: str, message_embedding: torch.Tensor | None = None) -> Route:
+    """
+    Pick the route of a message using the already loaded bi encoder.
+
+    Every route scores as its most similar example. If the two best routes are too close to call,
+    the message is routed as mixed, which uses the default model and all tools.
+
+    Args:
+        message (str): The user's message.
+        message_embedding (torch.Tensor, optional): The bi encoder embedding of the message, if already computed.
+
+    Returns:
+        Route: The chosen route.
+    """
+    if not ROUTING_ENABLED:
+        return ROUTES['mixed']
+
+    start = time.perf_counter()
+    example_embeddings, example_routes = _get_example_embeddings()
+    if message_embedding is None:
+        message_embedding = bi_encoder.encode(message, convert_to_tensor=True, show_progress_bar=False)
+    similarities = util.cos_sim(message_embedding, example_embeddings)[0].tolist()
+
+    route_scores: dict[str, float] = {}
+    for route_name, similarity in zip(example_routes, similarities):
+        route_scores[route_name] = max(route_scores.get(route_name, -1.0), similarity)
+    ranked = sorted(route_scores.items(), key=lambda item: item[1], reverse=True)
+    (best_route, best_score), (_, second_score) = ranked[0], ranked[1]
+    route_name = best_route if best_score - second_score >= ambiguity_margin else 'mixed'
+
+    routing_duration.labels(route=route_name).observe(time.perf_counter() - start)
+    logfire.info(
+        "Routed message to {route}",
+        route=route_name,
+        scores={name: round(score, 3) for name, score in ranked},
+    )
+    return ROUTES[route_name]
@@ -1,19 +1,37 @@
 from datetime import datetime
 from typing import TYPE_CHECKING, Optional
 
+from sqlalchemy import Column, Computed, Index
+from sqlalchemy.orm import deferred
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlmodel import Field, Relationship, SQLModel
 
 if TYPE_CHECKING:
     from .user import User
 
+# the text search configuration of message_search, 'simple' does not stem, so it works for messages in any language
+CHAT_MESSAGE_SEARCH_CONFIG = 'simple'
+# deferred, so loading messages does not load their search vectors, see ChatMessage.__mapper_args__
+_message_search_column = Column(
+    'message_search', TSVECTOR, Computed(f"to_tsvector('{CHAT_MESSAGE_SEARCH_CONFIG}', message)", persisted=True)
+)
+
 
 class ChatMessage(SQLModel, table=True):
     __tablename__ = "chat_message"
+    __table_args__ = (Index('ix_chat_message_message_search', 'message_search', postgresql_using='gin'),)
+    __mapper_args__ = {'properties': {'message_search': deferred(_message_search_column)}}
 
     id: Optional[int] = Field(default=None, primary_key=True)
     message: str = Field(nullable=False)
     sender: str = Field(nullable=False)
     send_time: datetime = Field(default=datetime.now())
+    # generated by the database from message, see the add_chat_message_search migration
+    message_search: Optional[str] = Field(
+        default=None,
+        sa_column=_message_search_column,
+        exclude=True,
+    )
 
-    user_id: str = Field(nullable=False, foreign_key="user.id")
-    user: "User" = Relationship(back_populates="messages")
\ No newline at end of file
+    user_id: str = Field(nullable=False, foreign_key="user.id", index=True)
+    user: "User" = Relationship(back_populates="messages")
@@ -0,0 +1,10 @@
+from datetime import datetime
+
+from pydantic import BaseModel
+
+
+class ChatMessageRead(BaseModel):
+    id: int
+    message: str
+    sender: str
+    send_time: datetime
@@ -0,0 +1,11 @@
+from typing import Optional
+
+from pydantic import BaseModel
+
+from .chat_search_result import ChatSearchResult
+
+
+class ChatSearchPage(BaseModel):
+    results: list[ChatSearchResult]
+    # pass as cursor to get the next page, None on the last page
+    next_cursor: Optional[str]
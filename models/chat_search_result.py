@@ -0,0 +1,11 @@
+from datetime import datetime
+
+from pydantic import BaseModel
+
+
+class ChatSearchResult(BaseModel):
+    id: int
+    message: str
+    sender: str
+    send_time: datetime
+    rank: float
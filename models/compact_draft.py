@@ -0,0 +1,7 @@
+from pydantic import BaseModel
+
+
+class CompactDraft(BaseModel):
+    id: str
+    message_id: str | None = None
+    thread_id: str | None = None
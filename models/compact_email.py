@@ -0,0 +1,6 @@
+from pydantic import BaseModel
+
+
+class CompactEmail(BaseModel):
+    id: str
+    data: str
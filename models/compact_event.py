@@ -0,0 +1,13 @@
+from pydantic import BaseModel
+
+
+class CompactEvent(BaseModel):
+    id: str
+    summary: str | None = None
+    start: str | None = None
+    end: str | None = None
+    location: str | None = None
+    description: str | None = None
+    attendees: list[str] | None = None
+    attendee_count: int | None = None
+    recurrence: list[str] | None = None
@@ -0,0 +1,7 @@
+from pydantic import BaseModel
+
+
+class CompactSentMessage(BaseModel):
+    id: str
+    thread_id: str | None = None
+    labels: list[str] | None = None
@@ -0,0 +1,13 @@
+from datetime import datetime
+
+from sqlmodel import Field, SQLModel
+
+
+class ConversationSummary(SQLModel, table=True):
+    __tablename__ = "conversation_summary"
+
+    user_id: str = Field(primary_key=True, foreign_key="user.id")
+    # rolling summary of all chat messages up to and including summarized_until_message_id
+    summary: str = Field(nullable=False)
+    summarized_until_message_id: int = Field(nullable=False)
+    updated_at: datetime = Field(nullable=False)
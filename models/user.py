@@ -1,3 +1,4 @@
+from datetime import datetime
 from typing import TYPE_CHECKING, Optional
 
 from sqlmodel import Field, Relationship, SQLModel
@@ -15,7 +16,8 @@ class User(SQLModel, table=True):
     name: str = Field(nullable=False)
     picture: Optional[str] = Field(default=None)
     google_token: str = Field(nullable=False)
-    google_token_expires: Optional[int] = Field(default=None)
+    # absolute expiry of google_token in UTC
+    google_token_expires_at: Optional[datetime] = Field(default=None)
     google_refresh_token: Optional[str] = Field(default=None)
 
     messages: list["ChatMessage"] = Relationship(back_populates="user", cascade_delete=True)
\ No newline at end of file
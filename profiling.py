@@ -0,0 +1,140 @@
+import asyncio
+import os
+import re
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Awaitable, Callable
+
+import logfire
+from pyinstrument import Profiler
+from pyinstrument.renderers import SpeedscopeRenderer
+from pyinstrument.session import Session
+from starlette.requests import Request
+from starlette.responses import Response
+
+from .models.user import User
+
+PROFILE_DIRECTORY = os.getenv("PROFILE_DIRECTORY", "profiles")
+PROFILE_SUFFIX = ".speedscope.json"
+ADMIN_EMAILS = {email.strip().lower() for email in os.getenv("ADMIN_EMAILS", "").split(",") if email.strip()}
+PROFILE_HEADER = "X-Profile"
+PROFILE_QUERY_PARAMETER = "profile"
+profiler_interval_seconds = 0.001
+
+# sessions recorded in worker threads of the request that is being profiled
+_thread_sessions: ContextVar[list[Session] | None] = ContextVar("profiling_thread_sessions", default=None)
+_unsafe_filename_characters = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+def is_admin(user: User) -> bool:
+    """ Check if a user may profile requests and download profiles, admins are configured through ADMIN_EMAILS """
+    return user.email.lower() in ADMIN_EMAILS
+
+
+def profiling_requested(request: Request) -> bool:
+    """ Check if the client asked for the request to be profiled """
+    return (
+        request.headers.get(PROFILE_HEADER, "").lower() in ("1", "true")
+        or request.query_params.get(PROFILE_QUERY_PARAMETER, "").lower() in ("1", "true")
+    )
+
+
+def _run_profiled(sessions: list[Session], function: Callable, *args, **kwargs):
+    """ Internal method to run a function under its own profiler, threads are not seen by the request's profiler """
+    profiler = Profiler(interval=profiler_interval_seconds, async_mode="disabled")
+    profiler.start()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        sessions.append(profiler.stop())
+
+
+async def to_thread(function: Callable, *args, **kwargs):
+    """
+    Run a blocking function in a worker thread, like asyncio.to_thread.
+
+    If the current request is being profiled, the function is profiled as well
+    and shows up in the request's profile.
+    """
+    sessions = _thread_sessions.get()
+    if sessions is None:
+        return await asyncio.to_thread(function, *args, **kwargs)
+    return await asyncio.to_thread(_run_profiled, sessions, function, *args, **kwargs)
+
+
+def _profile_filename(request: Request) -> str:
+    """ Internal method to build a unique, filesystem safe profile filename for a request """
+    path = _unsafe_filename_characters.sub("_", request.url.path.strip("/")) or "root"
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    return f"{timestamp}-{request.method}-{path}{PROFILE_SUFFIX}"
+
+
+def profiling_middleware(authenticate: Callable[[str], Awaitable[User]]):
+    """
+    Create a middleware that profiles requests of admins that ask for it.
+
+    Requests without the X-Profile header or profile query parameter pass straight through.
+    The profile is stored in PROFILE_DIRECTORY in the speedscope format.
+
+    Args:
+        authenticate: Resolves a bearer token to the user, raising if it is invalid.
+    """
+
+    async def middleware(request: Request, call_next) -> Response:
+        if not profiling_requested(request):
+            return await call_next(request)
+
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        try:
+            user = await authenticate(token) if scheme.lower() == "bearer" and token else None
+        except Exception:
+            user = None
+        if user is None or not is_admin(user):
+            logfire.warn("Ignoring profiling request of a non-admin")
+            return await call_next(request)
+
+        sessions: list[Session] = []
+        context_token = _thread_sessions.set(sessions)
+        profiler = Profiler(interval=profiler_interval_seconds, async_mode="enabled")
+        profiler.start()
+        try:
+            response = await call_next(request)
+        finally:
+            session = profiler.stop()
+            _thread_sessions.reset(context_token)
+            for thread_session in sessions:
+                session = Session.combine(session, thread_session)
+
+            os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+            filename = _profile_filename(request)
+            with open(os.path.join(PROFILE_DIRECTORY, filename), "w") as file:
+                file.write(SpeedscopeRenderer().render(session))
+            logfire.info("Stored request profile {filename}", filename=filename)
+        response.headers["X-Profile-Name"] = filename
+        return response
+
+    return middleware
+
+
+def list_profiles() -> list[dict]:
+    """ List the stored profiles, newest first """
+    if not os.path.isdir(PROFILE_DIRECTORY):
+        return []
+    profiles = []
+    for entry in os.scandir(PROFILE_DIRECTORY):
+        if entry.is_file() and entry.name.endswith(PROFILE_SUFFIX):
+            stat = entry.stat()
+            profiles.append({
+                'name': entry.name,
+                'size': stat.st_size,
+                'created': datetime.fromtimestamp(stat.st_mtime),
+            })
+    return sorted(profiles, key=lambda profile: profile['created'], reverse=True)
+
+
+def profile_path(name: str) -> str | None:
+    """ Get the path of a stored profile, None if there is no profile with that name """
+    if name != os.path.basename(name) or not name.endswith(PROFILE_SUFFIX):
+        return None
+    path = os.path.join(PROFILE_DIRECTORY, name)
+    return path if os.path.isfile(path) else None
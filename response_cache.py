@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+import logfire
+import torch
+from pydantic_ai.messages import ModelMessage, ModelResponse, ToolCallPart
+from sentence_transformers import util
+
+from .metrics import response_cache_lookups
+
+# only messages without conversation history use the cache, so it only pays off with CONVERSATION_CONTEXT_ENABLED=false
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+# "user" caches answers per user, "global" shares them between all users
+RESPONSE_CACHE_SCOPE = os.getenv("RESPONSE_CACHE_SCOPE", "user").lower()
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", 24 * 60 * 60))
+# a cached answer is served if the message is at least this similar to the cached one
+RESPONSE_CACHE_SIMILARITY_THRESHOLD = float(os.getenv("RESPONSE_CACHE_SIMILARITY_THRESHOLD", 0.95))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 10000))
+
+
+@dataclass
+class _CachedResponse:
+    message: str
+    embedding: torch.Tensor
+    response: str
+    expires_at: float
+
+
+def used_tools(messages: list[ModelMessage]) -> bool:
+    """ Check if the model called any tool in the given messages of a run """
+    return any(
+        isinstance(part, ToolCallPart)
+        for message in messages if isinstance(message, ModelResponse)
+        for part in message.parts
+    )
+
+
+class ResponseCache:
+    """
+    Cache of answers to messages that needed no tools, looked up by the similarity of message embeddings.
+
+    Answers that used a tool depend on the user's data or the current time and are never cached.
+    The key is the message alone, so get_ai_response only uses the cache for messages without conversation history.
+    With conversation context enabled, that is only the first message of a conversation, the cache is meant for
+    deployments with CONVERSATION_CONTEXT_ENABLED=false whose assistants answer standalone questions.
+    Entries expire after RESPONSE_CACHE_TTL_SECONDS, beyond RESPONSE_CACHE_MAX_ENTRIES the oldest are evicted.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # scope -> entries, oldest first
+        self._entries: dict[str, list[_CachedResponse]] = {}
+        self._size = 0
+
+    @staticmethod
+    def _scope(user_id: str) -> str:
+        return 'global' if RESPONSE_CACHE_SCOPE == 'global' else user_id
+
+    def _evict_expired(self, scope: str, now: float) -> list[_CachedResponse]:
+        """ Internal method to drop the expired entries of a scope, returns the remaining entries """
+        entries = self._entries.get(scope, [])
+        alive = [entry for entry in entries if entry.expires_at > now]
+        self._size -= len(entries) - len(alive)
+        if alive:
+            self._entries[scope] = alive
+        else:
+            self._entries.pop(scope, None)
+        return alive
+
+    def get(self, user_id: str, message_embedding: torch.Tensor) -> str | None:
+        """
+        Get the cached answer to a message similar to the given one.
+
+        Args:
+            user_id (str): The id of the user asking.
+            message_embedding (torch.Tensor): The bi encoder embedding of the message.
+
+        Returns:
+            str | None: The cached answer, None if no similar message was answered.
+        """
+        if not RESPONSE_CACHE_ENABLED:
+            return None
+        with self._lock:
+            entries = self._evict_expired(self._scope(user_id), time.monotonic())
+        if not entries:
+            response_cache_lookups.labels(result='miss').inc()
+            return None
+
+        embeddings = torch.stack([entry.embedding for entry in entries]).to(message_embedding.device)
+        similarities = util.cos_sim(message_embedding, embeddings)[0]
+        best = int(torch.argmax(similarities))
+        if float(similarities[best]) < RESPONSE_CACHE_SIMILARITY_THRESHOLD:
+            response_cache_lookups.labels(result='miss').inc()
+            return None
+        response_cache_lookups.labels(result='hit').inc()
+        logfire.info(
+            "Serving cached answer of a similar message",
+            similarity=round(float(similarities[best]), 3),
+            cached_message=entries[best].message,
+        )
+        return entries[best].response
+
+    def put(self, user_id: str, message: str, message_embedding: torch.Tensor, response: str) -> None:
+        """ Cache the answer to a message, only call this for answers that used no tools """
+        if not RESPONSE_CACHE_ENABLED or RESPONSE_CACHE_MAX_ENTRIES <= 0:
+            return
+        scope = self._scope(user_id)
+        with self._lock:
+            self._evict_expired(scope, time.monotonic())
+            self._entries.setdefault(scope, []).append(_CachedResponse(
+                message=message,
+                embedding=message_embedding.detach().cpu(),
+                response=response,
+                expires_at=time.monotonic() + RESPONSE_CACHE_TTL_SECONDS,
+            ))
+            self._size += 1
+            while self._size > RESPONSE_CACHE_MAX_ENTRIES:
+                # evict the entry that expires first, which is the oldest one
+                oldest_scope = min(self._entries, key=lambda entry_scope: self._entries[entry_scope][0].expires_at)
+                self._entries[oldest_scope].pop(0)
+                if not self._entries[oldest_scope]:
+                    del self._entries[oldest_scope]
+                self._size -= 1
+
+
+response_cache = ResponseCache()
@@ -1,14 +1,38 @@
 import base64
-import string
+import hashlib
+import html
+import os
+import re
+import threading
+from collections import OrderedDict
 
 import numpy as np
 from sentence_transformers import SentenceTransformer, CrossEncoder, util
-from sklearn.feature_extraction import _stop_words
-from rank_bm25 import BM25Okapi
 import logfire
 import torch
 
+from .bm25_index import BM25Index, bm25_tokenizer
+from .metrics import cross_encoder_cache_lookups, model_inference_duration, observe
+from .vector_index import VectorIndex
+
 num_top_hits = 5
+# number of calendar events kept when events are searched by a query
+num_event_hits = 10
+# number of candidates each first stage retriever contributes to the fusion
+top_k = 32
+bm25_top_k = 32
+# number of fused candidates that get scored by the cross encoder
+rerank_top_k = 16
+# smoothing constant of reciprocal rank fusion, 60 is the value from the original paper
+rrf_k = 60
+# skip reranking if the bi encoder already separates the top hits from the rest by this cosine margin
+rerank_skip_margin = 0.15
+# documents are truncated to this many bi encoder tokens during preprocessing
+max_document_tokens = 2048
+# documents longer than the encoder's max sequence length are split into overlapping chunks covering all of them
+chunk_overlap_tokens = 32
+# cached cross encoder scores, an entry takes about 300 bytes, 0 disables the cache
+CROSS_ENCODER_CACHE_MAX_ENTRIES = int(os.getenv("CROSS_ENCODER_CACHE_MAX_ENTRIES", 50000))
 
 
 if not torch.cuda.is_available():
@@ -16,128 +40,501 @@ if not torch.cuda.is_available():
 
 # use https://huggingface.co/cross-encoder/ms-marco-MiniLM-L6-v2
 bi_encoder = SentenceTransformer("multi-qa-MiniLM-L6-cos-v1")
-top_k = 32
-# TODO: potentially tweak
 
 cross_encoder = CrossEncoder("cross-encoder/ms-marco-MiniLM-L6-v2")
 
+_html_invisible_pattern = re.compile(r'<(script|style|head|title)\b.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+_html_comment_pattern = re.compile(r'<!--.*?-->', re.DOTALL)
+_html_block_pattern = re.compile(r'<(br|p|div|tr|li|h[1-6]|table|blockquote)\b[^>]*>|</(p|div|tr|li|h[1-6]|table|blockquote)\s*>', re.IGNORECASE)
+_html_tag_pattern = re.compile(r'<[^>]+>')
+_inline_whitespace_pattern = re.compile(r'[ \t\r\f\v\u00a0\u200c]+')
+_blank_lines_pattern = re.compile(r'\n\s*\n+')
+# the line introducing the quoted history of a reply, e.g. "On Mon, 5 May 2025, Jane <jane@example.com> wrote:"
+_reply_attribution_pattern = re.compile(r'^\s*(On\b.*\bwrote:|Am\b.*\bschrieb\b.*:)\s*$')
+_reply_attribution_start_pattern = re.compile(r'^\s*(On|Am)\b')
+_forwarded_header_pattern = re.compile(r'^\s*-{2,}\s*(Original Message|Ursprüngliche Nachricht)\s*-{2,}\s*$', re.IGNORECASE)
+_outlook_header_pattern = re.compile(r'^\s*(From|Von):\s')
+_outlook_header_field_pattern = re.compile(r'^\s*(Sent|Date|Gesendet|Datum|To|An|Subject|Betreff):\s')
+
 
-def bm25_tokenizer(text: str) -> list[str]:
+def reciprocal_rank_fusion(rankings: list[list[int]], k: int = rrf_k) -> list[int]:
     """
-    Tokenize a string using the BM25 algorithm.
+    Fuse multiple rankings of corpus ids into a single ranking.
+
+    Args:
+        rankings (list[list[int]]): Rankings of corpus ids, best first.
+        k (int): The smoothing constant, higher values flatten the influence of the top ranks.
+
+    Returns:
+        list[int]: The fused ranking of corpus ids, best first.
     """
-    tokenized_text = []
-    for token in text.lower().split():
-        token = token.strip(string.punctuation)
-        if len(token) > 0 and token not in _stop_words.ENGLISH_STOP_WORDS:
-            tokenized_text.append(token)
-    return tokenized_text
+    fused_scores: dict[int, float] = {}
+    for ranking in rankings:
+        for rank, corpus_id in enumerate(ranking):
+            fused_scores[corpus_id] = fused_scores.get(corpus_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(fused_scores, key=fused_scores.get, reverse=True)
+
 
+def _bm25_ranking(data: list[dict], query: str, limit: int, bm25_index: BM25Index | None) -> list[int]:
+    """ Internal method to get the ids of the best BM25 matches, documents without any matching term are left out """
+    if bm25_index is None:
+        bm25_index = BM25Index()
+        document_ids = [str(idx) for idx in range(len(data))]
+        bm25_index.add_documents(dict(zip(document_ids, [data_blob['data'] for data_blob in data])))
+    else:
+        document_ids = [data_blob['id'] for data_blob in data]
+        missing_documents = {
+            data_blob['id']: data_blob['data'] for data_blob in data if data_blob['id'] not in bm25_index
+        }
+        if missing_documents:
+            bm25_index.add_documents(missing_documents)
+    bm25_scores = bm25_index.get_scores(query, document_ids)
+    limit = min(limit, len(data))
+    top_n = np.argpartition(bm25_scores, -limit)[-limit:]
+    top_n = sorted(top_n, key=lambda idx: bm25_scores[idx], reverse=True)
+    return [int(idx) for idx in top_n if bm25_scores[idx] > 0]
+
+
+def _remove_superseded(data: list[dict], bm25_index: BM25Index | None, vector_index: VectorIndex | None) -> None:
+    """ Internal method to remove the documents listed under "superseded_ids" of the data from the persistent indexes """
+    superseded_ids = [document_id for data_blob in data for document_id in data_blob.get('superseded_ids', [])]
+    if bm25_index is not None:
+        bm25_index.remove_documents([document_id for document_id in superseded_ids if document_id in bm25_index])
+    if vector_index is not None:
+        chunk_ids = []
+        for document_id in superseded_ids:
+            chunk_idx = 0
+            while f"{document_id}#{chunk_idx}" in vector_index:
+                chunk_ids.append(f"{document_id}#{chunk_idx}")
+                chunk_idx += 1
+        vector_index.remove(chunk_ids)
+
+
+def _token_offsets(text: str) -> list[tuple[int, int]]:
+    """ Internal method to get the character offsets of the bi encoder tokens of a text """
+    encoding = bi_encoder.tokenizer(
+        text,
+        add_special_tokens=False,
+        return_offsets_mapping=True,
+        truncation=False,
+        verbose=False
+    )
+    return encoding['offset_mapping']
 
-def search(data: list[dict], query: str) -> list[dict]:
+
+def chunk_document(text: str, max_tokens: int = max_document_tokens) -> dict:
     """
-    Search for a query in the given data.
+    Truncate a document to max_tokens bi encoder tokens and split it into overlapping chunks
+    that fit into the encoder's max sequence length. The text is tokenized once for both.
 
-    param data: A list of dictionaries containing data to search.
-        - Each dictionary must contain a key named "data" that contains the data to search.
+    Args:
+        text (str): The document text.
+        max_tokens (int): The maximum number of tokens to keep.
+
+    Returns:
+        dict: The truncated text under "data" and its chunks, at least one, under "chunks".
     """
-    logfire.span("Refining search results...")
+    offsets = _token_offsets(text)
+    if len(offsets) > max_tokens:
+        logfire.debug("Truncating document of {tokens} tokens to {max_tokens}", tokens=len(offsets), max_tokens=max_tokens)
+        offsets = offsets[:max_tokens]
+        text = text[:offsets[-1][1]]
 
-    data_embedding = bi_encoder.encode(
-        [
-            data_blob['data'] for data_blob in data # TODO unsure
-        ],
-        convert_to_tensor=True,
-        show_progress_bar=True
-    )
+    # leave room for the special tokens the encoder adds
+    chunk_tokens = bi_encoder.max_seq_length - 2
+    if len(offsets) <= chunk_tokens:
+        return {'data': text, 'chunks': [text]}
 
-    tokenized_data = []
-    for data_node in data:
-        tokenized_data.append(bm25_tokenizer(data_node['data']))
-    bm25 = BM25Okapi(tokenized_data)
+    chunks = []
+    stride = chunk_tokens - chunk_overlap_tokens
+    for start in range(0, len(offsets), stride):
+        end = min(start + chunk_tokens, len(offsets))
+        chunks.append(text[offsets[start][0]:offsets[end - 1][1]])
+        if end == len(offsets):
+            break
+    return {'data': text, 'chunks': chunks}
 
-    bm25_scores = bm25.get_scores(bm25_tokenizer(query))
-    top_n = np.argpartition(bm25_scores, -5)[-5:] #TODO maybe tweak 2
-    bm25_hits = [{'data_id': idx, 'score': bm25_scores[idx]} for idx in top_n]
-    bm25_hits = sorted(bm25_hits, key=lambda x: x['score'], reverse=True)
 
-    query_embedding = bi_encoder.encode(query, convert_to_tensor=True)
+def _dense_scores(
+        data: list[dict],
+        query: str,
+        vector_index: VectorIndex | None = None
+) -> tuple[torch.Tensor, list[str]]:
+    """
+    Internal method to get the bi encoder cosine similarity of the query to every document.
+
+    Long documents are encoded in chunks, a document scores as its best chunk.
+    The chunks of preprocessed documents are reused, other documents are chunked here.
+    With a vector index, only chunks missing from it are encoded and added.
+    Returns the scores and the best chunk of each document.
+    """
+    corpus = [data_blob['data'] for data_blob in data]
+    chunks = []
+    chunk_ids = []
+    chunk_owners = []
+    for document_idx, data_blob in enumerate(data):
+        document_chunks = data_blob.get('chunks') or chunk_document(data_blob['data'])['chunks']
+        for chunk_idx, chunk in enumerate(document_chunks):
+            chunks.append(chunk)
+            chunk_owners.append(document_idx)
+            if vector_index is not None:
+                chunk_ids.append(f"{data[document_idx]['id']}#{chunk_idx}")
+
+    with observe(model_inference_duration, model='bi_encoder'):
+        if vector_index is None:
+            data_embedding = bi_encoder.encode(
+                chunks,
+                convert_to_tensor=True,
+                show_progress_bar=False
+            )
+        else:
+            missing = [idx for idx, chunk_id in enumerate(chunk_ids) if chunk_id not in vector_index]
+            if missing:
+                embeddings = bi_encoder.encode(
+                    [chunks[idx] for idx in missing],
+                    convert_to_numpy=True,
+                    show_progress_bar=False
+                )
+                vector_index.add({chunk_ids[idx]: embedding for idx, embedding in zip(missing, embeddings)})
+            logfire.debug("Encoded {missing} of {count} chunks", missing=len(missing), count=len(chunks))
+            data_embedding = torch.from_numpy(vector_index.get_vectors(chunk_ids))
+        query_embedding = bi_encoder.encode(query, convert_to_tensor=True)
     if torch.cuda.is_available():
         query_embedding = query_embedding.cuda()
-    else:
-        logfire.warn("CUDA is not available. Might be slow...")
-    hits = util.semantic_search(query_embedding, data_embedding, top_k=top_k)
-    hits = hits[0]
+    data_embedding = data_embedding.to(query_embedding.device)
+    chunk_scores = util.cos_sim(query_embedding, data_embedding)[0]
+
+    owners = torch.tensor(chunk_owners, device=chunk_scores.device)
+    document_scores = torch.full((len(corpus),), -1.0, device=chunk_scores.device)
+    document_scores = document_scores.scatter_reduce(0, owners, chunk_scores, reduce='amax')
+
+    best_chunks = list(corpus)
+    best_chunk_scores = [-1.0] * len(corpus)
+    for chunk, document_idx, score in zip(chunks, chunk_owners, chunk_scores.tolist()):
+        if score > best_chunk_scores[document_idx]:
+            best_chunk_scores[document_idx] = score
+            best_chunks[document_idx] = chunk
+    return document_scores, best_chunks
+
+
+class _ScoreCache:
+    """ Internal thread safe LRU cache of cross encoder scores """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._scores: OrderedDict[tuple[bytes, bytes], float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple[bytes, bytes]) -> float | None:
+        with self._lock:
+            score = self._scores.get(key)
+            if score is not None:
+                self._scores.move_to_end(key)
+            return score
+
+    def put(self, key: tuple[bytes, bytes], score: float) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._scores[key] = score
+            self._scores.move_to_end(key)
+            while len(self._scores) > self.max_entries:
+                self._scores.popitem(last=False)
+
+
+_cross_encoder_cache = _ScoreCache(CROSS_ENCODER_CACHE_MAX_ENTRIES)
+
+
+def _content_hash(text: str) -> bytes:
+    """ Internal method to hash a text for the score cache """
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+
+def _cross_encoder_scores(query: str, documents: list[str]) -> list[float]:
+    """
+    Internal method to score documents against a query with the cross encoder.
+
+    Scores are cached by the hash of the normalized query and the hash of the document,
+    only pairs missing from the cache are scored by the model.
+    """
+    # the cross encoder is uncased, so queries differing in case and whitespace only score the same
+    query_hash = _content_hash(' '.join(query.lower().split()))
+    keys = [(query_hash, _content_hash(document)) for document in documents]
+    scores = [_cross_encoder_cache.get(key) for key in keys]
+    missing = [idx for idx, score in enumerate(scores) if score is None]
+    cross_encoder_cache_lookups.labels(result='hit').inc(len(documents) - len(missing))
+    cross_encoder_cache_lookups.labels(result='miss').inc(len(missing))
+
+    if missing:
+        with observe(model_inference_duration, model='cross_encoder'):
+            missing_scores = cross_encoder.predict(
+                [[query, documents[idx]] for idx in missing],
+                show_progress_bar=False
+            ).tolist()
+        for idx, score in zip(missing, missing_scores):
+            scores[idx] = score
+            _cross_encoder_cache.put(keys[idx], score)
+    logfire.debug(
+        "Reranked {count} candidates, {cached} from cache",
+        count=len(documents),
+        cached=len(documents) - len(missing),
+    )
+    return scores
+
+
+def _is_decisive(shortlist: list[int], dense_scores: torch.Tensor, num_hits: int, margin: float) -> bool:
+    """ Internal method to check if the bi encoder scores already clearly separate the top hits from the rest """
+    top_hits = shortlist[:num_hits]
+    remaining = shortlist[num_hits:]
+    if not remaining:
+        return True
+    weakest_top_hit = min(float(dense_scores[idx]) for idx in top_hits)
+    strongest_remaining = max(float(dense_scores[idx]) for idx in remaining)
+    return weakest_top_hit - strongest_remaining >= margin
+
+
+def search(
+        data: list[dict],
+        query: str,
+        num_hits: int = num_top_hits,
+        bm25_index: BM25Index | None = None,
+        vector_index: VectorIndex | None = None,
+        rerank_candidates: int = rerank_top_k,
+        skip_margin: float = rerank_skip_margin
+) -> list[dict]:
+    """
+    Search for a query in the given data.
+
+    BM25 and bi encoder candidates are fused with reciprocal rank fusion, and only the fused shortlist is
+    reranked by the cross encoder. Reranking is skipped for corpora that are not larger than num_hits
+    and when the bi encoder scores are already decisive.
+    Documents longer than the encoder's max sequence length are encoded in chunks,
+    each document is scored and reranked by its best chunk.
 
-    ### RERANKING ###
-    cross_input = [[query, data[hit['corpus_id']]['data']] for hit in hits]
-    cross_scores = cross_encoder.predict(cross_input)
-    for idx in range(len(cross_scores)):
-        hits[idx]['cross_score'] = cross_scores[idx] # TODO need .tolist() ?
+    param data: A list of dictionaries containing data to search.
+        - Each dictionary must contain a key named "data" that contains the data to search.
+    param query: The search query.
+    param num_hits: The maximum number of results.
+    param bm25_index: A persistent BM25 index to score with, documents missing from it are added.
+        - Requires every dictionary to contain a unique "id" key.
+        Defaults to a temporary index over the given data.
+    param vector_index: A persistent index of chunk embeddings, chunks missing from it are encoded and added.
+        - Requires every dictionary to contain a unique "id" key, the text of an id must not change.
+        Defaults to encoding every chunk.
+    Dictionaries may list the ids of documents they replace under "superseded_ids",
+    these are removed from the persistent indexes.
+    param rerank_candidates: The number of fused candidates that get reranked by the cross encoder.
+    param skip_margin: The bi encoder score margin above which reranking is skipped.
+    """
+    if not data:
+        return []
+
+    with logfire.span("Refining search results...", corpus_size=len(data)):
+        corpus = [data_blob['data'] for data_blob in data]
 
-    top_hits_bm25 = bm25_hits[:num_top_hits]
-    top_hits_bi_encoder = sorted(hits, key=lambda x: x['score'], reverse=True)[:num_top_hits]
-    top_hits_cross = sorted(hits, key=lambda x: x['cross_score'], reverse=True)[:num_top_hits]
+        _remove_superseded(data, bm25_index, vector_index)
+        bm25_ranking = _bm25_ranking(data, query, bm25_top_k, bm25_index)
+        dense_scores, best_chunks = _dense_scores(data, query, vector_index)
+        dense_top = torch.topk(dense_scores, k=min(top_k, len(corpus)))
+        dense_ranking = [int(idx) for idx in dense_top.indices]
 
-    out_data = []
+        fused_ranking = reciprocal_rank_fusion([bm25_ranking, dense_ranking])
 
-    logfire.span("Results:", _level='debug')
-    logfire.span("BM25 top hits:", _level='debug')
-    for idx, hit in enumerate(top_hits_bm25):
-        logfire.debug(f"{idx+1}. {data[hit['data_id']]} ({hit['score']})")
-    logfire.span("Bi-Encoder top hits:", _level='debug')
-    for idx, hit in enumerate(top_hits_bi_encoder):
-        logfire.debug(f"{idx+1}. {data[hit['corpus_id']]} ({hit['score']})")
-    logfire.span("Cross Encoder top hits:", _level='debug')
-    for idx, hit in enumerate(top_hits_cross):
-        logfire.debug(f"{idx+1}. {data[hit['corpus_id']]} ({hit['cross_score']})")
-        out_data.append(data[hit['corpus_id']])
+        if len(data) <= num_hits:
+            logfire.debug("Corpus is not larger than the number of hits, skipping reranking")
+            return [data[idx] for idx in fused_ranking[:num_hits]]
 
-    return out_data
+        shortlist = fused_ranking[:max(rerank_candidates, num_hits)]
+        if _is_decisive(shortlist, dense_scores, num_hits, skip_margin):
+            logfire.debug("Bi encoder scores are decisive, skipping reranking")
+            return [data[idx] for idx in shortlist[:num_hits]]
+
+        ### RERANKING ###
+        cross_scores = _cross_encoder_scores(query, [best_chunks[idx] for idx in shortlist])
+        reranked = sorted(zip(shortlist, cross_scores), key=lambda hit: hit[1], reverse=True)
+
+        return [data[idx] for idx, _ in reranked[:num_hits]]
 
 
 def decode_base64url(data):
     """Decode base64url to string."""
-    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4)).decode('utf-8')
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4)).decode('utf-8', errors='replace')
+
+
+def html_to_text(html_body: str) -> str:
+    """
+    Convert an HTML document to plain text, dropping scripts, styles and markup.
+    """
+    text = _html_comment_pattern.sub('', html_body)
+    text = _html_invisible_pattern.sub('', text)
+    text = _html_block_pattern.sub('\n', text)
+    text = _html_tag_pattern.sub('', text)
+    text = html.unescape(text)
+    text = _inline_whitespace_pattern.sub(' ', text)
+    return _blank_lines_pattern.sub('\n\n', text).strip()
+
+
+def _find_body_parts(part: dict, bodies: dict[str, str]) -> None:
+    """ Internal method to walk a MIME part tree depth first and collect the first text/plain and text/html body """
+    mime_type = part.get('mimeType', '')
+    if mime_type.startswith('multipart/'):
+        for child in part.get('parts', []):
+            _find_body_parts(child, bodies)
+            if 'text/plain' in bodies:
+                return
+        return
+    # skip attachments, their content would have to be fetched separately anyway
+    if part.get('filename'):
+        return
+    if mime_type in ('text/plain', 'text/html') and mime_type not in bodies:
+        body_data = part.get('body', {}).get('data')
+        if body_data:
+            bodies[mime_type] = decode_base64url(body_data)
+
+
+def get_email_body(payload: dict) -> str | None:
+    """
+    Get the plain text body of an e-mail payload.
+
+    Walks nested multipart payloads as well as single part messages,
+    prefers text/plain and falls back to the text of the text/html part.
+
+    Args:
+        payload (dict): The payload of a message from the Gmail API.
+
+    Returns:
+        str | None: The body text or None if the message has no text body.
+    """
+    bodies: dict[str, str] = {}
+    _find_body_parts(payload, bodies)
+    if bodies.get('text/plain', '').strip():
+        return bodies['text/plain'].strip()
+    if 'text/html' in bodies:
+        return html_to_text(bodies['text/html'])
+    return None
+
+
+def strip_quoted_text(body: str) -> str:
+    """
+    Remove the quoted history from the body of a reply.
+
+    Lines quoted with ">" are dropped, and everything from the first reply attribution
+    ("On ... wrote:") or Outlook style header block onwards is cut off.
+    """
+    lines = body.splitlines()
+    kept_lines = []
+    for idx, line in enumerate(lines):
+        next_line = lines[idx + 1] if idx + 1 < len(lines) else ''
+        if (
+                _reply_attribution_pattern.match(line)
+                # attributions with long names are wrapped by some clients
+                or (_reply_attribution_start_pattern.match(line) and _reply_attribution_pattern.match(f'{line} {next_line}'))
+                or _forwarded_header_pattern.match(line)
+                or (_outlook_header_pattern.match(line) and _outlook_header_field_pattern.match(next_line))
+        ):
+            break
+        if not line.lstrip().startswith('>'):
+            kept_lines.append(line)
+    return '\n'.join(kept_lines).strip()
+
+
+def _email_headers(email: dict) -> dict[str, str]:
+    """ Internal method to get the headers of an e-mail by name """
+    return {pair['name']: pair['value'] for pair in email['payload'].get('headers', [])}
 
 
 def preprocess_emails(emails: list[dict]) -> list[dict]:
     """
     Preprocess e-mails for search.
+
+    Bodies are converted to plain text, documents are truncated to max_document_tokens bi encoder tokens
+    and chunked for the bi encoder, see chunk_document.
     """
     preprocessed_emails = []
     for email in emails:
-        subject = [pair['value'] for pair in email['payload']['headers'] if pair['name'] == 'Subject'][0]
-        sender = [pair['value'] for pair in email['payload']['headers'] if pair['name'] == 'From'][0]
-        if not email['payload']:
+        if not email.get('payload'):
             logfire.warn("No payload found in email.")
             continue
+        headers = _email_headers(email)
+        subject = headers.get('Subject', '')
+        sender = headers.get('From', '')
 
-        plain_body = None
-        html_body = None
-        if not email['payload'].get('parts'):
-            logfire.warn("No parts found in email.")
-            continue
-        for part in email['payload']['parts']:
-            if part['mimeType'] == 'text/plain':
-                plain_body_encoded = part['body']['data']
-                plain_body = decode_base64url(plain_body_encoded)
-                break
-            if part['mimeType'] == 'text/html':
-                html_body_encoded = part['body']['data']
-                html_body = decode_base64url(html_body_encoded)
-                break
-        if not plain_body and not html_body:
+        body = get_email_body(email['payload'])
+        if not body:
             logfire.warn("No plain text or HTML body found in email.")
-            continue
+            body = email.get('snippet', '')
 
         preprocessed_emails.append({
-            'data':
+            **chunk_document(
                 f'from: {sender}'
                 f'\n\n'
                 f'subject: {subject}'
                 f'\n\n'
-                f'body: {plain_body or html_body or email["snippet"]}',
+                f'body: {body}'
+            ),
             'id': email['id']
         })
-    return preprocessed_emails
\ No newline at end of file
+    return preprocessed_emails
+
+
+def preprocess_threads(threads: list[dict]) -> list[dict]:
+    """
+    Preprocess e-mail threads for search, each thread becomes one document.
+
+    The quoted history is stripped from every message, so text repeated in replies is only indexed once.
+    Messages are listed newest first, so truncating a long thread drops its oldest messages.
+    The document is identified by the latest message of the thread, the one to read for details.
+    The documents of the thread under its earlier messages, indexed before the latest replies, are superseded.
+    """
+    preprocessed_threads = []
+    for thread in threads:
+        messages = [message for message in thread.get('messages', []) if message.get('payload')]
+        if not messages:
+            logfire.warn("No messages found in thread.")
+            continue
+        subject = _email_headers(messages[0]).get('Subject', '')
+
+        bodies = []
+        for message in reversed(messages):
+            body = get_email_body(message['payload']) or message.get('snippet', '')
+            bodies.append(f"{_email_headers(message).get('From', '')}: {strip_quoted_text(body)}")
+        text = '\n\n'.join(bodies)
+
+        preprocessed_threads.append({
+            **chunk_document(
+                f'subject: {subject}'
+                f'\n\n'
+                f'messages: {text}'
+            ),
+            'id': messages[-1]['id'],
+            'thread_id': thread['id'],
+            'superseded_ids': [message['id'] for message in thread['messages'] if message['id'] != messages[-1]['id']],
+        })
+    return preprocessed_threads
+
+
+def preprocess_events(events: list[dict]) -> list[dict]:
+    """
+    Preprocess calendar events for search.
+
+    Each result keeps the original event under the "event" key, so search hits can be mapped back to it.
+    """
+    preprocessed_events = []
+    for event in events:
+        attendees = ', '.join(
+            attendee.get('displayName') or attendee.get('email', '') for attendee in event.get('attendees') or []
+        )
+        preprocessed_events.append({
+            **chunk_document(
+                f'summary: {event.get("summary") or ""}'
+                f'\n\n'
+                f'location: {event.get("location") or ""}'
+                f'\n\n'
+                f'attendees: {attendees}'
+                f'\n\n'
+                f'description: {event.get("description") or ""}'
+            ),
+            'id': event.get('id'),
+            'event': event,
+        })
+    return preprocessed_events
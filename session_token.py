@@ -0,0 +1,32 @@
+import os
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+if not os.getenv("SECRET_KEY"):
+    raise ValueError("SECRET_KEY must be set")
+
+# how long a login stays valid, the Google access token of the user is refreshed independently
+SESSION_MAX_AGE_SECONDS = int(os.getenv("SESSION_MAX_AGE_SECONDS", 30 * 24 * 60 * 60))
+
+_serializer = URLSafeTimedSerializer(os.getenv("SECRET_KEY"), salt="session-token")
+
+
+def issue_session_token(user_id: str) -> str:
+    """ Issue the bearer token the frontend authenticates with, signed with SECRET_KEY """
+    return _serializer.dumps({'user_id': user_id})
+
+
+def verify_session_token(token: str) -> str | None:
+    """
+    Verify a session token of issue_session_token.
+
+    Args:
+        token (str): The bearer token.
+
+    Returns:
+        str | None: The id of the user, None if the token is invalid or expired.
+    """
+    try:
+        return _serializer.loads(token, max_age=SESSION_MAX_AGE_SECONDS)['user_id']
+    except (BadSignature, KeyError, TypeError):
+        return None
@@ -0,0 +1,16 @@
+import os
+
+
+def user_data_directory(user_id: str) -> str:
+    """
+    Get the directory where local data (indexes, caches) of a user is stored, creating it if necessary.
+
+    Args:
+        user_id (str): The id of the user.
+
+    Returns:
+        str: The path of the user's data directory.
+    """
+    directory = os.path.join(os.getenv("USER_DATA_DIRECTORY", "user_data"), user_id)
+    os.makedirs(directory, exist_ok=True)
+    return directory
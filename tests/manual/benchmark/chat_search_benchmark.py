@@ -0,0 +1,102 @@
+import importlib
+import os
+import statistics
+import sys
+import time
+
+from sqlalchemy import text
+from sqlmodel import Session
+
+# the backend modules use relative imports, so import them through the repository's package
+REPOSITORY_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+sys.path.insert(0, os.path.dirname(REPOSITORY_ROOT))
+PACKAGE = os.path.basename(REPOSITORY_ROOT)
+database = importlib.import_module(f"{PACKAGE}.database")
+# the relationships of the models only resolve once all of them are imported
+importlib.import_module(f"{PACKAGE}.models.user")
+chat_search = importlib.import_module(f"{PACKAGE}.chat_search")
+
+# run against a scratch Postgres database migrated to head, the benchmark fills chat_message with seeded rows
+MESSAGE_COUNT = int(os.getenv("CHAT_SEARCH_BENCHMARK_MESSAGES", 1_000_000))
+USER_COUNT = 1_000
+QUERIES = ['meeting', 'dentist appointment', '"project review"', 'invoice -paid', 'flight or train', 'zebra']
+REPETITIONS = 20
+PAGE_SIZE = 20
+BENCHMARK_USER_PREFIX = 'chat-search-benchmark-'
+
+VOCABULARY = [
+    'meeting', 'calendar', 'email', 'reply', 'tomorrow', 'today', 'week', 'project', 'review', 'invoice',
+    'paid', 'flight', 'train', 'hotel', 'dentist', 'appointment', 'lunch', 'dinner', 'team', 'report',
+    'deadline', 'budget', 'contract', 'draft', 'send', 'schedule', 'move', 'cancel', 'confirm', 'remind',
+]
+
+
+def seed(db_session: Session) -> None:
+    """ Insert MESSAGE_COUNT messages of random words from VOCABULARY, spread over USER_COUNT users """
+    existing = db_session.exec(text(
+        "SELECT count(*) FROM chat_message WHERE user_id LIKE :prefix"
+    ).bindparams(prefix=f"{BENCHMARK_USER_PREFIX}%")).one()[0]
+    if existing >= MESSAGE_COUNT:
+        return
+    print(f"Seeding {MESSAGE_COUNT - existing} messages, this takes a while")
+    db_session.exec(text(
+        'INSERT INTO "user" (id, email, username, name, google_token) '
+        "SELECT :prefix || n, :prefix || n || '@example.com', :prefix || n, 'Benchmark', '' "
+        'FROM generate_series(1, :users) AS n ON CONFLICT DO NOTHING'
+    ).bindparams(prefix=BENCHMARK_USER_PREFIX, users=USER_COUNT))
+    db_session.exec(text(
+        'INSERT INTO chat_message (message, sender, send_time, user_id) '
+        "SELECT (SELECT string_agg((CAST(:vocabulary AS text[]))[1 + floor(random() * :words)::int], ' ') "
+        '        FROM generate_series(1, 10 + n % 30)), '
+        "    CASE WHEN n % 2 = 0 THEN 'user' ELSE 'ai-assistant' END, now(), "
+        '    :prefix || (1 + n % :users) '
+        'FROM generate_series(1, :count) AS n'
+    ).bindparams(
+        vocabulary=VOCABULARY, words=len(VOCABULARY), prefix=BENCHMARK_USER_PREFIX,
+        users=USER_COUNT, count=MESSAGE_COUNT - existing,
+    ))
+    db_session.commit()
+    db_session.exec(text('ANALYZE chat_message'))
+
+
+def timed_search(db_session: Session, user_id: str, query: str, cursor: str | None) -> tuple[float, dict]:
+    start = time.perf_counter()
+    page = chat_search.search_chat_messages(db_session, user_id, query, PAGE_SIZE, cursor)
+    return (time.perf_counter() - start) * 1000, page
+
+
+def main():
+    with Session(database.engine) as db_session:
+        seed(db_session)
+        user_id = f"{BENCHMARK_USER_PREFIX}1"
+        print(
+            f"{MESSAGE_COUNT} messages of {USER_COUNT} users, {REPETITIONS} runs per query, "
+            f"up to {chat_search.chat_search_max_ranked} matches ranked"
+        )
+        print(f"{'query':>22} {'page':>5} {'results':>8} {'p50 ms':>7} {'p95 ms':>7}")
+        for query in QUERIES:
+            cursor = None
+            # the first page and the third, which is reached through keyset cursors
+            for page_number in range(1, 4):
+                latencies = []
+                for _ in range(REPETITIONS):
+                    latency, page = timed_search(db_session, user_id, query, cursor)
+                    latencies.append(latency)
+                if page_number in (1, 3):
+                    print(
+                        f"{query:>22} {page_number:>5} {len(page['results']):>8} "
+                        f"{statistics.median(latencies):>7.2f} {statistics.quantiles(latencies, n=20)[-1]:>7.2f}"
+                    )
+                cursor = page['next_cursor']
+                if cursor is None:
+                    break
+
+        # the plan should combine the GIN index on message_search with the user_id index
+        statement = chat_search._search_statement(user_id, 'meeting', PAGE_SIZE).compile(database.engine)
+        plan = db_session.connection().exec_driver_sql(f"EXPLAIN ANALYZE {statement}", statement.params).all()
+        print()
+        print('\n'.join(row[0] for row in plan))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import timeit
+
+import logfire
+
+import log_policy
+
+EVENT_COUNT = 300
+REPETITIONS = 50
+
+
+def generate_events(count: int) -> list[dict]:
+    return [
+        {
+            'id': f'event{idx}',
+            'summary': f'Weekly sync {idx}',
+            'description': 'Agenda: status updates, blockers and planning for the next sprint. ' * 5,
+            'start': {'dateTime': '2025-05-05T10:00:00+02:00'},
+            'end': {'dateTime': '2025-05-05T11:00:00+02:00'},
+            'attendees': [{'email': f'person{n}@example.com', 'responseStatus': 'accepted'} for n in range(10)],
+            'location': 'Meeting room 3',
+            'recurrence': None,
+        }
+        for idx in range(count)
+    ]
+
+
+def log_eagerly(events: list[dict]) -> None:
+    """ The logging fetch_google_calendar_events used to do per request """
+    items = {'items': events}
+    calendar_id = 'primary'
+    logfire.info(f"Fetched events from calendar {calendar_id}")
+    logfire.info(f"Got {items}")
+    logfire.info(f"Got items data: {items}")
+    logfire.info(f"Fetched {len(events)} events from all calendars.")
+    with logfire.span(f"Returning {len(events)} events."):
+        for event in events:
+            logfire.info(f"Event ID: {event['id']}, Summary: {event['summary']}, Start: {event['start']}, End: {event['end']}")
+
+
+def log_with_policy(events: list[dict]) -> None:
+    """ The logging fetch_google_calendar_events does now """
+    logfire.debug("Fetched {count} events from calendar {calendar_id}", count=len(events), calendar_id='primary')
+    log_policy.log_payload("Calendar events of {calendar_id}", events, calendar_id='primary')
+    logfire.info("Fetched {count} events from all calendars.", count=len(events))
+    log_policy.log_payload("Returning {count} events", events, count=len(events))
+
+
+def main():
+    logfire.configure(send_to_logfire=False, console=False)
+    events = generate_events(EVENT_COUNT)
+
+    eager_seconds = timeit.timeit(lambda: log_eagerly(events), number=REPETITIONS) / REPETITIONS
+    results = [f"eager f-strings:           {eager_seconds * 1000:.2f} ms"]
+    for mode in ('off', 'sampled', 'full'):
+        log_policy.LOG_PAYLOADS = mode
+        policy_seconds = timeit.timeit(lambda: log_with_policy(events), number=REPETITIONS) / REPETITIONS
+        results.append(f"policy LOG_PAYLOADS={mode + ':':<8} {policy_seconds * 1000:.2f} ms")
+
+    print(f"{EVENT_COUNT} calendar events, CPU time per request, mean of {REPETITIONS} runs")
+    for result in results:
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import importlib
+import os
+import sys
+import time
+
+import numpy as np
+
+# the backend modules use relative imports, so import them through the repository's package
+REPOSITORY_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+sys.path.insert(0, os.path.dirname(REPOSITORY_ROOT))
+vector_index = importlib.import_module(f"{os.path.basename(REPOSITORY_ROOT)}.vector_index")
+
+# the dimension of the bi encoder embeddings
+DIMENSION = 384
+CORPUS_SIZES = [1_000, 20_000, 100_000, 200_000]
+QUERY_COUNT = 100
+K = 10
+STORAGE_CORPUS_SIZE = 100_000
+
+
+def generate_embeddings(rng: np.random.Generator, topics: np.ndarray, count: int) -> np.ndarray:
+    """ Synthetic embeddings clustered around topics, like e-mails of a mailbox """
+    return topics[rng.integers(0, len(topics), count)] + rng.normal(scale=0.7, size=(count, DIMENSION))
+
+
+def timed_searches(index, queries: np.ndarray) -> float:
+    """ The mean latency of a search in milliseconds """
+    start = time.perf_counter()
+    for query in queries:
+        index.search(query, K)
+    return (time.perf_counter() - start) / len(queries) * 1000
+
+
+def storage_report(rng: np.random.Generator, topics: np.ndarray, queries: np.ndarray) -> None:
+    """ Memory and recall of the storage types, against exact float32 search, at STORAGE_CORPUS_SIZE vectors """
+    embeddings = generate_embeddings(rng, topics, STORAGE_CORPUS_SIZE)
+    vectors = {f'{idx}#0': embedding for idx, embedding in enumerate(embeddings)}
+    indexes = {}
+    for dtype in vector_index.STORAGE_DTYPES:
+        indexes[dtype] = vector_index.VectorIndex(dtype=dtype)
+        indexes[dtype].add(vectors)
+
+    print(f"{STORAGE_CORPUS_SIZE} vectors, one per e-mail with a single chunk")
+    print(f"{'storage':>8} {'MiB':>7} {'search ms':>9} {'recall@10':>10}")
+    for dtype, index in indexes.items():
+        print(
+            f"{dtype:>8} {index.nbytes / 2 ** 20:>7.1f} {timed_searches(index, queries):>9.2f} "
+            f"{vector_index.measure_recall(index, indexes['float32'], queries, K):>10.3f}"
+        )
+    print()
+
+
+def main():
+    rng = np.random.default_rng(0)
+    topics = rng.normal(size=(500, DIMENSION))
+    queries = generate_embeddings(rng, topics, QUERY_COUNT)
+    storage_report(rng, topics, queries)
+    print(f"{'vectors':>8} {'MiB':>7} {'build s':>8} {'search ms':>9}")
+    for size in CORPUS_SIZES:
+        embeddings = generate_embeddings(rng, topics, size)
+        start = time.perf_counter()
+        index = vector_index.VectorIndex()
+        # documents arrive in batches, as they are searched for the first time
+        for offset in range(0, size, 5_000):
+            index.add({f'{idx}#0': embeddings[idx] for idx in range(offset, min(offset + 5_000, size))})
+        build_seconds = time.perf_counter() - start
+        print(f"{size:>8} {index.nbytes / 2 ** 20:>7.1f} {build_seconds:>8.1f} {timed_searches(index, queries):>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
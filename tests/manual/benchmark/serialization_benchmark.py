@@ -0,0 +1,62 @@
+import gzip
+import json
+import timeit
+from datetime import datetime, timedelta
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+# MUST IMPORT ALL MODELS, OTHERWISE RELATIONSHIPS WILL NOT WORK
+from models.user import User
+from models.chat_message import ChatMessage
+from models.chat_message_read import ChatMessageRead
+
+MESSAGE_COUNT = 5000
+REPETITIONS = 20
+
+
+def generate_rows(count: int) -> list[dict]:
+    start_time = datetime(2025, 1, 1)
+    return [
+        {
+            'id': idx,
+            'message': f"This is chat message number {idx}, it is about as long as a typical assistant answer. " * 3,
+            'sender': 'user' if idx % 2 == 0 else 'ai-assistant',
+            'send_time': start_time + timedelta(minutes=idx),
+        }
+        for idx in range(count)
+    ]
+
+
+def serialize_models(messages: list[ChatMessage]) -> bytes:
+    """ What FastAPI does for response_model=list[ChatMessage]: validate, encode, dump """
+    validated = TypeAdapter(list[ChatMessage]).validate_python(messages, from_attributes=True)
+    return json.dumps(jsonable_encoder(validated)).encode()
+
+
+def serialize_rows(rows: list[dict]) -> bytes:
+    """ What get_chat_history does: dump the column-only rows with orjson """
+    return orjson.dumps(rows)
+
+
+def main():
+    rows = generate_rows(MESSAGE_COUNT)
+    messages = [ChatMessage(user_id='benchmark-user', **row) for row in rows]
+
+    models_seconds = timeit.timeit(lambda: serialize_models(messages), number=REPETITIONS) / REPETITIONS
+    rows_seconds = timeit.timeit(lambda: serialize_rows(rows), number=REPETITIONS) / REPETITIONS
+    body = serialize_rows(rows)
+    compressed_body = gzip.compress(body, compresslevel=5)
+
+    # make sure the DTO describes exactly what is sent
+    TypeAdapter(list[ChatMessageRead]).validate_json(body)
+
+    print(f"{MESSAGE_COUNT} messages, mean of {REPETITIONS} runs")
+    print(f"SQLModel + response_model: {models_seconds * 1000:.2f} ms")
+    print(f"column rows + orjson:      {rows_seconds * 1000:.2f} ms ({models_seconds / rows_seconds:.1f}x faster)")
+    print(f"body size: {len(body) / 1024:.0f} KiB, gzip: {len(compressed_body) / 1024:.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
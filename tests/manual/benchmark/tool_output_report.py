@@ -0,0 +1,79 @@
+import importlib
+import json
+import os
+import sys
+
+# the backend modules use relative imports, so import them through the repository's package
+REPOSITORY_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+sys.path.insert(0, os.path.dirname(REPOSITORY_ROOT))
+tool_compaction = importlib.import_module(f"{os.path.basename(REPOSITORY_ROOT)}.tool_compaction")
+
+
+def estimate_tokens(value) -> int:
+    """ Rough token estimate of a tool result as the model sees it, about four characters per token """
+    return len(json.dumps(value, default=str)) // 4
+
+
+def generate_events(count: int) -> list[dict]:
+    """ Events shaped like the result of fetch_google_calendar_events """
+    return [
+        {
+            'id': f'7q4k2m9v0c8s1l5n3b6x{idx:04d}',
+            'summary': f'Project sync {idx}',
+            'description': 'Agenda:\n- status updates\n- blockers\n- planning for the next sprint\n' * 8,
+            'start': {'dateTime': '2025-05-05T10:00:00+02:00', 'timeZone': 'Europe/Berlin'},
+            'end': {'dateTime': '2025-05-05T11:00:00+02:00', 'timeZone': 'Europe/Berlin'},
+            'attendees': [
+                {'email': f'person{n}@example.com', 'displayName': f'Person {n}', 'responseStatus': 'accepted'}
+                for n in range(12)
+            ],
+            'location': 'Meeting room 3, Building B',
+            'recurrence': None,
+        }
+        for idx in range(count)
+    ]
+
+
+def generate_drafts_response(count: int) -> dict:
+    """ A drafts list response without field mask """
+    return {
+        'drafts': [
+            {'id': f'r-{idx:019d}', 'message': {'id': f'18f{idx:013x}', 'threadId': f'18f{idx:013x}'}}
+            for idx in range(count)
+        ],
+        'resultSizeEstimate': count,
+    }
+
+
+def generate_sent_message() -> dict:
+    return {'id': '18f2c3d4e5f60718', 'threadId': '18f2c3d4e5f60718', 'labelIds': ['SENT']}
+
+
+def generate_emails(count: int) -> list[dict]:
+    """ Search results shaped like the output of search.preprocess_emails """
+    return [
+        {
+            'id': f'18f{idx:013x}',
+            'data': f'from: News <news@example.com>\n\nsubject: Weekly digest {idx}\n\nbody: ' + 'Lorem ipsum dolor sit amet. ' * 300,
+        }
+        for idx in range(count)
+    ]
+
+
+def main():
+    scenarios = {
+        'get_calendar_events (60 events)': (generate_events(60), tool_compaction.compact_events),
+        'create_calendar_event': (generate_events(1)[0], tool_compaction.compact_event),
+        'get_user_emails (5 hits)': (generate_emails(5), tool_compaction.compact_emails),
+        'get_user_drafts (40 drafts)': (generate_drafts_response(40), tool_compaction.compact_drafts),
+        'send_user_draft': (generate_sent_message(), tool_compaction.compact_sent_message),
+    }
+    print(f"{'tool result':<34} {'raw':>7} {'compact':>8} {'saved':>6}")
+    for name, (raw, compact) in scenarios.items():
+        raw_tokens = estimate_tokens(raw)
+        compact_tokens = estimate_tokens(compact(raw))
+        print(f"{name:<34} {raw_tokens:>7} {compact_tokens:>8} {1 - compact_tokens / raw_tokens:>6.0%}")
+
+
+if __name__ == "__main__":
+    main()
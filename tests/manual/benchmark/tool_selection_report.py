@@ -0,0 +1,93 @@
+import importlib
+import json
+import os
+import sys
+
+from pydantic_ai.messages import ModelResponse, TextPart
+from pydantic_ai.models.function import AgentInfo, FunctionModel
+
+# the backend modules use relative imports, so import them through the repository's package
+REPOSITORY_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+sys.path.insert(0, os.path.dirname(REPOSITORY_ROOT))
+ai_integration = importlib.import_module(f"{os.path.basename(REPOSITORY_ROOT)}.ai_integration")
+model_routing = importlib.import_module(f"{os.path.basename(REPOSITORY_ROOT)}.model_routing")
+tool_selection = importlib.import_module(f"{os.path.basename(REPOSITORY_ROOT)}.tool_selection")
+
+# the messages of ai_benchmark.py and a few email turns
+SCENARIOS = {
+    'simple_question': "Who was the first president of the United States?",
+    'calender_question': "When is my AI test event happening?",
+    'hard_calender_question': "When is my next event at the Microsoft Headquarters happening?",
+    'create_event': "Create a calendar entry for next Tuesday for showcase at 10am.",
+    'create_event_with_location': "Create a calendar entry for next Tuesday for Microsoft Showcase at 10am at the Microsoft Headquarters.",
+    'create_complex_event': "Monday in two weeks, I have a flight from Cologne airport to Berlin at 7 in the morning. add a calendar entry for this.",
+    'search_emails': "Did I get any emails about the new openai model?",
+    'draft_email': "Draft an email to zanges93@gmail.com saying that I will be late tomorrow.",
+    'send_draft': "Send my latest draft.",
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """ Rough token estimate for English text and JSON, about four characters per token """
+    return len(text) // 4
+
+
+def offered_tool_definitions(tool_names: frozenset[str] | None) -> list[dict]:
+    """ Run the agent against a stub model and capture the tool definitions that would be sent to the LLM """
+    captured = []
+
+    def capture(messages, info: AgentInfo) -> ModelResponse:
+        captured.extend(
+            {
+                'name': tool.name,
+                'description': tool.description,
+                'parameters': tool.parameters_json_schema,
+            }
+            for tool in info.function_tools
+        )
+        return ModelResponse(parts=[TextPart('done')])
+
+    ai_integration.agent.run_sync(
+        'report',
+        model=FunctionModel(capture),
+        deps=ai_integration.MyDeps(token='', user=None, tool_names=tool_names),
+    )
+    return captured
+
+
+def route_report(full_tokens: int) -> None:
+    """ The schema tokens of every tool and of the tool set of every route, the ceiling of the selection """
+    print(f"{'tool':<28} {'tokens':>7}")
+    for definition in offered_tool_definitions(None):
+        print(f"{definition['name']:<28} {estimate_tokens(json.dumps(definition)):>7}")
+    print()
+    print(f"{'route':<28} {'tools':>5} {'tokens':>7} {'saved':>6}")
+    for name, route in model_routing.ROUTES.items():
+        definitions = offered_tool_definitions(route.tool_names)
+        tokens = estimate_tokens(json.dumps(definitions))
+        print(f"{name:<28} {len(definitions):>5} {tokens:>7} {1 - tokens / full_tokens:>6.0%}")
+    print()
+
+
+def main():
+    full_tokens = estimate_tokens(json.dumps(offered_tool_definitions(None)))
+    route_report(full_tokens)
+    total_selected_tokens = 0
+    print(f"{'scenario':<28} {'route':<9} {'tools':>5} {'tokens':>7} {'saved':>6}")
+    for name, message in SCENARIOS.items():
+        message_embedding = ai_integration.search.bi_encoder.encode(message, convert_to_tensor=True)
+        route = model_routing.route_message(message, message_embedding)
+        tool_names = tool_selection.select_tools(message_embedding, ai_integration.TOOL_DESCRIPTIONS, route.tool_names)
+        definitions = offered_tool_definitions(tool_names)
+        tokens = estimate_tokens(json.dumps(definitions))
+        total_selected_tokens += tokens
+        print(f"{name:<28} {route.name:<9} {len(definitions):>5} {tokens:>7} {1 - tokens / full_tokens:>6.0%}")
+        print(f"    {sorted(definition['name'] for definition in definitions)}")
+
+    average_tokens = total_selected_tokens / len(SCENARIOS)
+    print(f"all tools: {full_tokens} tokens per request")
+    print(f"selected:  {average_tokens:.0f} tokens per request on average ({1 - average_tokens / full_tokens:.0%} saved)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,15 @@
+import importlib
 import json
+import os
+import sys
 
-from email_integration import get_emails, get_email_details
+# the backend modules use relative imports, so import them through the repository's package
+REPOSITORY_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, os.path.dirname(REPOSITORY_ROOT))
+email_integration = importlib.import_module(f"{os.path.basename(REPOSITORY_ROOT)}.email_integration")
 
-email_json_filename = "email.json"
 email_details_json_filename = "email_details.json"
+search_string = "new openai model"
 auth_token = None
 
 
@@ -16,28 +22,14 @@ def wrapper(func: callable):
     return wrapped
 
 
-@wrapper
-def generate_email_json(auth_token: str):
-    result = get_emails(auth_token, "new openai model")
-    json_result = json.dumps(result)
-    with open(email_json_filename, "w") as f:
-        f.write(json_result)
-    print(f"Successfully wrote {email_json_filename}")
-
-
 @wrapper
 def generate_email_details_json(auth_token: str):
-    with open(email_json_filename, "r") as f:
-        emails = json.load(f)
-    email_ids = [email['id'] for email in emails['messages']]
-    emails = []
-    for email_id in email_ids:
-        email_details = get_email_details(auth_token, email_id)
-        emails.append(email_details)
+    # fetched the way the assistant searches, at most EMAIL_SEARCH_MAX_CANDIDATES e-mails
+    emails = list(email_integration.iter_emails(auth_token, search_string))
     with open(email_details_json_filename, "w") as f:
         f.write(json.dumps(emails))
+    print(f"Successfully wrote {len(emails)} emails to {email_details_json_filename}")
 
 
 if __name__ == "__main__":
-    #generate_email_json()
-    generate_email_details_json()
\ No newline at end of file
+    generate_email_details_json()
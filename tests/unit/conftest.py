@@ -0,0 +1,28 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+# the backend modules use relative imports, so load the repository as the package "backend"
+REPOSITORY_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("LOGFIRE_IGNORE_NO_CONFIG", "1")
+# the summary agent is created on import, the keyless test model keeps it from needing an API key
+os.environ.setdefault("SUMMARY_MODEL", "test")
+
+_spec = importlib.util.spec_from_file_location(
+    "backend",
+    os.path.join(REPOSITORY_ROOT, "__init__.py"),
+    submodule_search_locations=[REPOSITORY_ROOT]
+)
+sys.modules["backend"] = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(sys.modules["backend"])
+
+
+@pytest.fixture(autouse=True)
+def user_data_directory(tmp_path, monkeypatch):
+    """ Keep the local data (indexes, caches) of every test in its own directory """
+    directory = tmp_path / "user_data"
+    monkeypatch.setenv("USER_DATA_DIRECTORY", str(directory))
+    return directory
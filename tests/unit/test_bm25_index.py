@@ -0,0 +1,155 @@
+import math
+
+import numpy as np
+import pytest
+
+from backend.bm25_index import BM25Index, bm25_tokenizer
+
+DOCUMENTS = {
+    'a': "The new model was released by the lab today",
+    'b': "Lunch with the team on Friday",
+    'c': "The model card of the new language model",
+    'd': "Quarterly report of the sales team",
+}
+
+
+def reference_scores(documents: dict[str, str], query: str, k1: float = 1.5, b: float = 0.75) -> list[float]:
+    """ BM25 computed term by term, the way the index is meant to score """
+    tokenized = {document_id: bm25_tokenizer(text) for document_id, text in documents.items()}
+    average_length = sum(len(tokens) for tokens in tokenized.values()) / len(tokenized)
+    scores = []
+    for tokens in tokenized.values():
+        score = 0.0
+        for term in bm25_tokenizer(query):
+            document_frequency = sum(term in other for other in tokenized.values())
+            if document_frequency == 0:
+                continue
+            idf = math.log1p((len(tokenized) - document_frequency + 0.5) / (document_frequency + 0.5))
+            term_frequency = tokens.count(term)
+            score += idf * term_frequency * (k1 + 1) / (term_frequency + k1 * (1 - b + b * len(tokens) / average_length))
+        scores.append(score)
+    return scores
+
+
+def build(documents: dict[str, str]) -> BM25Index:
+    index = BM25Index()
+    index.add_documents(documents)
+    return index
+
+
+def test_tokenizer_drops_stop_words_and_punctuation():
+    assert bm25_tokenizer("The model, of the Lab!") == ['model', 'lab']
+
+
+def test_scores_match_reference():
+    index = build(DOCUMENTS)
+
+    scores = index.get_scores("new model", list(DOCUMENTS))
+
+    np.testing.assert_allclose(scores, reference_scores(DOCUMENTS, "new model"), rtol=1e-5)
+    assert scores[1] == 0 and scores[3] == 0
+
+
+def test_unknown_query_terms_score_zero():
+    index = build(DOCUMENTS)
+
+    assert not index.get_scores("unicorn", list(DOCUMENTS)).any()
+
+
+def test_adding_in_batches_equals_adding_at_once():
+    index = BM25Index()
+    index.add_documents({'a': DOCUMENTS['a'], 'b': DOCUMENTS['b']})
+    index.add_documents({'c': DOCUMENTS['c'], 'd': DOCUMENTS['d']})
+
+    np.testing.assert_allclose(
+        index.get_scores("model team", list(DOCUMENTS)),
+        build(DOCUMENTS).get_scores("model team", list(DOCUMENTS)),
+        rtol=1e-5
+    )
+
+
+def test_adding_an_indexed_document_replaces_it():
+    index = build(DOCUMENTS)
+    index.add_documents({'b': "Model review with the team"})
+
+    documents = {**DOCUMENTS, 'b': "Model review with the team"}
+    assert len(index) == len(DOCUMENTS)
+    np.testing.assert_allclose(
+        index.get_scores("model", list(documents)),
+        reference_scores(documents, "model"),
+        rtol=1e-5
+    )
+
+
+def test_removed_documents_no_longer_count(monkeypatch):
+    # keep the removed row around to check that it is ignored before compaction
+    monkeypatch.setattr("backend.bm25_index.compaction_threshold", 1.0)
+    index = build(DOCUMENTS)
+
+    index.remove_documents(['c', 'unknown'])
+
+    remaining = {document_id: text for document_id, text in DOCUMENTS.items() if document_id != 'c'}
+    assert 'c' not in index
+    assert len(index) == 3
+    assert len(index.document_ids) == 4
+    np.testing.assert_allclose(
+        index.get_scores("new model", list(remaining)),
+        reference_scores(remaining, "new model"),
+        rtol=1e-5
+    )
+    assert index.get_scores("new model")[2] == 0
+
+
+def test_removing_most_documents_compacts_the_index():
+    index = build(DOCUMENTS)
+
+    index.remove_documents(['a', 'b'])
+
+    assert index.document_ids == ['c', 'd']
+    assert index.term_frequencies.shape[0] == 2
+    np.testing.assert_allclose(
+        index.get_scores("model team", ['c', 'd']),
+        build({'c': DOCUMENTS['c'], 'd': DOCUMENTS['d']}).get_scores("model team", ['c', 'd']),
+        rtol=1e-5
+    )
+
+
+def test_compact_keeps_the_scores(monkeypatch):
+    monkeypatch.setattr("backend.bm25_index.compaction_threshold", 1.0)
+    index = build(DOCUMENTS)
+    index.remove_documents(['b'])
+    before = index.get_scores("team model", ['a', 'c', 'd'])
+
+    index.compact()
+
+    assert index.document_ids == ['a', 'c', 'd']
+    np.testing.assert_allclose(index.get_scores("team model", ['a', 'c', 'd']), before, rtol=1e-6)
+
+
+def test_save_and_load_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr("backend.bm25_index.compaction_threshold", 1.0)
+    index = build(DOCUMENTS)
+    index.remove_documents(['d'])
+    path = str(tmp_path / "bm25_index.npz")
+
+    index.save(path)
+    loaded = BM25Index.load(path)
+
+    assert loaded.document_ids == ['a', 'b', 'c', None]
+    assert 'd' not in loaded and 'a' in loaded
+    assert loaded.vocabulary == index.vocabulary
+    np.testing.assert_allclose(loaded.get_scores("new team model"), index.get_scores("new team model"))
+    loaded.add_documents({'e': "Another new model"})
+    assert loaded.get_scores("model", ['e'])[0] > 0
+
+
+def test_load_missing_file_returns_an_empty_index(tmp_path):
+    index = BM25Index.load(str(tmp_path / "missing.npz"))
+
+    assert len(index) == 0
+    assert not index.get_scores("model").any()
+
+
+def test_get_scores_of_unknown_document_raises():
+    with pytest.raises(KeyError):
+        build(DOCUMENTS).get_scores("model", ['unknown'])
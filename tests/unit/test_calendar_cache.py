@@ -0,0 +1,230 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import requests
+
+from backend import calendar_cache
+from backend.calendar_cache import CalendarEventStore, EventIntervalIndex
+
+NOW = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def make_event(event_id: str, start: datetime, hours: float = 1, status: str = 'confirmed') -> dict:
+    return {
+        'id': event_id,
+        'status': status,
+        'summary': f"Event {event_id}",
+        'start': {'dateTime': start.isoformat()},
+        'end': {'dateTime': (start + timedelta(hours=hours)).isoformat()},
+    }
+
+
+def gone() -> requests.exceptions.HTTPError:
+    response = requests.Response()
+    response.status_code = 410
+    return requests.exceptions.HTTPError("410 Gone", response=response)
+
+
+class FakeCalendarApi:
+    """ Answers the events list requests of the store with queued pages, per calendar """
+
+    def __init__(self, calendar_ids: list[str]):
+        self.calendar_ids = calendar_ids
+        self.pages: dict[str, list[dict | Exception]] = {calendar_id: [] for calendar_id in calendar_ids}
+        self.requests: list[tuple[str, dict]] = []
+
+    def fetch_calendar_list(self, token: str) -> list[dict]:
+        return [{'id': calendar_id} for calendar_id in self.calendar_ids]
+
+    def google_get(self, token: str, url: str, params: dict) -> dict:
+        calendar_id = url.split('/calendars/')[1].split('/events')[0]
+        self.requests.append((calendar_id, params))
+        page = self.pages[calendar_id].pop(0)
+        if isinstance(page, Exception):
+            raise page
+        return page
+
+
+@pytest.fixture
+def api(monkeypatch) -> FakeCalendarApi:
+    api = FakeCalendarApi(['primary'])
+    monkeypatch.setattr(calendar_cache, 'fetch_calendar_list', api.fetch_calendar_list)
+    monkeypatch.setattr(calendar_cache, 'google_get', api.google_get)
+    monkeypatch.setattr(calendar_cache, '_stores', {})
+    return api
+
+
+@pytest.fixture
+def store(tmp_path) -> CalendarEventStore:
+    return CalendarEventStore(str(tmp_path / calendar_cache.CALENDAR_CACHE_FILENAME))
+
+
+def test_interval_index_finds_long_events_starting_before_the_window():
+    index = EventIntervalIndex([
+        (0, 100, ('primary', 'long')),
+        (10, 20, ('primary', 'early')),
+        (50, 60, ('primary', 'inside')),
+        (200, 210, ('primary', 'late')),
+    ])
+
+    assert index.overlapping(40, 70) == [('primary', 'long'), ('primary', 'inside')]
+    assert index.overlapping(20, None) == [('primary', 'long'), ('primary', 'inside'), ('primary', 'late')]
+    assert index.overlapping(None, 10) == [('primary', 'long')]
+    assert EventIntervalIndex([]).overlapping(0, 10) == []
+
+
+def test_first_sync_is_a_full_sync_within_the_window(api, store):
+    api.pages['primary'] = [
+        {'items': [make_event('a', NOW)], 'nextPageToken': 'page 2'},
+        {'items': [make_event('b', NOW + timedelta(days=1))], 'nextSyncToken': 'sync 1'},
+    ]
+
+    assert store.sync('token')
+
+    _, first_params = api.requests[0]
+    assert 'syncToken' not in first_params and 'timeMin' in first_params and 'timeMax' in first_params
+    assert first_params['showDeleted'] and first_params['singleEvents']
+    assert api.requests[1][1]['pageToken'] == 'page 2'
+    assert store.calendars['primary']['sync_token'] == 'sync 1'
+    assert store.calendars['primary']['window'] is not None
+    assert set(store.calendars['primary']['events']) == {'a', 'b'}
+
+
+def test_incremental_sync_applies_changes(api, store):
+    api.pages['primary'] = [
+        {'items': [make_event('a', NOW), make_event('b', NOW + timedelta(hours=2))], 'nextSyncToken': 'sync 1'},
+        {
+            'items': [
+                {**make_event('a', NOW), 'summary': "Renamed"},
+                {'id': 'b', 'status': 'cancelled'},
+                make_event('c', NOW + timedelta(hours=4)),
+            ],
+            'nextSyncToken': 'sync 2',
+        },
+    ]
+    store.sync('token')
+    window = store.calendars['primary']['window']
+
+    assert store.sync('token')
+
+    _, params = api.requests[1]
+    assert params['syncToken'] == 'sync 1'
+    assert 'timeMin' not in params and 'timeMax' not in params
+    events = store.calendars['primary']['events']
+    assert set(events) == {'a', 'c'}
+    assert events['a']['summary'] == "Renamed"
+    assert store.calendars['primary']['sync_token'] == 'sync 2'
+    assert store.calendars['primary']['window'] == window
+
+
+def test_expired_sync_token_starts_over_with_a_full_sync(api, store):
+    api.pages['primary'] = [
+        {'items': [make_event('stale', NOW)], 'nextSyncToken': 'sync 1'},
+        gone(),
+        {'items': [make_event('fresh', NOW)], 'nextSyncToken': 'sync 2'},
+    ]
+    store.sync('token')
+
+    assert store.sync('token')
+
+    assert 'syncToken' in api.requests[1][1]
+    assert 'syncToken' not in api.requests[2][1] and 'timeMin' in api.requests[2][1]
+    assert set(store.calendars['primary']['events']) == {'fresh'}
+    assert store.calendars['primary']['sync_token'] == 'sync 2'
+
+
+def test_failed_calendar_fails_the_sync_and_removed_calendars_are_dropped(api, store):
+    api.calendar_ids = ['primary', 'work']
+    api.pages = {
+        'primary': [{'items': [make_event('a', NOW)], 'nextSyncToken': 'sync 1'}],
+        'work': [requests.exceptions.HTTPError("500 Server Error")],
+    }
+
+    assert not store.sync('token')
+    assert store.last_sync == 0.0
+    assert store.calendars['work']['window'] is None
+
+    api.calendar_ids = ['primary']
+    api.pages['primary'] = [{'items': [], 'nextSyncToken': 'sync 2'}]
+    assert store.sync('token')
+    assert list(store.calendars) == ['primary']
+
+
+def test_covers_only_bounds_within_every_window(api, store):
+    api.pages['primary'] = [{'items': [], 'nextSyncToken': 'sync 1'}]
+    store.sync('token')
+
+    assert store.covers(NOW, NOW + timedelta(days=7))
+    assert store.covers(NOW - timedelta(days=30), None)
+    assert not store.covers(None, None)
+    assert not store.covers(NOW, NOW + calendar_cache.sync_future_window * 2)
+
+
+def test_events_between_and_save_and_load(api, store):
+    api.pages['primary'] = [{
+        'items': [
+            make_event('yesterday', NOW - timedelta(days=1)),
+            make_event('today', NOW),
+            make_event('all week', NOW - timedelta(days=2), hours=24 * 7),
+            make_event('next month', NOW + timedelta(days=30)),
+        ],
+        'nextSyncToken': 'sync 1',
+    }]
+    store.sync('token')
+
+    loaded = CalendarEventStore.load(store.path)
+
+    for candidate in (store, loaded):
+        events = candidate.events_between(NOW - timedelta(minutes=30), NOW + timedelta(days=1))
+        assert [event['id'] for event in events] == ['all week', 'today']
+    assert loaded.calendars == store.calendars
+
+
+def test_get_calendar_events_answers_from_the_store(api, monkeypatch):
+    api.pages['primary'] = [{'items': [make_event('a', NOW)], 'nextSyncToken': 'sync 1'}]
+    monkeypatch.setattr(calendar_cache, 'fetch_google_calendar_events', pytest.fail)
+
+    events = calendar_cache.get_calendar_events('token', 'alice', NOW - timedelta(hours=1), NOW + timedelta(hours=2))
+    # within the sync interval the store is not synced again
+    events_again = calendar_cache.get_calendar_events('token', 'alice', NOW - timedelta(hours=1), NOW + timedelta(hours=2))
+
+    assert [event['id'] for event in events] == ['a']
+    assert events_again == events
+    assert len(api.requests) == 1
+
+
+def test_get_calendar_events_fetches_from_google_outside_the_window(api, monkeypatch):
+    api.pages['primary'] = [{'items': [], 'nextSyncToken': 'sync 1'}]
+    fetched = []
+    monkeypatch.setattr(
+        calendar_cache, 'fetch_google_calendar_events', lambda token, parameters: fetched.append(parameters) or ['remote']
+    )
+    minimum_end_time = NOW - calendar_cache.sync_past_window * 2
+
+    assert calendar_cache.get_calendar_events('token', 'alice', minimum_end_time, NOW) == ['remote']
+    assert fetched == [{'minimum_end_time': minimum_end_time, 'maximum_start_time': NOW}]
+
+
+def test_created_and_deleted_events_are_applied_right_away(api, monkeypatch):
+    api.pages['primary'] = [{'items': [], 'nextSyncToken': 'sync 1'}]
+    window = (NOW - timedelta(hours=1), NOW + timedelta(hours=2))
+    assert calendar_cache.get_calendar_events('token', 'alice', *window) == []
+
+    calendar_cache.apply_created_event('alice', 'primary', make_event('new', NOW))
+    assert [event['id'] for event in calendar_cache.get_calendar_events('token', 'alice', *window)] == ['new']
+
+    calendar_cache.apply_deleted_event('alice', 'primary', 'new')
+    assert calendar_cache.get_calendar_events('token', 'alice', *window) == []
+    assert len(api.requests) == 1
+
+
+def test_created_recurring_event_forces_a_sync(api):
+    api.pages['primary'] = [{'items': [], 'nextSyncToken': 'sync 1'}]
+    calendar_cache.get_calendar_events('token', 'alice', NOW, NOW + timedelta(hours=1))
+
+    calendar_cache.apply_created_event('alice', 'primary', {**make_event('weekly', NOW), 'recurrence': ['RRULE:FREQ=WEEKLY']})
+
+    api.pages['primary'] = [{'items': [make_event('weekly_1', NOW)], 'nextSyncToken': 'sync 2'}]
+    events = calendar_cache.get_calendar_events('token', 'alice', NOW, NOW + timedelta(hours=1))
+    assert [event['id'] for event in events] == ['weekly_1']
+    assert api.requests[1][1]['syncToken'] == 'sync 1'
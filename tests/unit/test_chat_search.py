@@ -0,0 +1,100 @@
+import base64
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from backend import chat_search
+from backend.chat_search import decode_cursor, encode_cursor, search_chat_messages
+# the relationship of ChatMessage needs the User mapper to build statements
+from backend.models.user import User  # noqa: F401
+
+Row = namedtuple('Row', ['id', 'message', 'sender', 'send_time', 'rank'])
+SEND_TIME = datetime(2025, 6, 2, tzinfo=timezone.utc)
+
+
+class FakeSession:
+    """ Returns the given rows for any statement, the statements are recorded """
+
+    def __init__(self, rows: list[Row]):
+        self.rows = rows
+        self.statements = []
+
+    def exec(self, statement):
+        self.statements.append(statement)
+        return self
+
+    def all(self) -> list[Row]:
+        return self.rows
+
+
+@pytest.mark.parametrize(('rank', 'message_id'), [(0.0607927, 42), (1e-20, 1), (0.1 + 0.2, 7)])
+def test_cursor_round_trip_is_exact(rank, message_id):
+    assert decode_cursor(encode_cursor(rank, message_id)) == (rank, message_id)
+
+
+@pytest.mark.parametrize('cursor', [
+    'not base64!',
+    base64.urlsafe_b64encode(b'0.5').decode(),
+    base64.urlsafe_b64encode(b'0.5:1:2').decode(),
+    base64.urlsafe_b64encode(b'rank:1').decode(),
+    base64.urlsafe_b64encode(b'0.5:first').decode(),
+    base64.urlsafe_b64encode(b'\xff\xfe:1').decode(),
+    base64.urlsafe_b64encode(b'nan:1').decode(),
+    base64.urlsafe_b64encode(b'inf:1').decode(),
+])
+def test_malformed_cursors_are_rejected(cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        decode_cursor(cursor)
+
+
+def test_first_page_statement():
+    compiled = chat_search._search_statement('alice', 'model -draft', 20).compile(dialect=postgresql.dialect())
+    sql = str(compiled)
+
+    assert 'websearch_to_tsquery' in sql
+    # best rank first, ties broken by the newest message
+    assert 'ts_rank' in sql.split('ORDER BY')[-1] and 'DESC, chat_message.id DESC' in sql
+    assert 'CAST(' not in sql
+    # only the newest matches are ranked, the page has one row more than the limit
+    assert {chat_search.chat_search_max_ranked, 21} <= set(compiled.params.values())
+
+
+def test_next_page_statement_continues_after_the_cursor():
+    compiled = chat_search._search_statement('alice', 'model', 20, encode_cursor(0.25, 42)).compile(
+        dialect=postgresql.dialect()
+    )
+
+    # the rank of the cursor is compared as real, like the ts_rank it came from
+    assert ') < (CAST(' in str(compiled) and 'AS REAL)' in str(compiled)
+    assert {0.25, 42, 21} <= set(compiled.params.values())
+
+
+def test_page_with_more_results_has_a_cursor():
+    rows = [Row(idx, f"message {idx}", 'user', SEND_TIME, 1.0 / idx) for idx in (5, 4, 3)]
+    session = FakeSession(rows)
+
+    page = search_chat_messages(session, 'alice', 'model', limit=2)
+
+    assert [result['id'] for result in page['results']] == [5, 4]
+    assert page['results'][0] == {'id': 5, 'message': "message 5", 'sender': 'user', 'send_time': SEND_TIME, 'rank': 0.2}
+    assert decode_cursor(page['next_cursor']) == (0.25, 4)
+
+
+def test_last_page_has_no_cursor():
+    rows = [Row(idx, f"message {idx}", 'ai', SEND_TIME, 0.5) for idx in (2, 1)]
+
+    page = search_chat_messages(FakeSession(rows), 'alice', 'model', limit=2)
+
+    assert len(page['results']) == 2
+    assert page['next_cursor'] is None
+    assert search_chat_messages(FakeSession([]), 'alice', 'model') == {'results': [], 'next_cursor': None}
+
+
+def test_invalid_cursor_fails_before_querying():
+    session = FakeSession([])
+
+    with pytest.raises(ValueError):
+        search_chat_messages(session, 'alice', 'model', cursor='garbage')
+    assert session.statements == []
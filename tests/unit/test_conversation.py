@@ -0,0 +1,193 @@
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from pydantic_ai.messages import ModelRequest, ModelResponse, SystemPromptPart, TextPart, UserPromptPart
+from sqlalchemy import text
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Session, SQLModel, create_engine
+
+from backend import conversation
+from backend.models.chat_message import ChatMessage
+from backend.models.conversation_summary import ConversationSummary
+from backend.models.user import User
+
+RECENT = conversation.CONVERSATION_RECENT_MESSAGES
+BATCH = conversation.CONVERSATION_COMPACTION_BATCH
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    engine = create_engine("sqlite://", connect_args={'check_same_thread': False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine, tables=[User.__table__, ConversationSummary.__table__])
+    with engine.begin() as connection:
+        # sqlite has no tsvector, so the search column is a plain column here
+        connection.execute(text(
+            "CREATE TABLE chat_message (id INTEGER PRIMARY KEY, message TEXT NOT NULL, sender TEXT NOT NULL, "
+            "send_time TIMESTAMP, message_search TEXT, user_id TEXT NOT NULL REFERENCES user (id))"
+        ))
+    with Session(engine) as db_session:
+        db_session.add(User(id='alice', email='alice@example.com', username='alice', name='Alice', google_token='token'))
+        db_session.commit()
+    monkeypatch.setattr(conversation, 'engine', engine)
+    return engine
+
+
+class AwareDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return datetime.now(tz or timezone.utc)
+
+
+@pytest.fixture(autouse=True)
+def aware_datetimes(monkeypatch):
+    """ sqlmodel releases newer than the locked one reject naive datetimes, which the locked one stores as they are """
+    monkeypatch.setattr(conversation, 'datetime', AwareDatetime)
+
+
+class FakeSummaryAgent:
+    """ Replaces the runs of the summary agent, recording the prompts """
+
+    def __init__(self, on_run=None):
+        self.prompts: list[str] = []
+        self.on_run = on_run
+
+    async def run(self, prompt: str):
+        self.prompts.append(prompt)
+        if self.on_run is not None:
+            self.on_run()
+        return SimpleNamespace(data=f"summary {len(self.prompts)}")
+
+
+@pytest.fixture
+def summary_agent(monkeypatch) -> FakeSummaryAgent:
+    agent = FakeSummaryAgent()
+    monkeypatch.setattr(conversation.summary_agent, 'run', agent.run)
+    return agent
+
+
+def add_messages(engine, count: int, user_id: str = 'alice') -> list[int]:
+    with Session(engine) as db_session:
+        start = len(db_session.exec(text("SELECT id FROM chat_message")).all())
+        messages = [
+            ChatMessage(
+                message=f"message {start + idx}",
+                sender='user' if idx % 2 == 0 else 'ai',
+                send_time=datetime.now(timezone.utc),
+                user_id=user_id,
+            )
+            for idx in range(count)
+        ]
+        db_session.add_all(messages)
+        db_session.commit()
+        return [message.id for message in messages]
+
+
+def history_texts(history) -> list[str]:
+    return [part.content for message in history[1:] for part in message.parts]
+
+
+def test_empty_conversation_has_no_history(engine):
+    assert conversation.conversation_history('alice', "system prompt") == []
+
+
+def test_history_starts_with_the_system_prompt_and_alternates(engine):
+    add_messages(engine, 3)
+
+    history = conversation.conversation_history('alice', "system prompt")
+
+    assert isinstance(history[0], ModelRequest)
+    assert [(type(part), part.content) for part in history[0].parts] == [(SystemPromptPart, "system prompt")]
+    assert isinstance(history[1], ModelRequest) and isinstance(history[1].parts[0], UserPromptPart)
+    assert isinstance(history[2], ModelResponse) and isinstance(history[2].parts[0], TextPart)
+    assert history_texts(history) == ["message 0", "message 1", "message 2"]
+
+
+def test_nothing_is_compacted_before_a_batch_is_complete(engine, summary_agent):
+    add_messages(engine, RECENT + BATCH - 1)
+
+    asyncio.run(conversation.compact_conversation('alice'))
+
+    assert summary_agent.prompts == []
+    assert len(conversation.conversation_history('alice', "system prompt")) == RECENT + BATCH
+
+
+def test_compaction_keeps_the_recent_messages(engine, summary_agent):
+    ids = add_messages(engine, RECENT + BATCH + 2)
+
+    asyncio.run(conversation.compact_conversation('alice'))
+
+    assert len(summary_agent.prompts) == 1
+    assert "Previous summary:\n(none)" in summary_agent.prompts[0]
+    assert "user: message 0\nai: message 1" in summary_agent.prompts[0]
+    assert f"message {BATCH + 1}" in summary_agent.prompts[0]
+    assert f"message {BATCH + 2}" not in summary_agent.prompts[0]
+    with Session(engine) as db_session:
+        summary = db_session.get(ConversationSummary, 'alice')
+        assert (summary.summary, summary.summarized_until_message_id) == ("summary 1", ids[BATCH + 1])
+
+    history = conversation.conversation_history('alice', "system prompt")
+    assert history[0].parts[1].content == "Summary of the earlier conversation:\nsummary 1"
+    assert history_texts(history) == [f"message {idx}" for idx in range(BATCH + 2, RECENT + BATCH + 2)]
+
+
+def test_next_compaction_merges_into_the_previous_summary(engine, summary_agent):
+    add_messages(engine, RECENT + BATCH)
+    asyncio.run(conversation.compact_conversation('alice'))
+
+    add_messages(engine, BATCH)
+    asyncio.run(conversation.compact_conversation('alice'))
+
+    assert len(summary_agent.prompts) == 2
+    assert "Previous summary:\nsummary 1" in summary_agent.prompts[1]
+    assert "message 0" not in summary_agent.prompts[1]
+    assert f"message {BATCH}" in summary_agent.prompts[1]
+
+
+def test_summary_is_dropped_if_the_chat_was_cleared_meanwhile(engine, monkeypatch):
+    def clear_chat():
+        with Session(engine) as db_session:
+            db_session.exec(text("DELETE FROM chat_message"))
+            conversation.clear_conversation_summary(db_session, 'alice')
+            db_session.commit()
+
+    agent = FakeSummaryAgent(on_run=clear_chat)
+    monkeypatch.setattr(conversation.summary_agent, 'run', agent.run)
+    add_messages(engine, RECENT + BATCH)
+
+    asyncio.run(conversation.compact_conversation('alice'))
+
+    assert len(agent.prompts) == 1
+    with Session(engine) as db_session:
+        assert db_session.get(ConversationSummary, 'alice') is None
+    assert conversation._compacting_users == set()
+
+
+def test_compaction_of_a_user_does_not_overlap(engine, summary_agent, monkeypatch):
+    add_messages(engine, RECENT + BATCH)
+    monkeypatch.setattr(conversation, '_compacting_users', {'alice'})
+
+    asyncio.run(conversation.compact_conversation('alice'))
+
+    assert summary_agent.prompts == []
+
+
+def test_history_is_capped_if_compaction_falls_behind(engine):
+    add_messages(engine, conversation._max_unsummarized_messages + 5)
+
+    history = conversation.conversation_history('alice', "system prompt")
+
+    assert len(history) == conversation._max_unsummarized_messages + 1
+    assert history_texts(history)[-1] == f"message {conversation._max_unsummarized_messages + 4}"
+    assert history_texts(history)[0] == "message 5"
+
+
+def test_disabled_context(engine, summary_agent, monkeypatch):
+    monkeypatch.setattr(conversation, 'CONVERSATION_CONTEXT_ENABLED', False)
+    add_messages(engine, RECENT + BATCH)
+
+    asyncio.run(conversation.compact_conversation('alice'))
+
+    assert conversation.conversation_history('alice', "system prompt") == []
+    assert summary_agent.prompts == []
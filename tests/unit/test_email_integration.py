@@ -0,0 +1,89 @@
+import threading
+
+import pytest
+
+from backend import email_integration
+
+MESSAGES_URL = 'https://gmail.googleapis.com/gmail/v1/users/me/messages'
+THREADS_URL = 'https://gmail.googleapis.com/gmail/v1/users/me/threads'
+
+
+class FakeGmailApi:
+    """ Lists the ids in pages of page_size and returns the details of every id """
+
+    def __init__(self, ids: list[str]):
+        self.ids = ids
+        self.list_requests: list[tuple[str, dict]] = []
+        self.fetched: list[str] = []
+        self.blocked = threading.Event()
+
+    def google_get(self, token: str, url: str, params: dict | None = None) -> dict:
+        if url in (MESSAGES_URL, THREADS_URL):
+            self.list_requests.append((url, params))
+            start = int(params.get('pageToken', 0))
+            end = start + params['maxResults']
+            resource = 'threads' if url == THREADS_URL else 'messages'
+            page = {resource: [{'id': item_id} for item_id in self.ids[start:end]]}
+            if end < len(self.ids):
+                page['nextPageToken'] = str(end)
+            return page
+        item_id = url.rsplit('/', 1)[1]
+        if item_id.startswith('slow'):
+            self.blocked.wait(5)
+        self.fetched.append(item_id)
+        return {'id': item_id, 'url': url}
+
+
+@pytest.fixture
+def api(monkeypatch) -> FakeGmailApi:
+    api = FakeGmailApi([])
+    monkeypatch.setattr(email_integration, 'google_get', api.google_get)
+    monkeypatch.setattr(email_integration, 'EMAIL_LIST_PAGE_SIZE', 2)
+    yield api
+    api.blocked.set()
+
+
+def test_pages_are_listed_until_the_last_one(api):
+    api.ids = ['a', 'b', 'c', 'd', 'e']
+
+    pages = list(email_integration.iter_email_id_pages('token', 'model', page_size=2))
+
+    assert pages == [['a', 'b'], ['c', 'd'], ['e']]
+    assert [params.get('pageToken') for _, params in api.list_requests] == [None, '2', '4']
+
+
+def test_iter_emails_stops_at_max_emails(api):
+    api.ids = ['a', 'b', 'c', 'd', 'e']
+
+    emails = list(email_integration.iter_emails('token', 'model', max_emails=3, time_budget_seconds=5))
+
+    assert sorted(email['id'] for email in emails) == ['a', 'b', 'c']
+    # the third page is never listed
+    assert len(api.list_requests) == 2
+
+
+def test_iter_emails_only_lists_what_is_consumed(api):
+    api.ids = ['a', 'b', 'c', 'd']
+
+    emails = email_integration.iter_emails('token', 'model', max_emails=10, time_budget_seconds=5)
+    next(emails)
+
+    assert len(api.list_requests) == 1
+    emails.close()
+
+
+def test_iter_emails_stops_when_the_time_budget_is_spent(api):
+    api.ids = ['a', 'slow']
+
+    emails = list(email_integration.iter_emails('token', 'model', max_emails=10, time_budget_seconds=0.2))
+
+    assert [email['id'] for email in emails] == ['a']
+
+
+def test_iter_emails_by_thread_fetches_threads(api):
+    api.ids = ['thread 1', 'thread 2']
+
+    threads = list(email_integration.iter_emails('token', 'model', max_emails=10, time_budget_seconds=5, by_thread=True))
+
+    assert api.list_requests[0][0] == THREADS_URL
+    assert sorted(thread['url'] for thread in threads) == [f"{THREADS_URL}/thread 1", f"{THREADS_URL}/thread 2"]
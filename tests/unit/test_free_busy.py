@@ -0,0 +1,131 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from backend import calendar_integration
+from backend.calendar_integration import _merge_intervals, fetch_google_free_busy
+
+BERLIN = timezone(timedelta(hours=2))
+DAY = datetime(2025, 6, 2, tzinfo=timezone.utc)
+
+
+def at(hour: float) -> datetime:
+    return DAY + timedelta(hours=hour)
+
+
+def busy(start: float, end: float) -> dict:
+    return {'start': at(start).isoformat().replace('+00:00', 'Z'), 'end': at(end).isoformat().replace('+00:00', 'Z')}
+
+
+class FakeResponse:
+    def __init__(self, body: dict):
+        self.body = body
+
+    def json(self) -> dict:
+        return self.body
+
+
+class FakeFreeBusyApi:
+    """ Answers freeBusy requests with the busy intervals or errors of each calendar """
+
+    def __init__(self, calendars: dict[str, dict]):
+        self.calendars = calendars
+        self.requests: list[dict] = []
+
+    def google_request(self, method: str, token: str, url: str, params: dict | None = None, json: dict | None = None):
+        assert (method, url) == ('POST', 'https://www.googleapis.com/calendar/v3/freeBusy')
+        self.requests.append(json)
+        return FakeResponse({'calendars': {item['id']: self.calendars[item['id']] for item in json['items']}})
+
+
+@pytest.fixture
+def api(monkeypatch) -> FakeFreeBusyApi:
+    api = FakeFreeBusyApi({})
+    monkeypatch.setattr(calendar_integration, 'google_request', api.google_request)
+    monkeypatch.setattr(
+        calendar_integration, 'fetch_calendar_list', lambda token: [{'id': calendar_id} for calendar_id in api.calendars]
+    )
+    return api
+
+
+def test_merge_intervals():
+    assert _merge_intervals([]) == []
+    assert _merge_intervals([(at(3), at(4)), (at(1), at(2))]) == [(at(1), at(2)), (at(3), at(4))]
+    # overlapping, adjacent and contained intervals are merged
+    assert _merge_intervals([(at(1), at(3)), (at(2), at(4)), (at(4), at(5)), (at(1.5), at(2))]) == [(at(1), at(5))]
+
+
+def test_busy_intervals_of_all_calendars_are_merged(api):
+    api.calendars = {
+        'primary': {'busy': [busy(9, 10), busy(13, 14)]},
+        'work': {'busy': [busy(9.5, 11), busy(11, 12)]},
+    }
+
+    free_busy = fetch_google_free_busy('token', at(8), at(18))
+
+    assert free_busy['busy'] == [
+        {'start': at(9).isoformat(), 'end': at(12).isoformat()},
+        {'start': at(13).isoformat(), 'end': at(14).isoformat()},
+    ]
+    assert free_busy['free'] == [
+        {'start': at(8).isoformat(), 'end': at(9).isoformat()},
+        {'start': at(12).isoformat(), 'end': at(13).isoformat()},
+        {'start': at(14).isoformat(), 'end': at(18).isoformat()},
+    ]
+    assert 'unavailable_calendars' not in free_busy
+    assert api.requests[0]['items'] == [{'id': 'primary'}, {'id': 'work'}]
+
+
+def test_intervals_are_clipped_to_the_window_and_in_its_timezone(api):
+    api.calendars = {'primary': {'busy': [busy(7, 9), busy(17, 20)]}}
+
+    free_busy = fetch_google_free_busy('token', at(8).astimezone(BERLIN), at(18).astimezone(BERLIN))
+
+    assert free_busy['busy'] == [
+        {'start': at(8).astimezone(BERLIN).isoformat(), 'end': at(9).astimezone(BERLIN).isoformat()},
+        {'start': at(17).astimezone(BERLIN).isoformat(), 'end': at(18).astimezone(BERLIN).isoformat()},
+    ]
+    assert free_busy['free'] == [
+        {'start': at(9).astimezone(BERLIN).isoformat(), 'end': at(17).astimezone(BERLIN).isoformat()},
+    ]
+
+
+def test_short_free_slots_are_left_out(api):
+    api.calendars = {'primary': {'busy': [busy(9, 10), busy(10.25, 11)]}}
+
+    free_busy = fetch_google_free_busy('token', at(9), at(12), minimum_free_duration=timedelta(minutes=30))
+
+    assert free_busy['free'] == [{'start': at(11).isoformat(), 'end': at(12).isoformat()}]
+
+
+def test_unavailable_calendars_are_reported(api):
+    api.calendars = {
+        'primary': {'busy': [busy(9, 10)]},
+        'shared': {'errors': [{'domain': 'global', 'reason': 'notFound'}]},
+    }
+
+    free_busy = fetch_google_free_busy('token', at(8), at(12))
+
+    assert free_busy['busy'] == [{'start': at(9).isoformat(), 'end': at(10).isoformat()}]
+    assert free_busy['unavailable_calendars'] == [{'calendar_id': 'shared', 'reasons': ['notFound']}]
+
+    with pytest.raises(RuntimeError):
+        fetch_google_free_busy('token', at(8), at(12), calendar_ids=['shared'])
+
+
+def test_calendars_are_requested_in_batches(api):
+    api.calendars = {f"calendar {idx}": {'busy': []} for idx in range(calendar_integration.FREE_BUSY_MAX_CALENDARS + 1)}
+
+    free_busy = fetch_google_free_busy('token', at(8), at(12))
+
+    assert [len(request['items']) for request in api.requests] == [calendar_integration.FREE_BUSY_MAX_CALENDARS, 1]
+    assert free_busy == {'busy': [], 'free': [{'start': at(8).isoformat(), 'end': at(12).isoformat()}]}
+
+
+@pytest.mark.parametrize(('time_min', 'time_max'), [
+    (at(8).replace(tzinfo=None), at(12)),
+    (at(12), at(8)),
+])
+def test_invalid_windows_are_rejected(api, time_min, time_max):
+    with pytest.raises(ValueError):
+        fetch_google_free_busy('token', time_min, time_max)
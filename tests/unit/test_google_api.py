@@ -0,0 +1,324 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+from backend import google_api
+from backend.google_api import RateLimiter, SingleFlight, TokenBucket
+
+CALENDAR_URL = 'https://www.googleapis.com/calendar/v3/calendars/primary/events'
+
+
+class CountingEvent(threading.Event):
+    """ An event that counts the callers waiting for it """
+
+    def __init__(self):
+        super().__init__()
+        self.waiters = 0
+
+    def wait(self, timeout=None):
+        self.waiters += 1
+        return super().wait(timeout)
+
+
+class FakeClock:
+    """ Stands in for the time module, sleeping advances the clock instead of blocking """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps: list[float] = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def perf_counter(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(google_api, 'time', clock)
+    monkeypatch.setattr(google_api, '_rate_limiter', RateLimiter())
+    return clock
+
+
+def make_response(status_code: int, body: bytes = b'{}', headers: dict | None = None) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = body
+    response.headers.update(headers or {})
+    response.url = CALENDAR_URL
+    return response
+
+
+def rate_limit_error(reason: str) -> bytes:
+    return f'{{"error": {{"errors": [{{"reason": "{reason}"}}]}}}}'.encode()
+
+
+class ResponseQueue(list):
+    """ The responses requests.request returns in order, the requests sent are recorded in sent """
+
+    def __init__(self):
+        super().__init__()
+        self.sent: list[tuple[str, str, dict]] = []
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        self.sent.append((method, url, kwargs))
+        return self.pop(0)
+
+
+@pytest.fixture
+def responses(monkeypatch) -> ResponseQueue:
+    queue = ResponseQueue()
+    monkeypatch.setattr(google_api.requests, 'request', queue.request)
+    monkeypatch.setattr(google_api.random, 'uniform', lambda low, high: high)
+    return queue
+
+
+def start_leader(single_flight: SingleFlight, executor: ThreadPoolExecutor, function) -> tuple:
+    """ Start the call that followers coalesce with, returns its future and the in-flight call """
+    future = executor.submit(single_flight.do, 'key', function)
+    deadline = time.monotonic() + 5
+    while 'key' not in single_flight._calls:
+        assert time.monotonic() < deadline, "the leader did not start"
+        time.sleep(0.001)
+    call = single_flight._calls['key']
+    call.done = CountingEvent()
+    return future, call
+
+
+def wait_for_followers(call, count: int) -> None:
+    deadline = time.monotonic() + 5
+    while call.done.waiters < count:
+        assert time.monotonic() < deadline, "the followers did not arrive"
+        time.sleep(0.001)
+
+
+def test_concurrent_calls_share_one_call():
+    single_flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def function():
+        calls.append(threading.get_ident())
+        release.wait(5)
+        return {'value': len(calls)}
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        leader, call = start_leader(single_flight, executor, function)
+        followers = [executor.submit(single_flight.do, 'key', function) for _ in range(3)]
+        wait_for_followers(call, 3)
+        release.set()
+        results = [leader.result(5)] + [follower.result(5) for follower in followers]
+
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert 'key' not in single_flight._calls
+
+
+def test_followers_get_the_error_of_the_leader():
+    single_flight = SingleFlight()
+    release = threading.Event()
+
+    def function():
+        release.wait(5)
+        raise ValueError("failed")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader, call = start_leader(single_flight, executor, function)
+        follower = executor.submit(single_flight.do, 'key', function)
+        wait_for_followers(call, 1)
+        release.set()
+        with pytest.raises(ValueError, match="failed"):
+            leader.result(5)
+        with pytest.raises(ValueError, match="failed"):
+            follower.result(5)
+
+
+def test_finished_calls_are_not_cached():
+    single_flight = SingleFlight()
+    calls = []
+
+    def function():
+        calls.append(1)
+        return len(calls)
+
+    assert single_flight.do('key', function) == 1
+    assert single_flight.do('key', function) == 2
+
+
+def test_different_keys_do_not_coalesce():
+    single_flight = SingleFlight()
+    release = threading.Event()
+
+    def blocked():
+        release.wait(5)
+        return 'blocked'
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        leader, _ = start_leader(single_flight, executor, blocked)
+        assert single_flight.do('other key', lambda: 'other') == 'other'
+        release.set()
+        assert leader.result(5) == 'blocked'
+
+
+def test_follower_calls_itself_after_wait_timeout():
+    single_flight = SingleFlight(wait_timeout=0.05)
+    release = threading.Event()
+
+    def hung():
+        release.wait(5)
+        return 'leader'
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        leader, _ = start_leader(single_flight, executor, hung)
+        try:
+            assert single_flight.do('key', lambda: 'follower') == 'follower'
+        finally:
+            release.set()
+        assert leader.result(5) == 'leader'
+
+
+def test_reads_coalesce_per_user_and_ignore_parameter_order():
+    google_api.register_token_owner('token of alice', 'alice')
+    google_api.register_token_owner('refreshed token of alice', 'alice')
+    url = 'https://gmail.googleapis.com/gmail/v1/users/me/messages'
+
+    key = google_api._request_key('token of alice', url, {'q': 'model', 'fields': 'id'})
+
+    assert key == google_api._request_key('refreshed token of alice', url, {'fields': 'id', 'q': 'model'})
+    assert key != google_api._request_key('token of bob', url, {'q': 'model', 'fields': 'id'})
+    assert key != google_api._request_key('token of alice', url, {'q': 'other', 'fields': 'id'})
+    # list parameters must be hashable as part of the key
+    hash(google_api._request_key('token of alice', url, {'id': ['a', 'b']}))
+
+
+def test_token_bucket_waits_for_missing_units(clock):
+    bucket = TokenBucket(rate=10, capacity=10)
+
+    assert bucket.reserve(10) == 0
+    assert bucket.reserve(5) == pytest.approx(0.5)
+    # reservations queue up behind each other
+    assert bucket.reserve(5) == pytest.approx(1.0)
+
+
+def test_token_bucket_refills_up_to_its_capacity(clock):
+    bucket = TokenBucket(rate=10, capacity=10)
+    bucket.reserve(10)
+
+    clock.now += 0.5
+    assert not bucket.is_full()
+    assert bucket.reserve(5) == 0
+
+    clock.now += 60
+    assert bucket.is_full()
+    assert bucket.reserve(10) == 0
+    assert bucket.reserve(1) == pytest.approx(0.1)
+
+
+def test_token_bucket_pause_holds_everything_back(clock):
+    bucket = TokenBucket(rate=10, capacity=10)
+
+    bucket.pause(2)
+
+    assert bucket.reserve(1) == pytest.approx(2.1)
+
+
+def test_rate_limiter_shares_buckets_between_tokens_of_a_user(clock):
+    limiter = RateLimiter()
+    limiter.register_token_owner('old token', 'alice')
+    limiter.register_token_owner('new token', 'alice')
+
+    bucket = limiter.bucket(limiter.user_key('old token'), 'gmail')
+
+    assert limiter.bucket(limiter.user_key('new token'), 'gmail') is bucket
+    assert limiter.bucket(limiter.user_key('new token'), 'calendar') is not bucket
+    assert limiter.bucket(limiter.user_key('token of bob'), 'gmail') is not bucket
+
+
+def test_rate_limiter_prunes_full_buckets_and_old_tokens(clock):
+    limiter = RateLimiter()
+    limiter.register_token_owner('token', 'alice')
+    limiter.bucket('alice', 'calendar').reserve(1)
+
+    clock.now += google_api.token_owner_ttl_seconds + 1
+    limiter.bucket('bob', 'calendar')
+
+    assert ('alice', 'calendar') not in limiter._buckets
+    assert limiter.user_key('token') != 'alice'
+
+
+@pytest.mark.parametrize(('method', 'url', 'expected'), [
+    ('GET', 'https://gmail.googleapis.com/gmail/v1/users/me/messages', ('gmail', 5)),
+    ('GET', 'https://gmail.googleapis.com/gmail/v1/users/me/threads/abc?format=full', ('gmail', 10)),
+    ('POST', 'https://gmail.googleapis.com/gmail/v1/users/me/drafts/send', ('gmail', 100)),
+    ('DELETE', 'https://gmail.googleapis.com/gmail/v1/users/me/drafts/abc', ('gmail', 10)),
+    ('GET', CALENDAR_URL, ('calendar', 1)),
+])
+def test_quota_cost(method, url, expected):
+    assert google_api._quota_cost(method, url) == expected
+
+
+@pytest.mark.parametrize(('headers', 'expected'), [
+    ({}, None),
+    ({'Retry-After': '3'}, 3.0),
+    ({'Retry-After': '-1'}, 0.0),
+    ({'Retry-After': '3600'}, google_api.backoff_max_seconds),
+    ({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}, None),
+])
+def test_retry_after_seconds(headers, expected):
+    assert google_api._retry_after_seconds(make_response(429, headers=headers)) == expected
+
+
+def test_rate_limited_requests_are_retried_after_retry_after(clock, responses):
+    responses.extend([make_response(429, headers={'Retry-After': '2'}), make_response(200, b'{"items": []}')])
+
+    response = google_api.google_request('GET', 'token', CALENDAR_URL)
+
+    assert response.json() == {'items': []}
+    assert len(responses.sent) == 2
+    assert responses.sent[0][2]['timeout'] == google_api.request_timeout_seconds
+    # the retry waits for the pause of the bucket and its own unit
+    assert clock.sleeps == [pytest.approx(2.1)]
+
+
+def test_forbidden_is_only_retried_for_rate_limit_reasons(clock, responses):
+    responses.extend([make_response(403, rate_limit_error('userRateLimitExceeded')), make_response(200)])
+    assert google_api.google_request('POST', 'token', CALENDAR_URL, json={}).status_code == 200
+
+    responses.append(make_response(403, rate_limit_error('insufficientPermissions')))
+    with pytest.raises(requests.exceptions.HTTPError):
+        google_api.google_request('GET', 'token', CALENDAR_URL)
+    assert len(responses.sent) == 3
+
+
+def test_server_errors_are_only_retried_for_get(clock, responses):
+    responses.extend([make_response(503), make_response(200)])
+    assert google_api.google_request('GET', 'token', CALENDAR_URL).status_code == 200
+    assert clock.sleeps == [google_api.backoff_base_seconds]
+
+    responses.append(make_response(503))
+    with pytest.raises(requests.exceptions.HTTPError):
+        google_api.google_request('POST', 'token', CALENDAR_URL, json={})
+    assert len(responses.sent) == 3
+
+
+def test_retries_are_limited(clock, responses):
+    responses.extend(make_response(503) for _ in range(google_api.max_retries + 1))
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        google_api.google_request('GET', 'token', CALENDAR_URL)
+
+    assert len(responses.sent) == google_api.max_retries + 1
+    # jittered exponential backoff, the jitter is fixed to its upper bound here
+    assert clock.sleeps == [
+        min(google_api.backoff_max_seconds, google_api.backoff_base_seconds * 2 ** attempt)
+        for attempt in range(google_api.max_retries)
+    ]
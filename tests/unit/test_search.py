@@ -0,0 +1,28 @@
+from unittest import mock
+
+# the search module loads the encoders on import, the fusion does not need them
+with mock.patch("sentence_transformers.SentenceTransformer"), mock.patch("sentence_transformers.CrossEncoder"):
+    from backend import search
+
+
+def test_reciprocal_rank_fusion_prefers_documents_ranked_by_both():
+    fused = search.reciprocal_rank_fusion([[1, 2, 3], [3, 1, 4]])
+
+    assert fused == [1, 3, 2, 4]
+
+
+def test_reciprocal_rank_fusion_scores():
+    k = 10
+    fused = search.reciprocal_rank_fusion([[7, 8], [8]], k=k)
+
+    # 8 scores 1 / (k + 2) + 1 / (k + 1), more than the single first rank of 7
+    assert fused == [8, 7]
+
+
+def test_reciprocal_rank_fusion_single_ranking_is_unchanged():
+    assert search.reciprocal_rank_fusion([[5, 2, 9]]) == [5, 2, 9]
+
+
+def test_reciprocal_rank_fusion_of_nothing():
+    assert search.reciprocal_rank_fusion([]) == []
+    assert search.reciprocal_rank_fusion([[], []]) == []
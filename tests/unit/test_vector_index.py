@@ -0,0 +1,255 @@
+import gc
+import os
+
+import numpy as np
+import pytest
+
+from backend import vector_index
+from backend.vector_index import VectorIndex, index_lock
+
+DIMENSION = 16
+
+
+@pytest.fixture
+def rng() -> np.random.Generator:
+    return np.random.default_rng(0)
+
+
+def random_vectors(rng: np.random.Generator, ids: list[str]) -> dict[str, np.ndarray]:
+    return {vector_id: rng.normal(size=DIMENSION).astype(np.float32) for vector_id in ids}
+
+
+def brute_force(vectors: dict[str, np.ndarray], query: np.ndarray, k: int) -> list[tuple[str, float]]:
+    similarities = {
+        vector_id: float(vector @ query / np.linalg.norm(vector) / np.linalg.norm(query))
+        for vector_id, vector in vectors.items()
+    }
+    return sorted(similarities.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+def assert_same_results(results: list[tuple[str, float]], expected: list[tuple[str, float]]) -> None:
+    assert [vector_id for vector_id, _ in results] == [vector_id for vector_id, _ in expected]
+    np.testing.assert_allclose([score for _, score in results], [score for _, score in expected], atol=1e-5)
+
+
+def segment_files(directory) -> list[str]:
+    return sorted(name for name in os.listdir(directory) if name.startswith("segment-"))
+
+
+def test_search_is_exact(rng):
+    vectors = random_vectors(rng, [f"v{idx}" for idx in range(50)])
+    index = VectorIndex(dtype='float32')
+    index.add(dict(list(vectors.items())[:20]))
+    index.add(dict(list(vectors.items())[20:]))
+    query = rng.normal(size=DIMENSION)
+
+    assert len(index) == 50
+    assert_same_results(index.search(query, 5), brute_force(vectors, query, 5))
+    assert len(index.search(query, 100)) == 50
+
+
+def test_search_within_given_ids(rng):
+    vectors = random_vectors(rng, ['a', 'b', 'c', 'd'])
+    index = VectorIndex(dtype='float32')
+    index.add(vectors)
+    query = rng.normal(size=DIMENSION)
+
+    results = index.search(query, 10, vector_ids=['b', 'd'])
+
+    assert_same_results(results, brute_force({'b': vectors['b'], 'd': vectors['d']}, query, 10))
+    assert index.search(query, 10, vector_ids=[]) == []
+    assert VectorIndex().search(query, 10) == []
+
+
+def test_vectors_are_stored_with_unit_length(rng):
+    index = VectorIndex(dtype='float32')
+    index.add({'a': np.asarray([3.0, 4.0] + [0.0] * (DIMENSION - 2))})
+
+    np.testing.assert_allclose(index.get_vectors(['a'])[0][:2], [0.6, 0.8])
+
+
+def test_adding_an_indexed_id_replaces_it(rng):
+    index = VectorIndex(dtype='float32')
+    index.add(random_vectors(rng, ['a', 'b']))
+    replacement = rng.normal(size=DIMENSION)
+
+    index.add({'a': replacement})
+
+    assert len(index) == 2
+    np.testing.assert_allclose(index.get_vectors(['a'])[0], replacement / np.linalg.norm(replacement), atol=1e-6)
+    assert [vector_id for vector_id, _ in index.search(replacement, 1)] == ['a']
+
+
+def test_removed_vectors_are_not_found(rng, monkeypatch):
+    monkeypatch.setattr("backend.vector_index.compaction_threshold", 1.0)
+    vectors = random_vectors(rng, ['a', 'b', 'c'])
+    index = VectorIndex(dtype='float32')
+    index.add(vectors)
+
+    index.remove(['b', 'unknown'])
+
+    assert 'b' not in index and len(index) == 2
+    assert index.ids == ['a', None, 'c']
+    assert {vector_id for vector_id, _ in index.search(vectors['b'], 10)} == {'a', 'c'}
+
+
+def test_removing_most_vectors_compacts_into_one_segment(rng):
+    vectors = random_vectors(rng, ['a', 'b', 'c', 'd'])
+    index = VectorIndex(dtype='float32')
+    index.add({'a': vectors['a'], 'b': vectors['b']})
+    index.add({'c': vectors['c'], 'd': vectors['d']})
+
+    index.remove(['a', 'c'])
+
+    assert index.ids == ['b', 'd']
+    assert len(index._segments) == 1
+    query = rng.normal(size=DIMENSION)
+    assert_same_results(index.search(query, 2), brute_force({'b': vectors['b'], 'd': vectors['d']}, query, 2))
+
+
+def test_save_and_load_round_trip(rng, tmp_path, monkeypatch):
+    monkeypatch.setattr("backend.vector_index.compaction_threshold", 1.0)
+    vectors = random_vectors(rng, ['a', 'b', 'c'])
+    index = VectorIndex(dtype='float32')
+    index.add(vectors)
+    index.remove(['b'])
+    directory = tmp_path / "vector_index"
+
+    index.save(str(directory))
+    loaded = VectorIndex.load(str(directory))
+
+    assert loaded.ids == ['a', None, 'c']
+    assert 'b' not in loaded and len(loaded) == 2
+    assert isinstance(loaded._segments[0], np.memmap)
+    query = rng.normal(size=DIMENSION)
+    assert_same_results(loaded.search(query, 3), index.search(query, 3))
+
+
+def test_save_only_writes_new_segments_and_deletes_unused_ones(rng, tmp_path):
+    directory = tmp_path / "vector_index"
+    index = VectorIndex(dtype='float32')
+    index.add(random_vectors(rng, ['a', 'b']))
+    index.save(str(directory))
+    first_segments = segment_files(directory)
+
+    index = VectorIndex.load(str(directory))
+    index.add(random_vectors(rng, ['c']))
+    index.save(str(directory))
+    assert len(segment_files(directory)) == 2
+    assert set(first_segments) < set(segment_files(directory))
+
+    index.remove(['a', 'b'])
+    index.save(str(directory))
+    assert len(segment_files(directory)) == 1
+    assert VectorIndex.load(str(directory)).ids == ['c']
+
+
+def test_load_missing_directory_returns_an_empty_index(tmp_path):
+    index = VectorIndex.load(str(tmp_path / "missing"))
+
+    assert len(index) == 0
+
+
+def test_index_lock_is_shared_per_directory(tmp_path):
+    lock = index_lock(str(tmp_path / "index"))
+
+    assert index_lock(str(tmp_path / "other" / ".." / "index")) is lock
+    assert index_lock(str(tmp_path / "other")) is not lock
+    # loading and saving take the lock again while the caller holds it
+    with lock:
+        VectorIndex().save(str(tmp_path / "index"))
+        VectorIndex.load(str(tmp_path / "index"))
+
+
+def test_index_lock_is_dropped_when_unused(tmp_path):
+    index_lock(str(tmp_path / "index"))
+    gc.collect()
+
+    assert os.path.abspath(str(tmp_path / "index")) not in vector_index._directory_locks
+
+
+@pytest.mark.parametrize(('dtype', 'tolerance'), [('float16', 1e-3), ('int8', 2e-2)])
+def test_compact_storage_keeps_the_scores_close(rng, dtype, tolerance):
+    vectors = random_vectors(rng, [f"v{idx}" for idx in range(30)])
+    reference = VectorIndex(dtype='float32')
+    reference.add(vectors)
+    index = VectorIndex(dtype=dtype)
+    index.add(vectors)
+    query = rng.normal(size=DIMENSION)
+
+    scores = dict(index.search(query, 30))
+
+    assert index.nbytes < reference.nbytes
+    for vector_id, score in reference.search(query, 30):
+        assert scores[vector_id] == pytest.approx(score, abs=tolerance)
+    np.testing.assert_allclose(index.get_vectors(['v0']), reference.get_vectors(['v0']), atol=tolerance)
+
+
+def test_int8_vectors_are_quantized_per_vector(rng):
+    index = VectorIndex(dtype='int8')
+    index.add({'a': rng.normal(size=DIMENSION), 'b': rng.normal(size=DIMENSION)})
+
+    assert index._segments[0].dtype == np.int8
+    # every vector uses the full int8 range with its own scale
+    assert np.abs(index._segments[0]).max(axis=1).tolist() == [127, 127]
+    assert index._scales[0] != index._scales[1]
+
+
+def test_compact_does_not_quantize_again(rng, monkeypatch):
+    monkeypatch.setattr("backend.vector_index.compaction_threshold", 1.0)
+    index = VectorIndex(dtype='int8')
+    index.add(random_vectors(rng, ['a', 'b', 'c']))
+    codes = np.array(index._segments[0][[0, 2]])
+    scales = index._scales[[0, 2]].copy()
+    index.remove(['b'])
+
+    index.compact()
+
+    np.testing.assert_array_equal(index._segments[0], codes)
+    np.testing.assert_array_equal(index._scales, scales)
+
+
+def test_scoring_in_blocks_matches_scoring_at_once(rng, monkeypatch):
+    vectors = random_vectors(rng, [f"v{idx}" for idx in range(25)])
+    index = VectorIndex(dtype='int8')
+    index.add(vectors)
+    query = rng.normal(size=DIMENSION)
+    expected = index.search(query, 25)
+
+    monkeypatch.setattr("backend.vector_index.scoring_block_size", 4)
+
+    assert_same_results(index.search(query, 25), expected)
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float16', 'int8'])
+def test_storage_type_survives_save_and_load(rng, tmp_path, dtype):
+    index = VectorIndex(dtype=dtype)
+    index.add(random_vectors(rng, ['a', 'b']))
+    index.save(str(tmp_path / "vector_index"))
+
+    loaded = VectorIndex.load(str(tmp_path / "vector_index"))
+
+    assert loaded.dtype == dtype
+    assert loaded._segments[0].dtype == np.dtype(dtype)
+    query = rng.normal(size=DIMENSION)
+    assert loaded.search(query, 2) == index.search(query, 2)
+
+
+def test_unknown_storage_type_is_rejected():
+    with pytest.raises(ValueError):
+        VectorIndex(dtype='int4')
+
+
+def test_measure_recall(rng):
+    vectors = random_vectors(rng, [f"v{idx}" for idx in range(40)])
+    reference = VectorIndex(dtype='float32')
+    reference.add(vectors)
+    index = VectorIndex(dtype='int8')
+    index.add(vectors)
+    queries = rng.normal(size=(5, DIMENSION))
+
+    assert vector_index.measure_recall(reference, reference, queries, 5) == 1.0
+    assert vector_index.measure_recall(index, reference, queries, 5) >= 0.8
+    partial = VectorIndex(dtype='float32')
+    partial.add(dict(list(vectors.items())[:20]))
+    assert vector_index.measure_recall(partial, reference, queries, 5) < 1.0
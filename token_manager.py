@@ -0,0 +1,181 @@
+import asyncio
+import os
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+import logfire
+import requests
+from sqlmodel import Session
+
+from .database import engine
+from .google_api import SingleFlight, register_token_owner, request_timeout_seconds
+from .models.user import User
+
+# refresh tokens this long before they expire
+refresh_margin = timedelta(minutes=5)
+refresh_loop_interval_seconds = 60
+# users without a request for this long are no longer refreshed in the background,
+# their token is refreshed on their next request instead
+inactive_user_timeout = timedelta(hours=1)
+
+
+def utc_now() -> datetime:
+    """ The current time as naive UTC datetime, the way token expiries are stored """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def token_expiry(expires_in: int) -> datetime:
+    """ Convert the relative expires_in of a token response into an absolute expiry """
+    return utc_now() + timedelta(seconds=expires_in)
+
+
+@dataclass
+class _CachedToken:
+    token: str
+    expires_at: datetime | None
+    last_used: datetime
+
+
+class TokenManager:
+    """
+    Keeps the Google access tokens of active users valid.
+
+    Tokens are cached in memory, so the hot path needs neither a database query nor a round trip to Google.
+    Tokens close to their expiry are refreshed in the background while the user is active,
+    expired tokens are refreshed before use.
+    Concurrent refreshes of the same user share a single request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens: dict[str, _CachedToken] = {}
+        self._refreshes = SingleFlight(wait_timeout=sum(request_timeout_seconds))
+
+    def remember(self, user: User) -> None:
+        """ Cache the token of a user, e.g. after the user logged in """
+        with self._lock:
+            self._tokens[user.id] = _CachedToken(user.google_token, user.google_token_expires_at, utc_now())
+        register_token_owner(user.google_token, user.id)
+
+    def _cached(self, user: User) -> _CachedToken:
+        with self._lock:
+            cached = self._tokens.get(user.id)
+        if cached is None:
+            self.remember(user)
+            with self._lock:
+                cached = self._tokens[user.id]
+        return cached
+
+    async def get_token(self, user: User) -> str:
+        """
+        Get a valid Google access token of a user.
+
+        Args:
+            user (User): The user.
+
+        Returns:
+            str: The access token.
+        """
+        cached = self._cached(user)
+        cached.last_used = utc_now()
+        if cached.expires_at is None:
+            return cached.token
+
+        remaining = cached.expires_at - utc_now()
+        if remaining > refresh_margin:
+            return cached.token
+        if remaining > timedelta(0):
+            asyncio.get_running_loop().run_in_executor(None, self._refresh_in_background, user.id)
+            return cached.token
+        try:
+            return await asyncio.to_thread(self.refresh, user.id)
+        except Exception as error:
+            logfire.error(f"Failed to refresh expired Google token: {error}")
+            return cached.token
+
+    def _refresh_in_background(self, user_id: str) -> None:
+        try:
+            self.refresh(user_id)
+        except Exception as error:
+            logfire.error(f"Failed to refresh Google token in background: {error}")
+
+    def refresh(self, user_id: str) -> str:
+        """
+        Refresh the Google access token of a user and store it.
+
+        Args:
+            user_id (str): The id of the user.
+
+        Returns:
+            str: The new access token.
+        """
+        return self._refreshes.do(user_id, lambda: self._refresh(user_id))
+
+    def _refresh(self, user_id: str) -> str:
+        with Session(engine) as db_session:
+            user = db_session.get(User, user_id)
+            if user is None:
+                raise ValueError("User not found")
+            # another worker might have refreshed the token already
+            if user.google_token_expires_at and user.google_token_expires_at - utc_now() > refresh_margin:
+                self.remember(user)
+                return user.google_token
+            if not user.google_refresh_token:
+                raise ValueError("User has no refresh token, a new login is required")
+
+            with logfire.span("Refreshing Google token"):
+                token_response = requests.post(
+                    "https://accounts.google.com/o/oauth2/token",
+                    data={
+                        "client_id": os.getenv("GOOGLE_CLIENT_ID"),
+                        "client_secret": os.getenv("GOOGLE_CLIENT_SECRET"),
+                        "refresh_token": user.google_refresh_token,
+                        "grant_type": "refresh_token",
+                    },
+                    timeout=request_timeout_seconds,
+                )
+                token_response.raise_for_status()
+                token_info = token_response.json()
+
+            user.google_token = token_info["access_token"]
+            user.google_token_expires_at = token_expiry(token_info["expires_in"])
+            # google only rotates the refresh token occasionally
+            if token_info.get("refresh_token"):
+                user.google_refresh_token = token_info["refresh_token"]
+            db_session.commit()
+            db_session.refresh(user)
+            self.remember(user)
+            return user.google_token
+
+    def refresh_expiring(self) -> None:
+        """ Refresh the cached tokens that expire within the refresh margin, inactive users are evicted """
+        now = utc_now()
+        deadline = now + refresh_margin
+        with self._lock:
+            inactive = [
+                user_id for user_id, cached in self._tokens.items() if now - cached.last_used > inactive_user_timeout
+            ]
+            for user_id in inactive:
+                del self._tokens[user_id]
+            expiring = [
+                user_id for user_id, cached in self._tokens.items()
+                if cached.expires_at is not None and cached.expires_at <= deadline
+            ]
+        for user_id in expiring:
+            try:
+                self.refresh(user_id)
+            except Exception as error:
+                logfire.error(f"Failed to refresh Google token: {error}")
+                # stop retrying until the user logs in again
+                with self._lock:
+                    self._tokens.pop(user_id, None)
+
+    async def run_refresh_loop(self) -> None:
+        """ Periodically refresh expiring tokens, meant to run as a background task for the app's lifetime """
+        while True:
+            await asyncio.sleep(refresh_loop_interval_seconds)
+            await asyncio.to_thread(self.refresh_expiring)
+
+
+token_manager = TokenManager()
@@ -0,0 +1,112 @@
+import os
+
+from .models.compact_draft import CompactDraft
+from .models.compact_email import CompactEmail
+from .models.compact_event import CompactEvent
+from .models.compact_sent_message import CompactSentMessage
+
+# caps on what a tool returns to the model, everything beyond is dropped or truncated
+TOOL_OUTPUT_MAX_ITEMS = int(os.getenv("TOOL_OUTPUT_MAX_ITEMS", 25))
+TOOL_OUTPUT_MAX_TEXT_CHARS = int(os.getenv("TOOL_OUTPUT_MAX_TEXT_CHARS", 300))
+TOOL_OUTPUT_MAX_EMAIL_CHARS = int(os.getenv("TOOL_OUTPUT_MAX_EMAIL_CHARS", 1500))
+TOOL_OUTPUT_MAX_EMAIL_DETAILS_CHARS = int(os.getenv("TOOL_OUTPUT_MAX_EMAIL_DETAILS_CHARS", 6000))
+TOOL_OUTPUT_MAX_ATTENDEES = int(os.getenv("TOOL_OUTPUT_MAX_ATTENDEES", 5))
+
+
+def truncate_text(text: str | None, max_chars: int) -> str | None:
+    """ Truncate a text to max_chars characters, marking the cut """
+    if text is None or len(text) <= max_chars:
+        return text
+    return text[:max_chars].rstrip() + '…'
+
+
+def _event_time(time: dict | None) -> str | None:
+    """ Internal method to flatten a calendar event time, all day events only have a date """
+    if not time:
+        return None
+    return time.get('dateTime') or time.get('date')
+
+
+def compact_event(event: dict) -> dict:
+    """
+    Project a Google Calendar event to the fields the model needs.
+
+    Args:
+        event (dict): The event resource from the Calendar API.
+
+    Returns:
+        dict: The compact event, without empty fields.
+    """
+    # resources and some groups come without an email
+    attendees = [
+        attendee.get('displayName') or attendee.get('email')
+        for attendee in event.get('attendees') or []
+    ]
+    attendees = [attendee for attendee in attendees if attendee]
+    return CompactEvent(
+        id=event['id'],
+        summary=event.get('summary'),
+        start=_event_time(event.get('start')),
+        end=_event_time(event.get('end')),
+        location=event.get('location'),
+        description=truncate_text(event.get('description'), TOOL_OUTPUT_MAX_TEXT_CHARS),
+        attendees=attendees[:TOOL_OUTPUT_MAX_ATTENDEES] or None,
+        attendee_count=len(attendees) if len(attendees) > TOOL_OUTPUT_MAX_ATTENDEES else None,
+        recurrence=event.get('recurrence'),
+    ).model_dump(exclude_none=True)
+
+
+def compact_events(events: list[dict]) -> dict:
+    """
+    Project a list of calendar events, capped at TOOL_OUTPUT_MAX_ITEMS events.
+
+    Returns:
+        dict: The compact events and, if the list was capped, the number of events left out.
+    """
+    compacted = {'events': [compact_event(event) for event in events[:TOOL_OUTPUT_MAX_ITEMS]]}
+    if len(events) > TOOL_OUTPUT_MAX_ITEMS:
+        compacted['omitted_events'] = len(events) - TOOL_OUTPUT_MAX_ITEMS
+    return compacted
+
+
+def compact_email(email: dict, max_chars: int = TOOL_OUTPUT_MAX_EMAIL_CHARS) -> dict:
+    """ Project a preprocessed e-mail, see search.preprocess_emails, truncating its text """
+    return CompactEmail(id=email['id'], data=truncate_text(email['data'], max_chars)).model_dump()
+
+
+def compact_emails(emails: list[dict]) -> list[dict]:
+    """ Project a list of preprocessed e-mails, capped at TOOL_OUTPUT_MAX_ITEMS e-mails """
+    return [compact_email(email) for email in emails[:TOOL_OUTPUT_MAX_ITEMS]]
+
+
+def compact_draft(draft: dict) -> dict:
+    """ Project a Gmail draft resource to its ids """
+    message = draft.get('message') or {}
+    return CompactDraft(
+        id=draft['id'],
+        message_id=message.get('id'),
+        thread_id=message.get('threadId'),
+    ).model_dump(exclude_none=True)
+
+
+def compact_drafts(drafts_response: dict) -> dict:
+    """
+    Project a Gmail drafts list response, capped at TOOL_OUTPUT_MAX_ITEMS drafts.
+
+    Returns:
+        dict: The compact drafts and, if the list was capped, whether there are more drafts.
+    """
+    drafts = drafts_response.get('drafts', [])
+    compacted = {'drafts': [compact_draft(draft) for draft in drafts[:TOOL_OUTPUT_MAX_ITEMS]]}
+    if len(drafts) > TOOL_OUTPUT_MAX_ITEMS or drafts_response.get('nextPageToken'):
+        compacted['more_drafts'] = True
+    return compacted
+
+
+def compact_sent_message(message: dict) -> dict:
+    """ Project a sent Gmail message resource to its ids and labels """
+    return CompactSentMessage(
+        id=message['id'],
+        thread_id=message.get('threadId'),
+        labels=message.get('labelIds'),
+    ).model_dump(exclude_none=True)
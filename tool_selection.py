@@ -0,0 +1,100 @@
+import inspect
+import os
+import threading
+from typing import Callable
+
+import logfire
+import torch
+from sentence_transformers import util
+
+from .search import bi_encoder
+
+TOOL_SELECTION_ENABLED = os.getenv("TOOL_SELECTION_ENABLED", "true").lower() == "true"
+# tools that are needed by almost every tool using turn, or to resolve follow-up questions
+ALWAYS_SELECTED_TOOLS = frozenset({'get_offset_time', 'get_user_timezone', 'get_user_recent_messages'})
+# a tool is selected if it is within this similarity of the best matching tool
+relative_margin = 0.12
+# if no tool is at least this similar to the message, the selection is not trusted
+minimum_similarity = 0.15
+max_selected_tools = 6
+# tools used one after another in a single turn, e.g. a draft is looked up before it is sent.
+# Selecting a tool of a group selects the whole group, so no step of the task is missing
+TOOL_GROUPS = [
+    frozenset({'get_user_drafts', 'send_user_draft', 'delete_user_draft'}),
+    frozenset({'draft_user_email', 'send_user_draft'}),
+    frozenset({'get_user_emails', 'get_user_email_details'}),
+]
+
+_description_embeddings: dict[str, torch.Tensor] = {}
+_description_lock = threading.Lock()
+
+
+def tool_description(tool: Callable) -> str:
+    """ The text a tool is matched against: its name and the summary paragraph of its docstring """
+    docstring = inspect.getdoc(tool) or ''
+    summary = docstring.split('\n\n', 1)[0]
+    return f"{tool.__name__.replace('_', ' ')}: {summary}"
+
+
+def _get_description_embeddings(tool_descriptions: dict[str, str]) -> dict[str, torch.Tensor]:
+    """ Internal method to encode tool descriptions once, on first use """
+    with _description_lock:
+        missing = [name for name in tool_descriptions if name not in _description_embeddings]
+        if missing:
+            embeddings = bi_encoder.encode(
+                [tool_descriptions[name] for name in missing],
+                convert_to_tensor=True,
+                show_progress_bar=False
+            )
+            _description_embeddings.update(zip(missing, embeddings))
+        return {name: _description_embeddings[name] for name in tool_descriptions}
+
+
+def select_tools(
+        message_embedding: torch.Tensor,
+        tool_descriptions: dict[str, str],
+        candidates: frozenset[str] | None = None
+) -> frozenset[str] | None:
+    """
+    Select the tools relevant to a message by the similarity of the message to the tool descriptions.
+
+    Falls back to the candidates if no tool clearly matches the message.
+    The partners of a selected tool in TOOL_GROUPS are selected as well.
+
+    Args:
+        message_embedding (torch.Tensor): The bi encoder embedding of the user's message.
+        tool_descriptions (dict[str, str]): The descriptions of all tools by tool name.
+        candidates (frozenset[str], optional): The tools to select from, e.g. those of the message's route.
+            Defaults to None, meaning all tools.
+
+    Returns:
+        frozenset[str] | None: The selected tool names, None means all tools.
+    """
+    if not TOOL_SELECTION_ENABLED:
+        return candidates
+
+    candidate_descriptions = {
+        name: description for name, description in tool_descriptions.items()
+        if (candidates is None or name in candidates) and name not in ALWAYS_SELECTED_TOOLS
+    }
+    if not candidate_descriptions:
+        return candidates
+
+    embeddings = _get_description_embeddings(candidate_descriptions)
+    names = list(embeddings)
+    similarities = util.cos_sim(message_embedding, torch.stack([embeddings[name] for name in names]))[0].tolist()
+    ranked = sorted(zip(names, similarities), key=lambda item: item[1], reverse=True)
+    best_similarity = ranked[0][1]
+    if best_similarity < minimum_similarity:
+        logfire.debug("No tool matches the message clearly, keeping {count} candidate tools", count=len(names))
+        return candidates
+
+    selected = {
+        name for name, similarity in ranked[:max_selected_tools]
+        if similarity >= max(best_similarity - relative_margin, minimum_similarity)
+    }
+    for group in TOOL_GROUPS:
+        if selected & group:
+            selected |= {name for name in group if name in candidate_descriptions}
+    logfire.debug("Selected tools {tools}", tools=sorted(selected))
+    return frozenset(selected) | (ALWAYS_SELECTED_TOOLS & (candidates or ALWAYS_SELECTED_TOOLS))
@@ -0,0 +1,302 @@
+import os
+import tempfile
+import threading
+import weakref
+
+import numpy as np
+
+from .storage import user_data_directory
+
+VECTOR_INDEX_DIRECTORY = "vector_index"
+VECTOR_THREAD_INDEX_DIRECTORY = "vector_thread_index"
+# compact the index once this fraction of its rows belongs to removed vectors
+compaction_threshold = 0.5
+# how new indexes store their vectors: float32, float16 or int8, existing indexes keep their storage type
+VECTOR_INDEX_DTYPE = os.getenv("VECTOR_INDEX_DTYPE", "float16")
+STORAGE_DTYPES = {'float32': np.float32, 'float16': np.float16, 'int8': np.int8}
+# vectors are scored in blocks of this many rows, which bounds the memory of decoding compact vectors
+scoring_block_size = 16384
+_METADATA_FILENAME = "index.npz"
+
+# saving deletes the segments the saved index does not use, so updates of an index must not overlap,
+# locks are dropped once nobody holds a reference to them
+_directory_locks: weakref.WeakValueDictionary[str, threading.RLock] = weakref.WeakValueDictionary()
+_directory_locks_lock = threading.Lock()
+
+
+def index_lock(directory: str) -> threading.RLock:
+    """
+    Get the lock of an index directory.
+
+    Hold it from loading an index to saving it, otherwise a concurrent update of the same index is lost
+    and its save deletes the segments of this one. Loading and saving take the lock as well.
+    """
+    with _directory_locks_lock:
+        lock = _directory_locks.get(os.path.abspath(directory))
+        if lock is None:
+            lock = threading.RLock()
+            _directory_locks[os.path.abspath(directory)] = lock
+        return lock
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """ Internal method to scale vectors to unit length, so the dot product is the cosine similarity """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class VectorIndex:
+    """
+    A persistent index of unit vectors keyed by string ids, for cosine similarity search.
+
+    Vectors are stored in append-only segments, so adding vectors only writes the new ones
+    and saved segments are memory-mapped when the index is loaded.
+    Removing vectors marks their rows as removed until the index gets compacted.
+
+    Vectors can be stored as float32, float16 or int8. int8 vectors are quantized per vector,
+    each with its own scale. Scoring decodes the compact vectors block by block,
+    so the full precision matrix is never materialized.
+
+    Searches are exact, the app only scores the candidates of a Gmail search, so an approximate index does not pay off.
+    """
+
+    def __init__(self, dtype: str = VECTOR_INDEX_DTYPE):
+        if dtype not in STORAGE_DTYPES:
+            raise ValueError(f"dtype must be one of {', '.join(STORAGE_DTYPES)}")
+        self.dtype = dtype
+        self.ids: list[str | None] = []
+        self._rows: dict[str, int] = {}
+        self._segments: list[np.ndarray] = []
+        self._segment_names: list[str | None] = []
+        self._segment_offsets = np.zeros(1, dtype=np.int64)
+        self._removed = np.zeros(0, dtype=bool)
+        # the dequantization factor of every row, 1 unless the vectors are stored as int8
+        self._scales = np.zeros(0, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, vector_id: str) -> bool:
+        return vector_id in self._rows
+
+    @property
+    def nbytes(self) -> int:
+        """ The size of the stored vectors and their scales in bytes """
+        return sum(segment.nbytes for segment in self._segments) + self._scales.nbytes
+
+    def add(self, vectors: dict[str, np.ndarray]) -> None:
+        """
+        Add vectors to the index, vectors that are already indexed are replaced.
+
+        Args:
+            vectors (dict[str, np.ndarray]): A mapping of ids to vectors.
+        """
+        if not vectors:
+            return
+        self.remove([vector_id for vector_id in vectors if vector_id in self._rows])
+
+        normalized = _normalize(np.stack(list(vectors.values())))
+        segment, scales = self._encode(normalized)
+        for vector_id in vectors:
+            self._rows[vector_id] = len(self.ids)
+            self.ids.append(vector_id)
+        self._segments.append(segment)
+        self._segment_names.append(None)
+        self._segment_offsets = np.append(self._segment_offsets, self._segment_offsets[-1] + len(segment))
+        self._removed = np.concatenate([self._removed, np.zeros(len(segment), dtype=bool)])
+        self._scales = np.concatenate([self._scales, scales])
+
+    def remove(self, vector_ids: list[str]) -> None:
+        """
+        Remove vectors from the index, unknown ids are ignored.
+
+        Args:
+            vector_ids (list[str]): The ids of the vectors to remove.
+        """
+        for vector_id in vector_ids:
+            row = self._rows.pop(vector_id, None)
+            if row is None:
+                continue
+            self._removed[row] = True
+            self.ids[row] = None
+
+        if len(self.ids) and 1 - len(self._rows) / len(self.ids) >= compaction_threshold:
+            self.compact()
+
+    def compact(self) -> None:
+        """ Drop the rows of removed vectors, merging all segments into one """
+        alive_rows = np.flatnonzero(~self._removed)
+        # the stored vectors are copied as they are, so compacting does not quantize them again
+        segment = self._codes(alive_rows)
+        self._scales = self._scales[alive_rows]
+        self.ids = [self.ids[row] for row in alive_rows]
+        self._rows = {vector_id: row for row, vector_id in enumerate(self.ids)}
+        self._segments = [segment]
+        self._segment_names = [None]
+        self._segment_offsets = np.asarray([0, len(segment)], dtype=np.int64)
+        self._removed = np.zeros(len(segment), dtype=bool)
+
+    def _encode(self, vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """ Internal method to convert unit vectors to the storage type, returns the stored vectors and their scales """
+        if self.dtype == 'int8':
+            scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+            return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+        return vectors.astype(STORAGE_DTYPES[self.dtype]), np.ones(len(vectors), dtype=np.float32)
+
+    @staticmethod
+    def _decode(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+        """ Internal method to convert stored vectors back to float32 """
+        vectors = np.asarray(codes, dtype=np.float32)
+        return vectors * scales[:, None] if codes.dtype == np.int8 else vectors
+
+    def _codes(self, rows: np.ndarray) -> np.ndarray:
+        """ Internal method to gather the stored vectors of the given rows from their segments """
+        rows = np.asarray(rows, dtype=np.int64)
+        dimension = self._segments[0].shape[1] if self._segments else 0
+        codes = np.empty((len(rows), dimension), dtype=STORAGE_DTYPES[self.dtype])
+        segment_of_row = np.searchsorted(self._segment_offsets, rows, side='right') - 1
+        for segment_idx in np.unique(segment_of_row):
+            mask = segment_of_row == segment_idx
+            codes[mask] = self._segments[segment_idx][rows[mask] - self._segment_offsets[segment_idx]]
+        return codes
+
+    def _vectors(self, rows: np.ndarray) -> np.ndarray:
+        """ Internal method to gather the float32 vectors of the given rows """
+        return self._decode(self._codes(rows), self._scales[np.asarray(rows, dtype=np.int64)])
+
+    def _scores(self, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """ Internal method to score the vectors of the given rows against a unit query, block by block """
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), scoring_block_size):
+            block = rows[start:start + scoring_block_size]
+            # the scale of an int8 vector factors out of its dot product
+            scores[start:start + len(block)] = (
+                np.asarray(self._codes(block), dtype=np.float32) @ query
+            ) * self._scales[block]
+        return scores
+
+    def get_vectors(self, vector_ids: list[str]) -> np.ndarray:
+        """ Get the unit length vectors of the given ids """
+        return self._vectors(np.asarray([self._rows[vector_id] for vector_id in vector_ids], dtype=np.int64))
+
+    def search(
+            self,
+            query: np.ndarray,
+            k: int,
+            vector_ids: list[str] | None = None
+    ) -> list[tuple[str, float]]:
+        """
+        Find the vectors most similar to the query.
+
+        Args:
+            query (np.ndarray): The query vector.
+            k (int): The maximum number of results.
+            vector_ids (list[str], optional): Only search these vectors. Defaults to all vectors of the index.
+
+        Returns:
+            list[tuple[str, float]]: The ids and cosine similarities of the best matches, best first.
+        """
+        query = _normalize(query).reshape(-1)
+        if vector_ids is not None:
+            rows = np.asarray([self._rows[vector_id] for vector_id in vector_ids], dtype=np.int64)
+        else:
+            rows = np.flatnonzero(~self._removed)
+        if len(rows) == 0:
+            return []
+
+        scores = self._scores(rows, query)
+        k = min(k, len(rows))
+        top = np.argpartition(scores, -k)[-k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(self.ids[rows[idx]], float(scores[idx])) for idx in top]
+
+    def save(self, directory: str) -> None:
+        """
+        Persist the index to the given directory.
+
+        Only segments that are not on disk yet are written, the metadata is replaced atomically
+        and segments that are no longer used are deleted afterwards.
+        """
+        os.makedirs(directory, exist_ok=True)
+        with index_lock(directory):
+            self._save(directory)
+
+    def _save(self, directory: str) -> None:
+        for segment_idx, name in enumerate(self._segment_names):
+            if name is not None:
+                continue
+            with tempfile.NamedTemporaryFile(dir=directory, prefix="segment-", suffix=".npy", delete=False) as file:
+                np.save(file, self._segments[segment_idx])
+            self._segment_names[segment_idx] = os.path.basename(file.name)
+
+        with tempfile.NamedTemporaryFile(dir=directory, suffix=".npz", delete=False) as file:
+            np.savez(
+                file,
+                ids=np.asarray(["" if vector_id is None else vector_id for vector_id in self.ids], dtype=np.str_),
+                removed=self._removed,
+                dtype=np.asarray(self.dtype),
+                scales=self._scales,
+                segment_names=np.asarray(self._segment_names, dtype=np.str_),
+                segment_offsets=self._segment_offsets,
+            )
+        os.replace(file.name, os.path.join(directory, _METADATA_FILENAME))
+
+        for entry in os.scandir(directory):
+            if entry.name.startswith("segment-") and entry.name not in self._segment_names:
+                os.remove(entry.path)
+
+    @classmethod
+    def load(cls, directory: str) -> "VectorIndex":
+        """ Load an index from the given directory, memory-mapping its segments. Returns an empty index if there is none """
+        with index_lock(directory):
+            return cls._load(directory)
+
+    @classmethod
+    def _load(cls, directory: str) -> "VectorIndex":
+        metadata_path = os.path.join(directory, _METADATA_FILENAME)
+        if not os.path.exists(metadata_path):
+            return cls()
+        with np.load(metadata_path, allow_pickle=False) as arrays:
+            index = cls(dtype=str(arrays["dtype"]))
+            index._removed = arrays["removed"]
+            index._scales = arrays["scales"]
+            index.ids = [
+                None if removed else vector_id
+                for vector_id, removed in zip(arrays["ids"].tolist(), index._removed.tolist())
+            ]
+            index._rows = {vector_id: row for row, vector_id in enumerate(index.ids) if vector_id is not None}
+            index._segment_names = arrays["segment_names"].tolist()
+            index._segment_offsets = arrays["segment_offsets"]
+        index._segments = [
+            np.load(os.path.join(directory, name), mmap_mode="r") for name in index._segment_names
+        ]
+        return index
+
+
+def user_vector_index_path(user_id: str, directory: str = VECTOR_INDEX_DIRECTORY) -> str:
+    """ Get the directory of a persisted vector index of a user, by default the index of single e-mails """
+    return os.path.join(user_data_directory(user_id), directory)
+
+
+def measure_recall(index: VectorIndex, reference: VectorIndex, queries: np.ndarray, k: int) -> float:
+    """
+    Measure the recall@k of the index's searches against a reference index holding the same vectors,
+    e.g. the loss of an int8 index against a float32 copy.
+
+    Args:
+        index (VectorIndex): The index to measure.
+        reference (VectorIndex): The index whose search results are the ground truth.
+        queries (np.ndarray): The query vectors, one per row.
+        k (int): The number of results per query.
+
+    Returns:
+        float: The fraction of the reference's top k results that the index's search returns.
+    """
+    found = 0
+    expected = 0
+    for query in queries:
+        expected_ids = {vector_id for vector_id, _ in reference.search(query, k)}
+        found += len(expected_ids & {vector_id for vector_id, _ in index.search(query, k)})
+        expected += len(expected_ids)
+    return found / expected if expected else 1.0